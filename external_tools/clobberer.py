@@ -104,7 +104,37 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
-def do_clobber(dir, dryrun=False, skip=None):
+def rmdirRecursiveInBackground(dirs):
+    """Delete `dirs` from a detached child process, so we don't have to wait
+    for them. Deletes them right away where there's no fork()."""
+    if not dirs:
+        return
+    if not hasattr(os, 'fork'):
+        for d in dirs:
+            rmdirRecursive(d)
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork():
+        return
+    try:
+        # Detach, and let go of our parent's output so nothing reading it
+        # waits for us.
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        for d in dirs:
+            try:
+                rmdirRecursive(d)
+            except:
+                pass
+    finally:
+        os._exit(0)
+
+
+def do_clobber(dir, dryrun=False, skip=None, background=False):
+    deferred = []
     try:
         for f in os.listdir(dir):
             if skip is not None and f in skip:
@@ -129,13 +159,17 @@ def do_clobber(dir, dryrun=False, skip=None):
                         rmdirRecursive(clobber_path)
                     # Prevent repeated moving.
                     if f.endswith(clobber_suffix):
-                        rmdirRecursive(f)
+                        clobber_path = f
                     else:
                         shutil.move(f, clobber_path)
+                    if background:
+                        deferred.append(os.path.abspath(clobber_path))
+                    else:
                         rmdirRecursive(clobber_path)
     except:
         print "Couldn't clobber properly, bailing out."
         sys.exit(1)
+    rmdirRecursiveInBackground(deferred)
 
 
 def getClobberDates(clobberURL, branch, buildername, builddir, slave, master):
@@ -177,6 +211,9 @@ if __name__ == "__main__":
                       action='append', dest='skip', default=['last-clobber'])
     parser.add_option('-d', '--dir', help='clobber this directory',
                       dest='dir', default='.', type='string')
+    parser.add_option('-b', '--background', dest='background',
+                      action='store_true', default=False,
+                      help='delete directories in a background process')
     parser.add_option('-v', '--verbose', help='be more verbose',
                       dest='verbose', action='store_true', default=False)
 
@@ -270,7 +307,8 @@ if __name__ == "__main__":
         if clobber:
             # Finally, perform a clobber if we're supposed to
             print "%s:Clobbering..." % builddir
-            do_clobber(builder_dir, options.dryrun, options.skip)
+            do_clobber(builder_dir, options.dryrun, options.skip,
+                       options.background)
             write_file(our_clobber_date, "last-clobber")
 
         # If this is the build dir for the current job, display the clobber type in TBPL.
@@ -22,13 +22,23 @@ example:
 import os
 import shutil
 import sys
+import time
 from fnmatch import fnmatch
 import re
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
 
 DEFAULT_BASE_DIRS = [".."]
 
 clobber_suffix = '.deleteme'
 
+INDEX_VERSION = 1
+# How often to walk a share dir for repos nobody stamped
+SHARE_RESCAN_INTERVAL = 7 * 24 * 3600
+
 if sys.platform == 'win32':
     # os.statvfs doesn't work on Windows
     from win32file import RemoveDirectory, DeleteFile, \
@@ -117,6 +127,147 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
+def rmdirRecursiveInBackground(dirs):
+    """Delete `dirs` from a detached child process, so we don't have to wait
+    for them. Deletes them right away where there's no fork()."""
+    if not dirs:
+        return
+    if not hasattr(os, 'fork'):
+        for d in dirs:
+            rmdirRecursive(d)
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork():
+        return
+    try:
+        # Detach, and let go of our parent's output so nothing reading it
+        # waits for us.
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        for d in dirs:
+            try:
+                rmdirRecursive(d)
+            except:
+                pass
+    finally:
+        os._exit(0)
+
+
+def disk_usage(p):
+    "Returns the number of bytes used by the tree under `p`"
+    total = 0
+    for root, dirs, files in os.walk(p):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+    return total
+
+
+class UsageIndex(object):
+    """Persistent record of the directories purge may delete: when each was
+    last used, how big it was, and whether it's an hg share.
+
+    Jobs record use by appending a line of JSON to <index>.journal, e.g.
+    {"path": "/builds/hg-shared/m-c", "last_used": 1400000000, "share": true}
+    (see ScriptMixin.stamp_dir_used in mozharness).  The journal is folded
+    into the index the next time purge runs, so nothing ever has to walk the
+    disk to find out what was used.  Sizes are measured the first time
+    they're needed and kept until the directory is used again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.journal = path + '.journal'
+        self.dirs = {}
+        self.scans = {}
+        self.claimed_journals = []
+        try:
+            data = json.load(open(path))
+        except (IOError, ValueError):
+            data = {}
+        if data.get('version') == INDEX_VERSION:
+            self.dirs = data['dirs']
+            self.scans = data['scans']
+        self.read_journal()
+
+    def read_journal(self):
+        # Move the journal aside first, so stamps written while we're
+        # reading go to a fresh one instead of being lost.
+        claimed = '%s.%d' % (self.journal, os.getpid())
+        try:
+            os.rename(self.journal, claimed)
+        except OSError:
+            return
+        self.claimed_journals.append(claimed)
+        for line in open(claimed):
+            try:
+                stamp = json.loads(line)
+                entry = self.dirs.setdefault(stamp['path'], {})
+                entry['last_used'] = max(entry.get('last_used', 0),
+                                         stamp['last_used'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if stamp.get('share'):
+                entry['share'] = True
+
+    def save(self):
+        tmp = '%s.tmp.%d' % (self.path, os.getpid())
+        f = open(tmp, 'w')
+        json.dump({'version': INDEX_VERSION, 'dirs': self.dirs,
+                   'scans': self.scans}, f)
+        f.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        for claimed in self.claimed_journals:
+            os.remove(claimed)
+        self.claimed_journals = []
+
+    def last_used(self, p):
+        """Returns when `p` was last used, or 0 if we don't know.  Anything
+        directly inside a share counts as used along with the share."""
+        p = os.path.realpath(p)
+        used = self.dirs.get(p, {}).get('last_used', 0)
+        parent = self.dirs.get(os.path.dirname(p), {})
+        if parent.get('share'):
+            used = max(used, parent.get('last_used', 0))
+        return used
+
+    def size(self, p):
+        "Returns the size of `p` in bytes, measuring it if we need to"
+        entry = self.dirs.setdefault(os.path.realpath(p), {})
+        measured = entry.get('measured')
+        if measured is None or measured < self.last_used(p) or \
+                measured < os.path.getmtime(p):
+            entry['size'] = disk_usage(p)
+            entry['measured'] = time.time()
+        return entry['size']
+
+    def forget(self, p):
+        self.dirs.pop(os.path.realpath(p), None)
+
+    def shares(self, share_dir):
+        """Returns the hg repos under `share_dir`, or None if we haven't
+        walked it recently enough to be sure we know them all."""
+        share_dir = os.path.realpath(share_dir)
+        if self.scans.get(share_dir, 0) < time.time() - SHARE_RESCAN_INTERVAL:
+            return None
+        prefix = share_dir.rstrip(os.sep) + os.sep
+        return sorted(p for p, entry in self.dirs.iteritems()
+                      if entry.get('share') and p.startswith(prefix) and
+                      os.path.isdir(p))
+
+    def set_shares(self, share_dir, hg_dirs):
+        for d in hg_dirs:
+            self.dirs.setdefault(os.path.realpath(d), {})['share'] = True
+        self.scans[os.path.realpath(share_dir)] = time.time()
+
+
 def str2seconds(s):
     """ Accepts time intervals resembling:
          30d  (30 days)
@@ -133,7 +284,8 @@ def str2seconds(s):
         raise ValueError("Unhandled time format '%s'" % s)
 
 
-def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
+def purge(base_dirs, gigs, ignore, max_age, dry_run=False, trash_dirs=(),
+          background=False, index=None):
     """Delete directories under `base_dirs` until `gigs` GB are free.
 
     Delete any directories older than max_age.
@@ -144,6 +296,18 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
       rel-*:40d
 
     Will not delete rel-* directories until they are over 40 days old.
+
+    Anything under `trash_dirs` is deleted before any of the directories
+    under `base_dirs`.
+
+    If `background` is set, directories deleted only for being older than
+    max_age, once enough space is free, are renamed and left to a child
+    process to delete.
+
+    Given a UsageIndex, directories are ordered by when they were last used
+    rather than by mtime.  With `background` as well, the sizes in the index
+    are used to pick the directories needed to reach `gigs` up front; those
+    are still deleted before we return.
     """
     gigs *= 1024 * 1024 * 1024
 
@@ -160,6 +324,8 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
                 if not os.path.isdir(p):
                     continue
                 mtime = os.path.getmtime(p)
+                if index:
+                    mtime = max(mtime, index.last_used(p))
                 skip = False
                 for pattern, cutoff_time in ignore.iteritems():
                     if (fnmatch(d, pattern)):
@@ -174,45 +340,96 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
 
     dirs.sort()
 
+    trash = []
+    for trash_dir in trash_dirs:
+        if os.path.isdir(trash_dir):
+            for d in os.listdir(trash_dir):
+                p = os.path.join(trash_dir, d)
+                trash.append((os.path.getmtime(p), p))
+    dirs = sorted(trash) + dirs
+    trash = set(p for mtime, p in trash)
+
+    # With sizes from the index, pick the directories that have to go to
+    # make the space before deleting anything.  The build needs that space
+    # as soon as we return, so only the rest can go to the background.
+    needed = set()
+    if index and background:
+        free = planned_free = freespace(base_dirs[0])
+        for mtime, d in dirs:
+            if planned_free >= gigs:
+                break
+            needed.add(d)
+            planned_free += index.size(d)
+        if needed:
+            print "Deleting %d directories to free %1.2f GB" % \
+                (len(needed), (gigs - free) / (1024 * 1024 * 1024.0))
+
+    deferred = []
     while dirs:
         mtime, d = dirs.pop(0)
 
+        # Check the disk after the planned deletions, in case the index
+        # sizes were off.
+        enough = d not in needed and freespace(base_dirs[0]) >= gigs
+
         # If we're newer than max_age, and don't need any more free space,
         # we're all done here
         if (not max_age) or (mtime > max_age):
-            if freespace(base_dirs[0]) >= gigs:
+            if enough:
+                if d in trash:
+                    # the build directories are still sorted by age
+                    continue
                 break
 
         print "Deleting", d
-        if not dry_run:
-            try:
-                clobber_path = d + clobber_suffix
-                if os.path.exists(clobber_path):
-                    rmdirRecursive(clobber_path)
+        try:
+            if not dry_run:
                 # Prevent repeated moving.
                 if d.endswith(clobber_suffix):
-                    rmdirRecursive(d)
+                    clobber_path = d
                 else:
+                    clobber_path = d + clobber_suffix
+                    if os.path.exists(clobber_path):
+                        rmdirRecursive(clobber_path)
                     shutil.move(d, clobber_path)
+                if background and enough:
+                    deferred.append(clobber_path)
+                else:
                     rmdirRecursive(clobber_path)
-            except:
-                print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+                if index:
+                    index.forget(d)
+        except:
+            print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
 
+    rmdirRecursiveInBackground(deferred)
 
-def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
-    """Deletes old hg directories under share_dir"""
-    # Find hg directories
-    hg_dirs = []
-    for root, dirs, files in os.walk(share_dir):
-        for d in dirs[:]:
-            path = os.path.join(root, d, '.hg')
-            if os.path.exists(path) or os.path.exists(path + clobber_suffix):
-                hg_dirs.append(os.path.join(root, d))
-                # Remove d from the list so we don't go traversing down into it
-                dirs.remove(d)
+
+def purge_hg_shares(share_dir, gigs, max_age, dry_run=False, index=None,
+                    background=False):
+    """Deletes old hg directories under share_dir.
+
+    Given a UsageIndex, the repos it knows about are used instead of walking
+    share_dir, which only happens every SHARE_RESCAN_INTERVAL.
+    """
+    hg_dirs = None
+    if index:
+        hg_dirs = index.shares(share_dir)
+    if hg_dirs is None:
+        # Find hg directories
+        hg_dirs = []
+        for root, dirs, files in os.walk(share_dir):
+            for d in dirs[:]:
+                path = os.path.join(root, d, '.hg')
+                if os.path.exists(path) or os.path.exists(path + clobber_suffix):
+                    hg_dirs.append(os.path.join(root, d))
+                    # Remove d from the list so we don't go traversing down into it
+                    dirs.remove(d)
+        if index:
+            index.set_shares(share_dir, hg_dirs)
 
     # Now we have a list of hg directories, call purge on them
-    purge(hg_dirs, gigs, [], max_age, dry_run)
+    purge(hg_dirs, gigs, [], max_age, dry_run, background=background,
+          index=index)
 
     # Clean up empty directories
     for d in hg_dirs:
@@ -220,9 +437,10 @@ def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
             print "Cleaning up", d
             if not dry_run:
                 rmdirRecursive(d)
+                if index:
+                    index.forget(d)
 
 if __name__ == '__main__':
-    import time
     from optparse import OptionParser
     from ConfigParser import ConfigParser, NoOptionError
 
@@ -261,6 +479,20 @@ will be listed in the order in which they would be deleted.''')
             has an mtime older than this, it will be deleted, regardless of how
             much free space is required.  Set to 0 to disable.''')
 
+    parser.add_option('', '--trash-dir', action='append', dest='trash_dirs',
+                      default=[],
+                      help='''directory of trees already moved out of the way to be
+deleted; its contents are deleted before anything else.''')
+
+    parser.add_option('', '--background', action='store_true',
+                      dest='background', default=False,
+                      help='''delete directories that are only being deleted for
+being older than max-age in a background process.''')
+
+    parser.add_option('', '--index', dest='index',
+                      help='''file to keep a record of directory use and sizes in.
+Jobs append to INDEX.journal when they use a directory.''')
+
     options, base_dirs = parser.parse_args()
 
     if len(base_dirs) < 1:
@@ -277,13 +509,19 @@ will be listed in the order in which they would be deleted.''')
     else:
         cutoff_time = None
 
-    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run)
+    index = None
+    if options.index:
+        index = UsageIndex(options.index)
+
+    purge(base_dirs, options.size, options.skip, cutoff_time,
+          options.dry_run, options.trash_dirs, options.background, index)
 
     # Try to cleanup shared hg repos. We run here even if we've freed enough
     # space so we can be sure and delete repositories older than max_age
     if 'HG_SHARE_BASE_DIR' in os.environ:
-        purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
-                        options.share_size, cutoff_time, options.dry_run)
+        purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'], options.share_size,
+                        cutoff_time, options.dry_run, index,
+                        options.background)
 
     after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
 
@@ -291,9 +529,13 @@ will be listed in the order in which they would be deleted.''')
     # actually help.
     if after < options.size:
         # We skip the tools dir here because we've usually just cloned it.
-        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run)
+        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run,
+              index=index)
         after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
 
+    if index and not options.dry_run:
+        index.save()
+
     if after < options.size:
         print "Error: unable to free %1.2f GB of space. " % options.size + \
               "Free space only %1.2f GB" % after
@@ -8,15 +8,18 @@ from contextlib import contextmanager
 import os
 import shutil
 import stat
+import struct
 import tarfile
 import tempfile
 import urlparse
 import urllib2
 import zipfile
+import zlib
 import time
 
 __all__ = ['extract_tarball',
            'extract_zip',
+           'extract_zip_stream',
            'extract',
            'is_url',
            'load',
@@ -47,7 +50,14 @@ def extract_tarball(src, dest):
 
 
 def extract_zip(src, dest):
-    """extract a zip file"""
+    """extract a zip file
+
+    src may also be a file-like object that can only be read forwards, such
+    as an HTTP response; see extract_zip_stream().
+    """
+
+    if hasattr(src, 'read') and not isinstance(src, zipfile.ZipFile):
+        return extract_zip_stream(src, dest)
 
     if isinstance(src, zipfile.ZipFile):
         bundle = src
@@ -78,6 +88,266 @@ def extract_zip(src, dest):
     return namelist
 
 
+### streaming zip extraction
+
+_ZIP_LOCAL_HEADER = 'PK\x03\x04'
+_ZIP_CENTRAL_HEADER = 'PK\x01\x02'
+_ZIP_END_RECORD = 'PK\x05\x06'
+_ZIP64_END_RECORD = 'PK\x06\x06'
+_ZIP_DATA_DESCRIPTOR = 'PK\x07\x08'
+_ZIP_STREAM_BLOCK_SIZE = 1024 ** 2
+# spool up to this much of an archive in memory before going to disk
+_ZIP_SPOOL_SIZE = 64 * 1024 ** 2
+
+
+class _NeedsSeek(Exception):
+    """The current entry can't be read without the central directory."""
+
+
+class _ForwardReader(object):
+    """read() exactly n bytes from a forward-only stream, with push back"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = ''
+
+    def read(self, n):
+        data = self.pending[:n]
+        self.pending = self.pending[n:]
+        while len(data) < n:
+            block = self.fileobj.read(n - len(data))
+            if not block:
+                break
+            data += block
+        return data
+
+    def read_exact(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise zipfile.BadZipfile("Truncated zip stream")
+        return data
+
+    def read_block(self):
+        if self.pending:
+            data, self.pending = self.pending, ''
+            return data
+        return self.fileobj.read(_ZIP_STREAM_BLOCK_SIZE)
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+def _zip64_sizes(extra, csize, usize):
+    """pick the real sizes out of a zip64 extra field, if there is one"""
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == 1:
+            values = extra[4:4 + length]
+            if usize == 0xFFFFFFFF:
+                usize = struct.unpack('<Q', values[:8])[0]
+                values = values[8:]
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack('<Q', values[:8])[0]
+            return csize, usize, True
+        extra = extra[4 + length:]
+    return csize, usize, False
+
+
+def _makedirs(path):
+    # several archives may be extracted into the same tree at once
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _open_member(dest, name):
+    filename = os.path.realpath(os.path.join(dest, name))
+    if name.endswith('/'):
+        if not os.path.isdir(filename):
+            _makedirs(filename)
+        return filename, None
+    path = os.path.dirname(filename)
+    if not os.path.isdir(path):
+        _makedirs(path)
+    return filename, open(filename, 'wb')
+
+
+def _stream_member(reader, header, name, extra, out):
+    """copy one member's data from reader to out (which may be None to
+    skip it), leaving reader positioned after the member."""
+    flags = header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+    method = header[zipfile._FH_COMPRESSION_METHOD]
+    crc = header[zipfile._FH_CRC]
+    csize, usize, is_zip64 = _zip64_sizes(extra,
+                                          header[zipfile._FH_COMPRESSED_SIZE],
+                                          header[zipfile._FH_UNCOMPRESSED_SIZE])
+    has_descriptor = flags & 0x08
+    if flags & 0x01 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        # encrypted, or a compression we can't stream
+        raise _NeedsSeek()
+    if has_descriptor and method == zipfile.ZIP_STORED:
+        # nothing marks the end of the data but the central directory
+        raise _NeedsSeek()
+
+    decompressor = None
+    if method == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    got_crc = 0
+    if has_descriptor:
+        # read until the deflate stream says it's done
+        while not decompressor.unused_data:
+            block = reader.read_block()
+            if not block:
+                raise zipfile.BadZipfile("Truncated zip stream in %s" % name)
+            data = decompressor.decompress(block)
+            if out is not None:
+                out.write(data)
+                got_crc = zlib.crc32(data, got_crc)
+        reader.unread(decompressor.unused_data)
+        if decompressor.unconsumed_tail:
+            raise zipfile.BadZipfile("Bad deflate stream in %s" % name)
+        descriptor = reader.read_exact(4)
+        if descriptor == _ZIP_DATA_DESCRIPTOR:
+            descriptor = reader.read_exact(4)
+        crc = struct.unpack('<L', descriptor)[0]
+        reader.read_exact(16 if is_zip64 else 8)
+    else:
+        remaining = csize
+        while remaining:
+            block = reader.read(min(remaining, _ZIP_STREAM_BLOCK_SIZE))
+            if not block:
+                raise zipfile.BadZipfile("Truncated zip stream in %s" % name)
+            remaining -= len(block)
+            if out is None:
+                continue
+            if decompressor:
+                block = decompressor.decompress(block)
+            out.write(block)
+            got_crc = zlib.crc32(block, got_crc)
+        if out is not None and decompressor:
+            block = decompressor.flush()
+            out.write(block)
+            got_crc = zlib.crc32(block, got_crc)
+    if out is not None and (got_crc & 0xFFFFFFFF) != crc:
+        raise zipfile.BadZipfile("Bad CRC-32 for file %s" % name)
+
+
+def _extract_spooled_zip(raw_header, reader, dest, members, namelist):
+    """spool the rest of a stream to a temporary file and extract the
+    members not already in namelist from it.
+
+    raw_header is the local header of the first entry we couldn't stream;
+    zipfile copes with the missing leading bytes the same way it copes
+    with an archive that has data prepended to it.
+    Returns a dict of name -> unix mode for all selected members.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=_ZIP_SPOOL_SIZE)
+    try:
+        spool.write(raw_header)
+        block = reader.read_block()
+        while block:
+            spool.write(block)
+            block = reader.read_block()
+        spool.seek(0)
+        bundle = zipfile.ZipFile(spool)
+        modes = {}
+        done = set(namelist)
+        for info in bundle.infolist():
+            name = info.filename
+            if members is not None and not members(name):
+                continue
+            modes[name] = info.external_attr >> 16 & 0x1FF
+            if name in done:
+                continue
+            filename, out = _open_member(dest, name)
+            if out is not None:
+                source = bundle.open(info)
+                try:
+                    shutil.copyfileobj(source, out, _ZIP_STREAM_BLOCK_SIZE)
+                finally:
+                    source.close()
+                    out.close()
+            namelist.append(name)
+        bundle.close()
+        return modes
+    finally:
+        spool.close()
+
+
+def extract_zip_stream(fileobj, dest, members=None):
+    """extract a zip archive while reading it forwards from fileobj
+
+    This lets an archive be extracted straight from an HTTP response
+    without writing the archive itself to disk.  Members are read from
+    their local headers as they arrive; permissions are applied once the
+    central directory at the end of the stream has been read.
+
+    If an entry can't be located without the central directory (stored
+    entries with data descriptors, encryption, unusual compression), the
+    rest of the stream is spooled to a temporary file and extracted with
+    zipfile instead.
+
+    :param fileobj: file-like object with a read() method
+    :param dest: directory to extract into
+    :param members: optional callable; only names for which it returns
+                    True are extracted
+    :returns: the list of extracted names
+    """
+    reader = _ForwardReader(fileobj)
+    namelist = []
+    modes = {}
+    while True:
+        signature = reader.read(4)
+        if signature == _ZIP_LOCAL_HEADER:
+            raw_header = signature + reader.read_exact(zipfile.sizeFileHeader - 4)
+            header = struct.unpack(zipfile.structFileHeader, raw_header)
+            raw_name = reader.read_exact(header[zipfile._FH_FILENAME_LENGTH])
+            extra = reader.read_exact(header[zipfile._FH_EXTRA_FIELD_LENGTH])
+            name = raw_name
+            if header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] & 0x800:
+                name = raw_name.decode('utf-8')
+            wanted = members is None or members(name)
+            out = None
+            if wanted:
+                filename, out = _open_member(dest, name)
+            try:
+                _stream_member(reader, header, name, extra, out)
+            except _NeedsSeek:
+                modes.update(_extract_spooled_zip(raw_header + raw_name + extra,
+                                                  reader, dest, members, namelist))
+                break
+            finally:
+                if out is not None:
+                    out.close()
+            if wanted:
+                namelist.append(name)
+        elif signature == _ZIP_CENTRAL_HEADER:
+            raw = signature + reader.read_exact(zipfile.sizeCentralDir - 4)
+            record = struct.unpack(zipfile.structCentralDir, raw)
+            name = reader.read_exact(record[zipfile._CD_FILENAME_LENGTH])
+            reader.read_exact(record[zipfile._CD_EXTRA_FIELD_LENGTH] +
+                              record[zipfile._CD_COMMENT_LENGTH])
+            if record[zipfile._CD_FLAG_BITS] & 0x800:
+                name = name.decode('utf-8')
+            modes[name] = record[zipfile._CD_EXTERNAL_FILE_ATTRIBUTES] >> 16 & 0x1FF
+        elif signature in (_ZIP_END_RECORD, _ZIP64_END_RECORD, ''):
+            break
+        else:
+            raise zipfile.BadZipfile("Unexpected signature %r in zip stream" %
+                                     signature)
+    # drain the rest so the connection can be reused
+    while reader.read_block():
+        pass
+
+    for name in namelist:
+        mode = modes.get(name)
+        if mode:
+            os.chmod(os.path.realpath(os.path.join(dest, name)), mode)
+    return namelist
+
+
 def extract(src, dest=None):
     """
     Takes in a tar or zip file and extracts it to dest
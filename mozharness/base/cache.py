@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Content-addressed local cache for downloaded artifacts.
+
+Blobs are stored by the sha512 of their contents under
+<cache_dir>/blobs/. For every URL we keep a small JSON record under
+<cache_dir>/urls/ with the validators (ETag, Last-Modified) the server sent
+and the digest of the blob it resolved to, so later downloads can be
+revalidated with a conditional GET instead of transferring the file again.
+
+Hits are hardlinked into place (or copied if linking isn't possible).
+Blobs are evicted least-recently-used first once the cache grows past its
+size limit.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.log import LogMixin
+
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+
+# DownloadCache {{{1
+class DownloadCache(LogMixin, object):
+    """On-disk download cache shared by every script object in this process
+    that points at the same cache directory; use DownloadCache.get().
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, cache_dir, max_size=None, log_obj=None):
+        """Return the DownloadCache for `cache_dir`, creating it if needed."""
+        cache_dir = os.path.abspath(cache_dir)
+        with cls._instances_lock:
+            if cache_dir not in cls._instances:
+                cls._instances[cache_dir] = cls(cache_dir, max_size=max_size,
+                                                log_obj=log_obj)
+            return cls._instances[cache_dir]
+
+    def __init__(self, cache_dir, max_size=None, log_obj=None):
+        self.config = {}
+        self.log_obj = log_obj
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.url_dir = os.path.join(cache_dir, 'urls')
+        self.max_size = max_size or DEFAULT_MAX_SIZE
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        for d in (self.blob_dir, self.url_dir):
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    if not os.path.isdir(d):
+                        raise
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def _url_record_path(self, url):
+        return os.path.join(self.url_dir, '%s.json' % hashlib.sha1(url).hexdigest())
+
+    def _read_url_record(self, url):
+        try:
+            with open(self._url_record_path(url)) as fh:
+                record = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if record.get('url') != url or not os.path.exists(self._blob_path(record['digest'])):
+            return None
+        return record
+
+    def _write_url_record(self, url, record):
+        record['url'] = url
+        fd, tmp_path = tempfile.mkstemp(dir=self.url_dir)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(record, fh)
+        os.rename(tmp_path, self._url_record_path(url))
+
+    def _link_blob(self, digest, file_name):
+        """Put the blob for `digest` at `file_name`; return its size."""
+        blob = self._blob_path(digest)
+        if os.path.lexists(file_name):
+            os.remove(file_name)
+        try:
+            os.link(blob, file_name)
+        except (AttributeError, OSError):
+            # no os.link on this platform, or a different filesystem
+            shutil.copyfile(blob, file_name)
+        # Touch the blob so eviction treats it as recently used.
+        try:
+            os.utime(blob, None)
+        except OSError, e:
+            # evicted by another job since; we have our copy
+            if e.errno != errno.ENOENT:
+                raise
+        return os.path.getsize(file_name)
+
+    def _record_hit(self, url, digest, file_name):
+        """Put the cached blob for `digest` at `file_name` and count the hit.
+        Returns None if the blob isn't there: the cache is shared between
+        jobs, and another one may have evicted it.
+        """
+        try:
+            size = self._link_blob(digest, file_name)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT or os.path.exists(self._blob_path(digest)):
+                raise
+            self.info("%s was evicted from the download cache." % url)
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+        self.info("Download cache hit for %s (%d bytes)." % (url, size))
+        return file_name
+
+    def download(self, url, file_name, urlopen, digest=None, timeout=30):
+        """Download `url` to `file_name` through the cache.
+
+        Args:
+            url (str): http(s) URL to download.
+            file_name (str): where to put the file.
+            urlopen (callable): used to open a urllib2.Request, e.g.
+              ScriptMixin._urlopen.
+            digest (str, optional): known sha512 hex digest of the file. If
+              the blob is already cached no request is made at all.
+            timeout (int, optional): socket timeout. Defaults to 30.
+
+        Returns:
+            str: `file_name`
+
+        Raises:
+            urllib2.URLError: on incomplete downloads or digest mismatch,
+              as well as anything `urlopen` raises.
+        """
+        if digest and os.path.exists(self._blob_path(digest)):
+            if self._record_hit(url, digest, file_name):
+                return file_name
+
+        record = self._read_url_record(url)
+        request = urllib2.Request(url)
+        if record:
+            if record.get('etag'):
+                request.add_header('If-None-Match', record['etag'])
+            if record.get('last_modified'):
+                request.add_header('If-Modified-Since', record['last_modified'])
+        try:
+            f = urlopen(request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not record:
+                raise
+            if self._record_hit(url, record['digest'], file_name):
+                return file_name
+            # gone since we read the record; a miss after all
+            f = urlopen(urllib2.Request(url), timeout=timeout)
+
+        info = f.info()
+        f_length = info.get('content-length')
+        hasher = hashlib.sha512()
+        got_length = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as local_file:
+                while True:
+                    block = f.read(1024 ** 2)
+                    if not block:
+                        break
+                    local_file.write(block)
+                    hasher.update(block)
+                    got_length += len(block)
+            if f_length is not None and got_length != int(f_length):
+                raise urllib2.URLError("Download incomplete; content-length was %s, but only received %d" % (f_length, got_length))
+            got_digest = hasher.hexdigest()
+            if digest and got_digest != digest:
+                raise urllib2.URLError("Digest mismatch for %s; expected %s, got %s" % (url, digest, got_digest))
+            os.rename(tmp_path, self._blob_path(got_digest))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._write_url_record(url, {
+            'digest': got_digest,
+            'etag': info.get('etag'),
+            'last_modified': info.get('last-modified'),
+        })
+        self._link_blob(got_digest, file_name)
+        with self._lock:
+            self.misses += 1
+        self.info("Download cache miss for %s; cached %d bytes." % (url, got_length))
+        self.evict()
+        return file_name
+
+    def evict(self):
+        """Delete least recently used blobs until the cache is under its
+        size limit."""
+        with self._lock:
+            blobs = []
+            total = 0
+            for name in os.listdir(self.blob_dir):
+                path = os.path.join(self.blob_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp'):
+                    # stale partial download from a killed job
+                    if st.st_mtime < time.time() - 24 * 60 * 60:
+                        os.remove(path)
+                    continue
+                blobs.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            if total <= self.max_size:
+                return
+            for mtime, size, path in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                self.info("Evicting %s (%d bytes) from download cache." % (path, size))
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                total -= size
+
+    def query_summary(self):
+        """Return a one-line summary of cache activity."""
+        return "Download cache: %d hits, %d misses, %d bytes saved." % (
+            self.hits, self.misses, self.bytes_saved)
@@ -24,10 +24,14 @@ TODO:
   these settings are set.
 """
 
+import cPickle
 from copy import deepcopy
+import hashlib
 from optparse import OptionParser, Option, OptionGroup
 import os
 import sys
+import tempfile
+import types
 import urllib2
 import socket
 import time
@@ -64,26 +68,56 @@ class ExtendOption(Option):
                 self, action, dest, opt, value, values, parser)
 
 
+# Directory to cache parsed python configs in; see parse_config_file().
+CONFIG_CACHE_ENV = 'MOZHARNESS_CONFIG_CACHE'
+
+
+# Types make_immutable() can return as they are.
+_IMMUTABLE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
 def make_immutable(item):
-    if isinstance(item, list) or isinstance(item, tuple):
-        result = LockedTuple(item)
-    elif isinstance(item, dict):
-        result = ReadOnlyDict(item)
-        result.lock()
-    else:
-        result = item
-    return result
+    """Return an immutable copy of `item`: lists and tuples become
+    LockedTuples and dicts locked ReadOnlyDicts, all the way down.  Nothing
+    in the copy is shared with `item`, so it can't be changed through
+    whatever `item` is still reachable from.
+    """
+    item_type = type(item)
+    if item_type in _IMMUTABLE_TYPES or item_type is LockedTuple or \
+            (item_type is ReadOnlyDict and item._lock):
+        # already immutable all the way down
+        return item
+    if isinstance(item, (list, tuple)):
+        return tuple.__new__(LockedTuple, [make_immutable(x) for x in item])
+    if isinstance(item, dict):
+        result = dict.__new__(ReadOnlyDict)
+        dict.update(result, [(k, make_immutable(v)) for (k, v) in dict.iteritems(item)])
+        result._lock = True
+        return result
+    return item
 
 
 class LockedTuple(tuple):
     def __new__(cls, items):
         return tuple.__new__(cls, (make_immutable(x) for x in items))
+
     def __deepcopy__(self, memo):
         return [deepcopy(elem, memo) for elem in self]
 
 
 # ReadOnlyDict {{{1
 class ReadOnlyDict(dict):
+    """Dictionary that can be locked against changes.
+
+    lock() replaces every nested list and dictionary with an immutable copy
+    (a LockedTuple or a locked ReadOnlyDict), in a single pass.  Copies,
+    rather than the originals, as dict(), update() and ** read the stored
+    values directly: anything they hand out has to be immutable already,
+    and mustn't be shared with the dictionary the ReadOnlyDict was created
+    from.
+    """
+    _lock = False
+
     def __init__(self, dictionary):
         self._lock = False
         self.update(dictionary.copy())
@@ -92,8 +126,8 @@ class ReadOnlyDict(dict):
         assert not self._lock, "ReadOnlyDict is locked!"
 
     def lock(self):
-        for (k, v) in self.items():
-            self[k] = make_immutable(v)
+        for (k, v) in dict.items(self):
+            dict.__setitem__(self, k, make_immutable(v))
         self._lock = True
 
     def __setitem__(self, *args):
@@ -131,14 +165,50 @@ class ReadOnlyDict(dict):
         for k, v in self.__dict__.items():
             setattr(result, k, deepcopy(v, memo))
         result._lock = False
-        for k, v in self.items():
-            result[k] = deepcopy(v, memo)
+        # Copy the values as stored: there's no point in freezing values
+        # only to copy them back into mutable ones.
+        for k, v in dict.iteritems(self):
+            dict.__setitem__(result, k, deepcopy(v, memo))
         return result
 
+
+# config cache {{{1
+def _read_config_cache(cache_dir, key):
+    """Return the object cached under `key`, or None."""
+    try:
+        with open(os.path.join(cache_dir, key), 'rb') as fh:
+            # loads() of the whole string beats load() from the file object
+            return cPickle.loads(fh.read())
+    except Exception:
+        # missing, or written by an incompatible version; it's only a cache
+        return None
+
+
+def _write_config_cache(cache_dir, key, obj):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            cPickle.dump(obj, fh, 2)
+        if os.name == 'nt' and os.path.exists(os.path.join(cache_dir, key)):
+            os.remove(os.path.join(cache_dir, key))
+        os.rename(tmp_path, os.path.join(cache_dir, key))
+    except Exception:
+        pass
+
+
 # parse_config_file {{{1
 def parse_config_file(file_name, quiet=False, search_path=None,
                       config_dict_name="config"):
     """Read a config file and return a dictionary.
+
+    If the MOZHARNESS_CONFIG_CACHE environment variable names a directory,
+    python config files are only executed the first time they're seen; the
+    resulting dictionary is cached there, keyed by the file's path and a hash
+    of its contents, so editing the file invalidates it.  Files that import
+    anything aren't cached, as they may compute their config from the
+    environment.
     """
     file_path = None
     if os.path.exists(file_name):
@@ -154,10 +224,22 @@ def parse_config_file(file_name, quiet=False, search_path=None,
         else:
             raise IOError("Can't find %s in %s!" % (file_name, search_path))
     if file_name.endswith('.py'):
+        cache_dir = os.environ.get(CONFIG_CACHE_ENV)
+        if cache_dir:
+            with open(file_path, 'rb') as fh:
+                key = 'parsed-%s' % hashlib.sha1('\0'.join([
+                    os.path.realpath(file_path), config_dict_name, fh.read()
+                ])).hexdigest()
+            config = _read_config_cache(cache_dir, key)
+            if config is not None:
+                return config
         global_dict = {}
         local_dict = {}
         execfile(file_path, global_dict, local_dict)
         config = local_dict[config_dict_name]
+        if cache_dir and not [v for v in global_dict.values() + local_dict.values()
+                              if isinstance(v, types.ModuleType)]:
+            _write_config_cache(cache_dir, key, config)
     elif file_name.endswith('.json'):
         fh = open(file_path)
         config = {}
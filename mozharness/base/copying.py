@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Fast file copies for ScriptMixin.copyfile() and copytree().
+
+Depending on `link_mode`, a copy is made by the cheapest means the
+filesystem allows:
+
+- 'copy' (the default) always copies the data.
+- 'reflink' asks the filesystem for a copy-on-write clone (FICLONE, on
+  btrfs, xfs and friends), which shares the data blocks until either side
+  is modified and takes no time regardless of size, and falls back to
+  copying.
+- 'hardlink' tries a reflink, then a hard link, then copying. Hard links
+  share the file itself, so only use this when neither side is going to be
+  modified in place.
+
+Copies are made in large blocks, several files at a time on worker
+threads, since file I/O releases the GIL.
+"""
+
+import errno
+import os
+import shutil
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mozharness.base.parallel import run_in_parallel
+
+LINK_MODES = ('copy', 'reflink', 'hardlink')
+BLOCK_SIZE = 1024 ** 2
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# (src device, dest device) pairs we know can't reflink or hardlink, so we
+# don't keep asking for every file.
+_cant_reflink = set()
+_cant_hardlink = set()
+
+
+# CopyStats {{{1
+class CopyStats(object):
+    """Thread safe tally of what a copy did and how fast."""
+    def __init__(self):
+        self.start = time.time()
+        self.num_files = 0
+        self.num_bytes = 0
+        self.methods = {}
+        self._lock = threading.Lock()
+
+    def add(self, method, num_bytes):
+        with self._lock:
+            self.num_files += 1
+            self.num_bytes += num_bytes
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        methods = ', '.join('%d %s' % (n, m)
+                            for m, n in sorted(self.methods.items()))
+        return ("Copied %d files (%d bytes) in %.2fs: %.1f files/s, %.2f MB/s"
+                " (%s)." % (self.num_files, self.num_bytes, elapsed,
+                            self.num_files / elapsed,
+                            self.num_bytes / elapsed / 1024 ** 2,
+                            methods or 'nothing to do'))
+
+
+def _devices(src, dest):
+    return (os.stat(src).st_dev,
+            os.stat(os.path.dirname(os.path.abspath(dest))).st_dev)
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        return False
+    devices = _devices(src, dest)
+    if devices in _cant_reflink:
+        return False
+    with open(src, 'rb') as s:
+        with open(dest, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    raise
+    _cant_reflink.add(devices)
+    return False
+
+
+def _hardlink(src, dest):
+    if not hasattr(os, 'link') or os.path.islink(src):
+        # os.link() would link to the symlink rather than its target
+        return False
+    devices = _devices(src, dest)
+    if devices in _cant_hardlink:
+        return False
+    if os.path.lexists(dest):
+        # left behind by _reflink()
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return True
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                           errno.EOPNOTSUPP):
+            raise
+    if e.errno != errno.EMLINK:
+        _cant_hardlink.add(devices)
+    return False
+
+
+def _copy_data(src, dest):
+    with open(src, 'rb') as s:
+        with open(dest, 'wb') as d:
+            while True:
+                block = s.read(BLOCK_SIZE)
+                if not block:
+                    break
+                d.write(block)
+
+
+def copy_file(src, dest, link_mode='copy', copystat=True, stats=None):
+    """Copy the file `src` to `dest`, replacing `dest` if it exists.
+
+    Args:
+        src (str): file to copy.
+        dest (str): where to copy it to.
+        link_mode (str, optional): one of LINK_MODES. Defaults to 'copy'.
+        copystat (bool, optional): copy permissions and times too, like
+          shutil.copy2. Defaults to True.
+        stats (CopyStats, optional): tally to add this copy to.
+
+    Returns:
+        str: how the copy was made: 'reflinked', 'hardlinked' or 'copied'.
+
+    Raises:
+        IOError, OSError: if the copy fails.
+        ValueError: for an unknown link_mode.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError("Unknown link_mode %s; expected one of %s" %
+                         (link_mode, ', '.join(LINK_MODES)))
+    if os.path.lexists(dest):
+        # Replace it rather than writing into it: it may be a hard link to
+        # `src`.
+        os.remove(dest)
+    method = 'copied'
+    if link_mode != 'copy' and _reflink(src, dest):
+        method = 'reflinked'
+    elif link_mode == 'hardlink' and _hardlink(src, dest):
+        # same inode, nothing else to copy
+        copystat = False
+        method = 'hardlinked'
+    else:
+        _copy_data(src, dest)
+    if copystat:
+        shutil.copystat(src, dest)
+    if stats is not None:
+        stats.add(method, os.path.getsize(dest))
+    return method
+
+
+def copy_files(pairs, link_mode='copy', max_workers=4, stats=None):
+    """copy_file() each (src, dest) in `pairs`, `max_workers` at a time."""
+    run_in_parallel(lambda pair: copy_file(pair[0], pair[1],
+                                           link_mode=link_mode, stats=stats),
+                    pairs, max_workers=max_workers)
+
+
+def copy_tree(src, dest, link_mode='copy', max_workers=4, stats=None,
+              exclude=()):
+    """Copy the tree at `src` to `dest`, which mustn't exist yet.
+
+    Unlike ScriptMixin.copytree(), symlinks are copied as symlinks, so
+    trees that point outside themselves, like virtualenvs, stay intact.
+
+    Args:
+        src (str): directory to copy.
+        dest (str): where to copy it to.
+        link_mode (str, optional): one of LINK_MODES. Defaults to 'copy'.
+        max_workers (int, optional): number of files to copy at once.
+        stats (CopyStats, optional): tally to add the copies to.
+        exclude (iterable, optional): paths under `src` not to copy.
+
+    Raises:
+        IOError, OSError: if the copy fails.
+    """
+    exclude = set(os.path.normpath(p) for p in exclude)
+    files, dirs = [], []
+    for root, dir_names, file_names in os.walk(src):
+        dest_root = dest
+        if root != src:
+            dest_root = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(dest_root)
+        dirs.append((root, dest_root))
+        for name in list(dir_names):
+            path = os.path.join(root, name)
+            if os.path.normpath(path) in exclude:
+                dir_names.remove(name)
+            elif os.path.islink(path):
+                # os.walk() doesn't descend into these
+                os.symlink(os.readlink(path), os.path.join(dest_root, name))
+        for name in file_names:
+            path = os.path.join(root, name)
+            if os.path.normpath(path) in exclude:
+                continue
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(dest_root, name))
+            else:
+                files.append((path, os.path.join(dest_root, name)))
+    copy_files(files, link_mode=link_mode, max_workers=max_workers,
+               stats=stats)
+    # after the files, as adding them changes the directory times
+    for src_dir, dest_dir in reversed(dirs):
+        shutil.copystat(src_dir, dest_dir)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""File hashing shared by everything in the process.
+
+Files are read once, in large blocks, feeding every requested digest in the
+same pass, so hashing a package never needs it all in memory. Results are
+remembered for the rest of the run by (path, size, mtime, inode), so asking
+again for the same unchanged file doesn't read it again. hashlib releases
+the GIL while hashing large blocks, so files_digests() hashes several files
+on threads in parallel.
+"""
+
+import hashlib
+import os
+import threading
+
+from mozharness.base.parallel import run_in_parallel
+
+BLOCK_SIZE = 1024 ** 2
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime, st.st_ino)
+
+
+def file_digests(path, algorithms=('sha512', )):
+    """Return the hex digests of the file at `path`.
+
+    Args:
+        path (str): file to hash.
+        algorithms (tuple, optional): hashlib algorithm names, e.g. 'sha1',
+          'sha512', 'md5'. Defaults to ('sha512', ).
+
+    Returns:
+        dict: algorithm name to hex digest.
+
+    Raises:
+        OSError, IOError: if the file can't be read.
+        ValueError: for an unknown algorithm.
+    """
+    key = _file_key(path)
+    with _digests_lock:
+        known = dict(_digests.get(key, {}))
+    missing = [a for a in algorithms if a not in known]
+    if missing:
+        hashers = [(a, hashlib.new(a)) for a in missing]
+        with open(path, 'rb') as fh:
+            while True:
+                block = fh.read(BLOCK_SIZE)
+                if not block:
+                    break
+                for _, hasher in hashers:
+                    hasher.update(block)
+        for algorithm, hasher in hashers:
+            known[algorithm] = hasher.hexdigest()
+        with _digests_lock:
+            _digests.setdefault(key, {}).update(known)
+    return dict((a, known[a]) for a in algorithms)
+
+
+def files_digests(paths, algorithms=('sha512', ), max_workers=4):
+    """Hash several files in parallel; see file_digests().
+
+    Returns:
+        dict: path to a dict of algorithm name to hex digest.
+    """
+    digests = run_in_parallel(lambda path: file_digests(path, algorithms),
+                              paths, max_workers=max_workers)
+    return dict(zip(paths, digests))
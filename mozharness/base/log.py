@@ -24,10 +24,15 @@ TODO:
 - log rotation config
 """
 
+import collections
 from datetime import datetime
 import logging
 import os
+import re
+import sre_constants
+import sre_parse
 import sys
+import threading
 import traceback
 
 # Define our own FATAL_LEVEL
@@ -51,6 +56,20 @@ LOG_LEVELS = {
 # mozharness root logger
 ROOT_LOGGER = logging.getLogger()
 
+# Prefix for messages logged from the current thread; see log_prefix().
+_thread_context = threading.local()
+
+
+def log_prefix(prefix):
+    """ Prefix every message logged by LogMixin objects on the current thread
+    with `[prefix] `, so interleaved output from parallel workers can be
+    told apart. log_prefix(None) clears it.
+
+    Args:
+        prefix (str): prefix to use, or None.
+    """
+    _thread_context.prefix = prefix
+
 
 # LogMixin {{{1
 class LogMixin(object):
@@ -107,6 +126,10 @@ class LogMixin(object):
         Returns:
             None
         """
+        prefix = getattr(_thread_context, 'prefix', None)
+        if prefix:
+            message = ('[%s] %s' % (prefix, message)).replace(
+                '\n', '\n[%s] ' % prefix)
         if self.log_obj:
             return self.log_obj.log_message(
                 message, level=level,
@@ -242,25 +265,169 @@ class LogMixin(object):
         pass
 
 
+# ErrorListMatcher {{{1
+class ErrorListMatcher(object):
+    """ Prefilter that tells whether any entry of an error_list can match a
+    line, without walking the list.
+
+    Every `substr`, plus the longest literal that each `regex` requires, goes
+    into a trie that is compiled into a single regex, so one C-level search
+    per line screens the whole list. Regexes with no usable literal
+    (case-insensitive ones, or ones made only of classes and repeats) are
+    searched individually; joining them into one alternation defeats sre's
+    literal-prefix optimizations and ends up slower.
+
+    The matcher only answers "might match"; OutputParser still walks
+    error_list in order on a hit so first-match-wins is unchanged.
+    """
+    _cache = {}
+
+    @classmethod
+    def get(cls, error_list):
+        """ Return a matcher for `error_list`, reusing a compiled one for
+        an identical list.
+
+        Args:
+            error_list (list): list of error_list dictionaries.
+
+        Returns:
+            ErrorListMatcher: matcher for `error_list`.
+        """
+        key = []
+        for error_check in error_list:
+            if 'substr' in error_check:
+                key.append(('substr', error_check['substr']))
+            elif 'regex' in error_check:
+                regex = error_check['regex']
+                key.append(('regex', getattr(regex, 'pattern', id(regex)),
+                            getattr(regex, 'flags', None)))
+            else:
+                key.append(None)
+        key = tuple(key)
+        matcher = cls._cache.get(key)
+        if matcher is None:
+            if len(cls._cache) > 100:
+                cls._cache.clear()
+            matcher = cls._cache[key] = cls(error_list)
+        return matcher
+
+    def __init__(self, error_list):
+        self.always_match = False
+        self.regexes = []
+        literals = set()
+        for error_check in error_list:
+            if 'substr' in error_check:
+                literals.add(error_check['substr'])
+            elif 'regex' in error_check:
+                regex = error_check['regex']
+                literal = self._required_literal(regex)
+                if literal:
+                    literals.add(literal)
+                elif regex not in self.regexes:
+                    self.regexes.append(regex)
+            else:
+                # let parse_single_line warn about it on every line, as before
+                self.always_match = True
+        if '' in literals:
+            self.always_match = True
+        elif literals:
+            self.regexes.insert(0, re.compile(self._trie_pattern(literals)))
+
+    @staticmethod
+    def _required_literal(regex):
+        """ Return the longest run of plain characters that every match of
+        `regex` must contain, or None.
+        """
+        if not hasattr(regex, 'pattern'):
+            return None
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except (re.error, OverflowError, RuntimeError):
+            return None
+        if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE):
+            return None
+        best = current = ''
+        for op, av in parsed:
+            if op == sre_constants.LITERAL and av < 128:
+                current += chr(av)
+                if len(current) > len(best):
+                    best = current
+            else:
+                current = ''
+        return best or None
+
+    @staticmethod
+    def _trie_pattern(words):
+        """ Return a regex pattern matching any of `words`, factored by
+        common prefix.
+        """
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+
+        def _pattern(node):
+            if '' in node:
+                # the shortest word ending here is enough for a match
+                return ''
+            alternatives = [re.escape(char) + _pattern(node[char])
+                            for char in sorted(node)]
+            if len(alternatives) == 1:
+                return alternatives[0]
+            return '(?:%s)' % '|'.join(alternatives)
+        return _pattern(trie)
+
+    def search(self, line):
+        """ Return True if some error_list entry may match `line`. """
+        if self.always_match:
+            return True
+        for regex in self.regexes:
+            if regex.search(line):
+                return True
+        return False
+
+
+def parse_context_lines(context_lines):
+    """ Turn an error_list `context_lines` setting into a (pre, post)
+    tuple of line counts.
+
+    Args:
+        context_lines (str | tuple | int | None): 'pre:post', where either
+          side may be empty, e.g. '5:5', '20:' or ':3'; a (pre, post) tuple;
+          or a single number used for both.
+
+    Returns:
+        tuple: (pre, post) as ints; (0, 0) for None.
+    """
+    if not context_lines:
+        return (0, 0)
+    if isinstance(context_lines, (tuple, list)):
+        pre, post = context_lines
+    elif isinstance(context_lines, basestring) and ':' in context_lines:
+        pre, post = context_lines.split(':', 1)
+    else:
+        pre = post = context_lines
+    return (int(pre or 0), int(post or 0))
+
+
 # OutputParser {{{1
 class OutputParser(LogMixin):
     """ Helper object to parse command output.
 
-    This will buffer output if needed, so we can go back and mark
-    [(linenum - 10) : linenum+10] as errors if need be, without having to
-    get all the output first.
-
-    linenum+10 will be easy; we can set self.num_post_context_lines to 10,
-    and self.num_post_context_lines-- as we mark each line to at least error
-    level X.
-
-    linenum-10 will be trickier. We'll not only need to save the line
-    itself, but also the level that we've set for that line previously,
-    whether by matching on that line, or by a previous line's context.
-    We should only log that line if all output has ended (self.finish() ?);
-    otherwise store a list of dictionaries in self.context_buffer that is
-    buffered up to self.num_pre_context_lines (set to the largest
-    pre-context-line setting in error_list.)
+    error_list entries may set `context_lines` to 'pre:post' (e.g. '5:5',
+    '20:' or ':3'), or to a (pre, post) tuple. The `pre` lines before and
+    the `post` lines after a matching line are then logged at the match's
+    level as well (FATAL matches promote their context to CRITICAL), so the
+    error log carries enough output to triage the failure.
+
+    Pre-context works by holding back up to self.num_pre_context_lines (the
+    largest `pre` in error_list) lines in self.context_buffer, each with the
+    level it will be logged at; the oldest line is logged as soon as it
+    falls out of every possible pre-context window, so memory use is
+    bounded. Whoever feeds lines to the parser must call finish() once the
+    output has ended to log what is still buffered.
     """
 
     def __init__(self, config=None, log_obj=None, error_list=None, log_output=True):
@@ -283,12 +450,77 @@ class OutputParser(LogMixin):
         self.log_output = log_output
         self.num_errors = 0
         self.num_warnings = 0
-        # TODO context_lines.
-        # Not in use yet, but will be based off error_list.
-        self.context_buffer = []
+        self.context_buffer = collections.deque()
         self.num_pre_context_lines = 0
         self.num_post_context_lines = 0
+        self.post_context_level = INFO
         self.worst_log_level = INFO
+        self._error_matcher = None
+        self._error_matcher_key = None
+
+    def _query_error_matcher(self):
+        """ Return the ErrorListMatcher for self.error_list, rebuilding it
+        if error_list was replaced or extended since the last call.
+        """
+        key = (id(self.error_list), len(self.error_list))
+        if self._error_matcher is None or key != self._error_matcher_key:
+            self._error_matcher = ErrorListMatcher.get(self.error_list)
+            self._error_matcher_key = key
+            self.num_pre_context_lines = max(
+                [parse_context_lines(e.get('context_lines'))[0]
+                 for e in self.error_list] or [0])
+        return self._error_matcher
+
+    def _log_line(self, message, level=INFO):
+        """ Log an output line that didn't match error_list, promoting it
+        to the post-context level of a recent match, and holding it back in
+        the context buffer if a later match may need it as pre-context.
+        """
+        if self.num_post_context_lines:
+            level = self.worst_level(self.post_context_level, level)
+            self.num_post_context_lines -= 1
+            if not self.num_post_context_lines:
+                self.post_context_level = INFO
+        if not self.num_pre_context_lines:
+            self.flush_context_buffer()
+            return self.log(message, level=level)
+        self.context_buffer.append([message, level])
+        while len(self.context_buffer) > self.num_pre_context_lines:
+            message, level = self.context_buffer.popleft()
+            self.log(message, level=level)
+
+    def _add_context(self, context_lines, level):
+        """ Log the context buffer ahead of a match at `level`, promoting
+        the match's pre-context, and start its post-context window.
+        """
+        pre, post = parse_context_lines(context_lines)
+        # A FATAL context line would exit before the match is even logged.
+        if level == FATAL:
+            level = CRITICAL
+        if level in (CRITICAL, ERROR, WARNING):
+            if pre:
+                for entry in list(self.context_buffer)[-pre:]:
+                    entry[1] = self.worst_level(level, entry[1])
+            if post:
+                self.num_post_context_lines = max(post,
+                                                  self.num_post_context_lines)
+                self.post_context_level = self.worst_level(
+                    level, self.post_context_level)
+        self.flush_context_buffer()
+
+    def flush_context_buffer(self):
+        """ Log every line held back for pre-context. """
+        while self.context_buffer:
+            message, level = self.context_buffer.popleft()
+            self.log(message, level=level)
+
+    def finish(self):
+        """ Called once the output has ended; log whatever is still held
+        back for pre-context.
+        """
+        self.flush_context_buffer()
+        self.num_post_context_lines = 0
+        self.post_context_level = INFO
 
     def parse_single_line(self, line):
         """ parse a console output line and check if it matches one in `error_list`,
@@ -297,8 +529,12 @@ class OutputParser(LogMixin):
         Args:
             line (str): command line output to parse.
         """
+        if not self._query_error_matcher().search(line):
+            # Nothing in error_list can match; skip the per-entry walk.
+            if self.log_output:
+                self._log_line(' %s' % line)
+            return
         for error_check in self.error_list:
-            # TODO buffer for context_lines.
             match = False
             if 'substr' in error_check:
                 if error_check['substr'] in line:
@@ -315,6 +551,8 @@ class OutputParser(LogMixin):
                     message = ' %s' % line
                     if error_check.get('explanation'):
                         message += '\n %s' % error_check['explanation']
+                    self._add_context(error_check.get('context_lines'),
+                                      log_level)
                     if error_check.get('summary'):
                         self.add_summary(message, level=log_level)
                     else:
@@ -328,7 +566,7 @@ class OutputParser(LogMixin):
                 break
         else:
             if self.log_output:
-                self.info(' %s' % line)
+                self._log_line(' %s' % line)
 
     def add_lines(self, output):
         """ process a string or list of strings, decode them to utf-8,strip
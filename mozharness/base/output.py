@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Helpers for consuming subprocess output as it arrives.
+
+OutputPump reads any number of pipes on reader threads (select() doesn't
+work on pipes on Windows) and hands each line to a callback on the calling
+thread, which sleeps on a queue in between rather than polling.
+HeadTailBuffer keeps only the first and last lines of a long output.
+"""
+
+import Queue
+import collections
+import threading
+
+
+# OutputPump {{{1
+class OutputPump(object):
+    """Stream lines from several pipes to per-pipe callbacks.
+
+    Usage:
+        pump = OutputPump()
+        pump.add_stream(p.stdout, handle_stdout_line)
+        pump.add_stream(p.stderr, handle_stderr_line)
+        pump.run()  # returns once every stream hit EOF
+
+    Lines are delivered in the order they were read, one at a time, on the
+    thread that calls run(), so callbacks don't need to be thread safe.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.num_streams = 0
+
+    def add_stream(self, fh, callback):
+        """Start reading `fh` line by line; `callback(line)` is called from
+        run() for each line, newline included.
+        """
+        thread = threading.Thread(target=self._read, args=(fh, callback))
+        thread.daemon = True
+        self.num_streams += 1
+        thread.start()
+
+    def _read(self, fh, callback):
+        try:
+            # not `for line in fh`, whose read-ahead delays lines on pipes
+            for line in iter(fh.readline, ''):
+                self.queue.put((callback, line))
+        finally:
+            self.queue.put((callback, None))
+
+    def run(self):
+        """Dispatch lines to their callbacks until every stream is closed."""
+        while self.num_streams:
+            try:
+                # get() with a timeout so KeyboardInterrupt still reaches us.
+                callback, line = self.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if line is None:
+                self.num_streams -= 1
+            else:
+                callback(line)
+
+
+# HeadTailBuffer {{{1
+class HeadTailBuffer(object):
+    """List-like line collector that, given a `limit`, keeps only the first
+    limit/2 and the last limit/2 lines it is given, and counts the rest.
+    With no limit every line is kept.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.head = []
+        self.tail = collections.deque()
+        self.num_omitted = 0
+        if limit:
+            self.head_size = (limit + 1) / 2
+            self.tail = collections.deque(maxlen=limit - self.head_size)
+
+    def append(self, line):
+        if not self.limit or len(self.head) < self.head_size:
+            self.head.append(line)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.num_omitted += 1
+        if self.tail.maxlen:
+            self.tail.append(line)
+
+    def __len__(self):
+        return len(self.head) + len(self.tail)
+
+    def lines(self):
+        """Return the kept lines, with a marker line where lines were
+        dropped.
+        """
+        lines = list(self.head)
+        if self.num_omitted:
+            lines.append("[... %d lines omitted ...]\n" % self.num_omitted)
+        lines.extend(self.tail)
+        return lines
@@ -7,6 +7,66 @@
 """Generic ways to parallelize jobs.
 """
 
+import sys
+import threading
+
+
+# run_in_parallel {{{1
+def run_in_parallel(func, items, max_workers=4):
+    """Call `func(item)` for each item in `items` on a bounded pool of
+    threads.
+
+    If any call raises (including the SystemExit raised by a FATAL log
+    message), no further items are started, the calls already running are
+    allowed to finish, and the first exception is re-raised in the calling
+    thread.  This keeps halt-on-failure behaviour the same as running the
+    calls serially.
+
+    Args:
+        func (callable): called once per item with the item as its only
+            argument.
+        items (iterable): items to process.
+        max_workers (int, optional): maximum number of threads. Defaults to 4.
+
+    Returns:
+        list: the return values of `func`, in the same order as `items`.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    pending = iter(range(len(items)))
+
+    def worker():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    i = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(items[i])
+            except BaseException:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    num_workers = max(1, min(max_workers or 1, len(items)))
+    threads = [threading.Thread(target=worker) for _ in range(num_workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # join() with a timeout so KeyboardInterrupt still reaches us.
+        while t.is_alive():
+            t.join(1)
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
 
 # ChunkingMixin {{{1
 class ChunkingMixin(object):
@@ -7,9 +7,12 @@
 '''Python usage, esp. virtualenv.
 '''
 
+import hashlib
 import os
+import platform
 import subprocess
 import sys
+import tempfile
 import time
 import json
 import traceback
@@ -20,8 +23,11 @@ from mozharness.base.script import (
     PreScriptAction,
     PreScriptRun,
 )
+from mozharness.base.copying import CopyStats, copy_tree
 from mozharness.base.errors import VirtualenvErrorList
+from mozharness.base.hashing import files_digests
 from mozharness.base.log import WARNING, FATAL
+from mozharness.base.resources import read_samples, summarize
 from mozharness.mozilla.proxxy import Proxxy
 
 # Virtualenv {{{1
@@ -53,6 +59,11 @@ virtualenv_config_options = [
         "dest": "pip_index",
         "help": "Don't use pip indexes"
     }],
+    [["--prebuilt-virtualenv-cache"], {
+        "action": "store",
+        "dest": "prebuilt_virtualenv_cache",
+        "help": "Directory to keep built virtualenvs in for reuse"
+    }],
 ]
 
 
@@ -63,6 +74,9 @@ class VirtualenvMixin(object):
      * virtualenv_path points to the virtualenv location on disk.
      * virtualenv_modules lists the module names.
      * MODULE_url list points to the module URLs (optional)
+     * prebuilt_virtualenv_cache is a directory to keep copies of built
+       virtualenvs in, to reuse instead of building the same one again
+       (optional); see create_virtualenv().
     Requires virtualenv to be in PATH.
     Depends on ScriptMixin
     '''
@@ -186,6 +200,8 @@ class VirtualenvMixin(object):
         will be combined with the module_url (if any), like so:
 
         pip install -r requirements1.txt -r requirements2.txt module_url
+
+        Returns 0 on success.
         """
         c = self.config
         dirs = self.query_abs_dirs()
@@ -260,7 +276,7 @@ class VirtualenvMixin(object):
         quoted_command = subprocess.list2cmdline(command)
         # Allow for errors while building modules, but require a
         # return status of 0.
-        self.retry(
+        return self.retry(
             self.run_command,
             # None will cause default value to be used
             attempts=1 if optional else None,
@@ -360,21 +376,30 @@ class VirtualenvMixin(object):
 
         virtualenv_options = c.get('virtualenv_options',
                                    ['--no-site-packages', '--distribute'])
+        if not modules:
+            modules = c.get('virtualenv_modules', [])
+        if not requirements:
+            requirements = c.get('virtualenv_requirements', [])
 
+        cache_key = None
         if os.path.exists(self.query_python_path()):
             self.info("Virtualenv %s appears to already exist; skipping virtualenv creation." % self.query_python_path())
         else:
-            self.run_command(virtualenv + virtualenv_options + [venv_path],
+            if c.get('prebuilt_virtualenv_cache'):
+                cache_key = self._query_virtualenv_cache_key(
+                    virtualenv, virtualenv_options, modules, requirements)
+                if self._install_prebuilt_virtualenv(cache_key):
+                    self.info("Done creating virtualenv %s." % venv_path)
+                    self.package_versions(log_output=True)
+                    return
+            self.run_command(list(virtualenv) + list(virtualenv_options) + [venv_path],
                              cwd=dirs['abs_work_dir'],
                              error_list=VirtualenvErrorList,
                              halt_on_failure=True)
-        if not modules:
-            modules = c.get('virtualenv_modules', [])
-        if not requirements:
-            requirements = c.get('virtualenv_requirements', [])
+        statuses = []
         if not modules and requirements:
-            self.install_module(requirements=requirements,
-                                install_method='pip')
+            statuses.append(self.install_module(requirements=requirements,
+                                                install_method='pip'))
         for module in modules:
             module_url = module
             global_options = []
@@ -392,30 +417,163 @@ class VirtualenvMixin(object):
             install_method = 'pip'
             if module_name in ('pywin32',):
                 install_method = 'easy_install'
-            self.install_module(module=module_name,
-                                module_url=module_url,
-                                install_method=install_method,
-                                requirements=requirements,
-                                global_options=global_options)
+            statuses.append(self.install_module(module=module_name,
+                                                module_url=module_url,
+                                                install_method=install_method,
+                                                requirements=requirements,
+                                                global_options=global_options))
 
         for module, url, method, requirements, optional, two_pass, editable in \
                 self._virtualenv_modules:
             if two_pass:
-                self.install_module(
+                statuses.append(self.install_module(
                     module=module, module_url=url,
                     install_method=method, requirements=requirements or (),
                     optional=optional, no_deps=True, editable=editable
-                )
-            self.install_module(
+                ))
+            statuses.append(self.install_module(
                 module=module, module_url=url,
                 install_method=method, requirements=requirements or (),
                 optional=optional, editable=editable
-            )
+            ))
 
         self.info("Done creating virtualenv %s." % venv_path)
 
+        if cache_key:
+            if [status for status in statuses if status != 0]:
+                # Optional modules failed to install; don't make every
+                # later job go without them.
+                self.info("Not caching virtualenv %s, as it's incomplete." %
+                          venv_path)
+            else:
+                self._publish_virtualenv(cache_key)
+
         self.package_versions(log_output=True)
 
+    def _query_tree_digest(self, path):
+        """Return a digest of the contents of the file or tree at `path`."""
+        digest = hashlib.sha1()
+        if os.path.isfile(path):
+            paths = [path]
+        else:
+            paths = []
+            for root, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                paths.extend(os.path.join(root, f) for f in sorted(file_names)
+                             if not f.endswith(('.pyc', '.pyo')))
+        for p, digests in sorted(files_digests(paths, ('sha1', )).items()):
+            digest.update('%s\0%s\0' % (os.path.relpath(p, path),
+                                          digests['sha1']))
+        return digest.hexdigest()
+
+    def _query_virtualenv_cache_key(self, virtualenv, virtualenv_options,
+                                    modules, requirements):
+        """Return the key to cache the virtualenv create_virtualenv() is
+        about to build under.
+
+        Everything that goes into the virtualenv is part of it: the python
+        it runs, the virtualenv command and options, where packages come
+        from, every module and requirements file to install (by contents,
+        for local files and directories), and the virtualenv's own path,
+        which its scripts have hard coded.
+        """
+        c = self.config
+        work_dir = self.query_abs_dirs()['abs_work_dir']
+        local_digests = {}
+        sources = [r for r in requirements]
+        for module in modules:
+            if isinstance(module, dict):
+                sources.append(module.get('url'))
+            else:
+                sources.append(c.get('%s_url' % module))
+        for module in self._virtualenv_modules:
+            sources.append(module[1])
+            sources.extend(module[3] or ())
+        for source in sources:
+            if not source or '://' in source:
+                continue
+            path = os.path.join(work_dir, source)
+            if os.path.exists(path):
+                local_digests[source] = self._query_tree_digest(path)
+        key = json.dumps([
+            sys.version, sys.platform, platform.machine(),
+            virtualenv, virtualenv_options,
+            c.get('find_links'), c.get('pip_index'),
+            modules, requirements, self._virtualenv_modules,
+            local_digests, self.query_virtualenv_path(),
+        ], sort_keys=True)
+        return hashlib.sha1(key).hexdigest()
+
+    def _install_prebuilt_virtualenv(self, cache_key):
+        """Put the virtualenv cached under `cache_key`, if any, in place.
+
+        The copy is made with reflinks where the filesystem supports them,
+        so it takes next to no time or space, and goes to a temporary
+        directory first, so an interrupted copy never looks like a
+        virtualenv.
+
+        Returns:
+            bool: whether the virtualenv is in place.
+        """
+        c = self.config
+        cached = os.path.join(c['prebuilt_virtualenv_cache'], cache_key)
+        if not os.path.isdir(cached):
+            self.info("No prebuilt virtualenv %s." % cached)
+            return False
+        max_age = c.get('prebuilt_virtualenv_max_age', 24 * 60 * 60)
+        if max_age and time.time() - os.path.getmtime(cached) > max_age:
+            # so unpinned modules still pick up new releases
+            self.info("Prebuilt virtualenv %s is too old to use." % cached)
+            return False
+        venv_path = self.query_virtualenv_path()
+        tmp_path = '%s.tmp-%d' % (venv_path, os.getpid())
+        self.info("Using prebuilt virtualenv %s." % cached)
+        stats = CopyStats()
+        try:
+            self.rmtree(tmp_path)
+            copy_tree(cached, tmp_path, link_mode='reflink', stats=stats)
+            os.rename(tmp_path, venv_path)
+        except (IOError, OSError):
+            self.warning("Can't use prebuilt virtualenv %s: %s" %
+                         (cached, traceback.format_exc()))
+            self.rmtree(tmp_path)
+            return False
+        self.info(str(stats))
+        return True
+
+    def _publish_virtualenv(self, cache_key):
+        """Copy the virtualenv just built into the cache under `cache_key`.
+
+        The copy is built next to the cache entry and renamed into place,
+        so jobs sharing the cache only ever see complete virtualenvs; if
+        another job publishes the same virtualenv first, ours is thrown away.
+        """
+        c = self.config
+        cache_dir = c['prebuilt_virtualenv_cache']
+        cached = os.path.join(cache_dir, cache_key)
+        venv_path = self.query_virtualenv_path()
+        self.mkdir_p(cache_dir)
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-%s-' % cache_key)
+        os.rmdir(tmp_path)
+        self.info("Caching virtualenv %s as %s." % (venv_path, cached))
+        try:
+            # pip's download cache lives in there by default
+            copy_tree(venv_path, tmp_path, link_mode='reflink',
+                      exclude=[c.get('virtualenv_cache_dir',
+                                     os.path.join(venv_path, 'cache'))])
+            if os.path.isdir(cached):
+                # too old to use; move it aside first
+                old = tempfile.mkdtemp(dir=cache_dir, prefix='.old-%s-' % cache_key)
+                os.rename(cached, os.path.join(old, cache_key))
+                self.rmtree(old)
+            os.rename(tmp_path, cached)
+            # its age is how long since it was built
+            os.utime(cached, None)
+        except (IOError, OSError):
+            self.info("Didn't cache virtualenv %s: %s" %
+                      (venv_path, traceback.format_exc()))
+            self.rmtree(tmp_path)
+
     def activate_virtualenv(self):
         """Import the virtualenv's packages into this Python interpreter."""
         bin_dir = os.path.dirname(self.query_python_path())
@@ -427,15 +585,13 @@ class ResourceMonitoringMixin(object):
     """Provides resource monitoring capabilities to scripts.
 
     When this class is in the inheritance chain, resource usage stats of the
-    executing script will be recorded.
-
-    This class requires the VirtualenvMixin in order to install a package used
-    for recording resource usage.
+    executing script will be logged at the end of the run, in total and per
+    action.
 
-    While we would like to record resource usage for the entirety of a script,
-    since we require an external package, we can only record resource usage
-    after that package is installed (as part of creating the virtualenv).
-    That's just the way things have to be.
+    Where BaseScript's built-in resource sampler is running (on Linux), the
+    stats come from that, and cover the whole script.  Elsewhere this falls
+    back to mozsystemmonitor, which requires the VirtualenvMixin to install
+    it, so resource usage is only recorded after the virtualenv is created.
     """
     def __init__(self, *args, **kwargs):
         super(ResourceMonitoringMixin, self).__init__(*args, **kwargs)
@@ -450,6 +606,10 @@ class ResourceMonitoringMixin(object):
     def _start_resource_monitoring(self, action, success=None):
         self.activate_virtualenv()
 
+        if self._resource_sampler:
+            # already measuring, and have been since the start
+            return
+
         # Resource Monitor requires Python 2.7, however it's currently optional.
         # Remove when all machines have had their Python version updated (bug 711299).
         if sys.version_info[:2] < (2, 7):
@@ -484,6 +644,15 @@ class ResourceMonitoringMixin(object):
 
     @PostScriptRun
     def _resource_record_post_run(self):
+        if self._resource_sampler:
+            try:
+                self._resource_sampler.stop()
+                self._log_sampled_resource_usage()
+            except Exception:
+                self.warning("Exception when reporting resource usage: %s" %
+                             traceback.format_exc())
+            return
+
         if not self._resource_monitor:
             return
 
@@ -496,6 +665,31 @@ class ResourceMonitoringMixin(object):
             self.warning("Exception when reporting resource usage: %s" %
                          traceback.format_exc())
 
+    def _log_sampled_resource_usage(self):
+        total, phases = summarize(read_samples(self._resource_sampler.path))
+        if not total:
+            return
+
+        def log_usage(prefix, usage):
+            if usage.cpu_percent is None:
+                cpu_percent_str = "Can't collect data"
+            else:
+                cpu_percent_str = str(round(usage.cpu_percent)) + '%'
+            self.info(
+                '{prefix} - Wall time: {u.duration:.0f}s; CPU: {cpu}; '
+                'Read bytes: {u.read_bytes}; Write bytes: {u.write_bytes}; '
+                'Read time: {u.read_time}; Write time: {u.write_time}; '
+                'Max RSS: {u.rss_max}; Net received bytes: {u.net_rx}; '
+                'Net sent bytes: {u.net_tx}; '
+                'Min disk free: {u.disk_free_min}'.format(
+                    prefix=prefix, u=usage, cpu=cpu_percent_str))
+
+        log_usage('Total resource usage', total)
+        for phase, usage in phases:
+            log_usage(phase, usage)
+        self.info("Resource usage samples are in %s" %
+                  self._resource_sampler.path)
+
     def _log_resource_usage(self):
         rm = self._resource_monitor
 
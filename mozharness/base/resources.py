@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Lightweight resource sampling straight from /proc.
+
+ResourceSampler records system CPU, the RSS of the script and its children,
+disk I/O, network traffic and free disk space once a second on a background
+thread, labelling each sample with the current phase (action), and appends
+them to a tab separated file:
+
+    time  phase  cpu_busy  cpu_total  rss  read_bytes  write_bytes
+          read_time  write_time  net_rx  net_tx  disk_free
+
+CPU is in jiffies, times in milliseconds, the rest in bytes.  Counters are
+cumulative, so any two samples give the usage in between; summarize() does
+that for each phase.
+
+Unlike mozsystemmonitor, this needs nothing outside the standard library,
+so it can run from the very start of a script.  It only works on Linux.
+"""
+
+import atexit
+import collections
+import os
+import re
+import threading
+import time
+import weakref
+
+COLUMNS = ('time', 'phase', 'cpu_busy', 'cpu_total', 'rss', 'read_bytes',
+           'write_bytes', 'read_time', 'write_time', 'net_rx', 'net_tx',
+           'disk_free')
+SECTOR_SIZE = 512
+
+ResourceUsage = collections.namedtuple('ResourceUsage', [
+    'duration', 'cpu_percent', 'rss_max', 'read_bytes', 'write_bytes',
+    'read_time', 'write_time', 'net_rx', 'net_tx', 'disk_free_min'])
+
+
+def is_supported():
+    return os.path.exists('/proc/stat')
+
+
+# /proc readers {{{1
+def _read(path):
+    with open(path) as fh:
+        return fh.read()
+
+
+def read_cpu():
+    """Return (busy, total) jiffies across all CPUs."""
+    fields = [int(f) for f in _read('/proc/stat').split('\n', 1)[0].split()[1:]]
+    total = sum(fields[:8])
+    # idle and iowait
+    return total - sum(fields[3:5]), total
+
+
+def _disks():
+    # whole disks only, or partitions would be counted twice
+    return set(name for name in os.listdir('/sys/block')
+               if not re.match(r'(loop|ram)\d', name))
+
+
+def read_disk_io(disks):
+    """Return (read bytes, write bytes, read ms, write ms) summed over `disks`."""
+    totals = [0, 0, 0, 0]
+    for line in _read('/proc/diskstats').splitlines():
+        fields = line.split()
+        if len(fields) < 11 or fields[2] not in disks:
+            continue
+        totals[0] += int(fields[5]) * SECTOR_SIZE
+        totals[1] += int(fields[9]) * SECTOR_SIZE
+        totals[2] += int(fields[6])
+        totals[3] += int(fields[10])
+    return totals
+
+
+def read_net_io():
+    """Return (received bytes, sent bytes) over all interfaces but lo."""
+    rx = tx = 0
+    for line in _read('/proc/net/dev').splitlines()[2:]:
+        name, fields = line.split(':', 1)
+        if name.strip() == 'lo':
+            continue
+        fields = fields.split()
+        rx += int(fields[0])
+        tx += int(fields[8])
+    return rx, tx
+
+
+def read_tree_rss(pid):
+    """Return the total RSS, in bytes, of `pid` and all its descendants."""
+    children = collections.defaultdict(list)
+    rss = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = _read('/proc/%s/stat' % name)
+        except (IOError, OSError):
+            # exited since the listdir()
+            continue
+        # the command name may contain spaces and parentheses
+        fields = stat[stat.rfind(')') + 2:].split()
+        children[int(fields[1])].append(int(name))
+        rss[int(name)] = int(fields[21])
+    total = 0
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        total += rss.get(p, 0)
+        pending.extend(children.get(p, []))
+    return total * os.sysconf('SC_PAGE_SIZE')
+
+
+def read_disk_free(path):
+    """Return the free space, in bytes, on the volume holding `path`, or
+    where it would be if it's been deleted (say, clobbered).
+    """
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+# ResourceSampler {{{1
+# (stop event, thread) of each running sampler
+_running = set()
+
+
+@atexit.register
+def _stop_all():
+    # A sampler thread still running while the interpreter shuts down finds
+    # the modules it uses torn down under it.
+    for stop_event, thread in list(_running):
+        stop_event.set()
+        thread.join()
+
+
+def _sample_loop(sampler_ref, stop_event, interval):
+    # Only hold the sampler while sampling, so a sampler (and its script)
+    # that is never stop()ped can still be garbage collected, which ends
+    # this thread.
+    while not stop_event.wait(interval):
+        sampler = sampler_ref()
+        if sampler is None:
+            return
+        sampler.try_sample()
+        del sampler
+
+
+class ResourceSampler(object):
+    """Samples resource usage into `path` every `interval` seconds.
+
+    Args:
+        path (str): file to append the samples to.
+        interval (float, optional): seconds between samples. Defaults to 1.
+        disk_path (str, optional): directory whose volume to report free
+          space for. Defaults to the current directory.
+        pid (int, optional): process whose tree to report the RSS of.
+          Defaults to this one.
+    """
+    def __init__(self, path, interval=1.0, disk_path='.', pid=None):
+        self.path = path
+        self.interval = interval
+        self.disk_path = os.path.abspath(disk_path)
+        self.pid = pid or os.getpid()
+        self.phase = None
+        self.phases = {}
+        self._disks = _disks()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._fh = None
+
+    def start(self):
+        self._fh = open(self.path, 'w')
+        self._fh.write('\t'.join(COLUMNS) + '\n')
+        self.sample()
+        self._thread = threading.Thread(
+            target=_sample_loop,
+            args=(weakref.ref(self), self._stop_event, self.interval))
+        self._thread.daemon = True
+        self._thread.start()
+        _running.add((self._stop_event, self._thread))
+
+    def sample(self):
+        row = [int(time.time() * 100) / 100.0, self.phase or '-']
+        row.extend(read_cpu())
+        row.append(read_tree_rss(self.pid))
+        row.extend(read_disk_io(self._disks))
+        row.extend(read_net_io())
+        row.append(read_disk_free(self.disk_path))
+        with self._lock:
+            if self._fh is None:
+                return
+            self._fh.write('\t'.join(str(v) for v in row) + '\n')
+            self._fh.flush()
+
+    def try_sample(self):
+        try:
+            self.sample()
+        except Exception:
+            # /proc can always surprise us; we'd rather lose a sample than
+            # break the script
+            pass
+
+    def begin_phase(self, phase):
+        self.phase = phase
+        self.phases[phase] = (time.time(), None)
+        self.try_sample()
+
+    def finish_phase(self, phase):
+        # the last sample of a phase is its end
+        self.try_sample()
+        self.phases[phase] = (self.phases.get(phase, (time.time(),))[0],
+                              time.time())
+        self.phase = None
+
+    def stop(self):
+        """Stop sampling, with a final sample.  Safe to call more than once."""
+        if self._fh is None:
+            return
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            _running.discard((self._stop_event, self._thread))
+        self.try_sample()
+        with self._lock:
+            self._fh.close()
+            self._fh = None
+
+    @property
+    def running(self):
+        return self._fh is not None
+
+
+# summaries {{{1
+def read_samples(path):
+    """Return the samples in `path` as a list of dicts, keyed by COLUMNS."""
+    samples = []
+    with open(path) as fh:
+        fh.readline()
+        for line in fh:
+            values = line.rstrip('\n').split('\t')
+            if len(values) != len(COLUMNS):
+                # cut short by a crash
+                continue
+            sample = dict(zip(COLUMNS, values))
+            for k in COLUMNS:
+                if k == 'time':
+                    sample[k] = float(sample[k])
+                elif k != 'phase':
+                    sample[k] = int(sample[k])
+            samples.append(sample)
+    return samples
+
+
+def _usage(samples):
+    first, last = samples[0], samples[-1]
+
+    def delta(k):
+        return last[k] - first[k]
+    cpu_total = delta('cpu_total')
+    return ResourceUsage(
+        duration=last['time'] - first['time'],
+        cpu_percent=100.0 * delta('cpu_busy') / cpu_total if cpu_total else None,
+        rss_max=max(s['rss'] for s in samples),
+        read_bytes=delta('read_bytes'), write_bytes=delta('write_bytes'),
+        read_time=delta('read_time'), write_time=delta('write_time'),
+        net_rx=delta('net_rx'), net_tx=delta('net_tx'),
+        disk_free_min=min(s['disk_free'] for s in samples))
+
+
+def summarize(samples):
+    """Return (total ResourceUsage, [(phase, ResourceUsage), ...]) for
+    `samples`, with the phases in the order they started.
+    """
+    if not samples:
+        return None, []
+    phases = collections.OrderedDict()
+    for sample in samples:
+        if sample['phase'] != '-':
+            phases.setdefault(sample['phase'], []).append(sample)
+    return _usage(samples), [(phase, _usage(s)) for (phase, s) in phases.items()]
@@ -13,6 +13,7 @@ mozharness.
 import codecs
 from contextlib import contextmanager
 import errno
+import fnmatch
 import gzip
 import inspect
 import os
@@ -23,12 +24,13 @@ import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import urllib2
 import httplib
 import urlparse
-import hashlib
+import zipfile
 if os.name == 'nt':
     try:
         import win32file
@@ -43,10 +45,21 @@ try:
 except ImportError:
     import json
 
+import mozfile
 from mozprocess import ProcessHandler
+from mozharness.base.cache import DownloadCache
 from mozharness.base.config import BaseConfig
+from mozharness.base.copying import CopyStats, copy_file, copy_files
+from mozharness.base.hashing import file_digests, files_digests
 from mozharness.base.log import SimpleFileLogger, MultiFileLogger, \
-    LogMixin, OutputParser, DEBUG, INFO, ERROR, FATAL
+    LogMixin, OutputParser, log_prefix, DEBUG, INFO, ERROR, FATAL
+from mozharness.base.output import HeadTailBuffer, OutputPump
+from mozharness.base.parallel import run_in_parallel
+from mozharness.base.resources import ResourceSampler, \
+    is_supported as resource_sampling_supported
+from mozharness.base.tracing import Tracer, null_span, traced
+from mozharness.base.trash import move_to_trash, spawn_trash_emptier, \
+    trash_dir_for
 
 def platform_name():
     pm = PlatformMixin()
@@ -132,6 +145,10 @@ class ScriptMixin(PlatformMixin):
 
     env = None
     script_obj = None
+    download_cache = None
+    _partial_downloads = None
+    _trash_emptiers = None
+    _tracer = None
 
     # Simple filesystem commands {{{2
     def mkdir_p(self, path, error_level=ERROR):
@@ -160,7 +177,7 @@ class ScriptMixin(PlatformMixin):
             self.debug("mkdir_p: %s Already exists." % path)
 
     def rmtree(self, path, log_level=INFO, error_level=ERROR,
-               exit_code=-1):
+               exit_code=-1, deferred=False):
         """ Delete an entire directory tree and log its result.
         This method also logs the platform rmtree function, its retries, errors,
         and current existence of the directory.
@@ -173,12 +190,20 @@ class ScriptMixin(PlatformMixin):
                                          Defaults to `ERROR`.
             exit_code (int, optional): useless parameter, not use here.
                                        Defaults to -1
+            deferred (bool, optional): rename the tree into the volume's trash
+                                       directory and delete it from a
+                                       background process instead of waiting
+                                       for it. Falls back to deleting it now
+                                       if it can't be renamed. Defaults to
+                                       False.
 
         Returns:
             None: for success
         """
 
         self.log("rmtree: %s" % path, level=log_level)
+        if deferred and self._defer_rmtree(path, log_level=log_level):
+            return
         error_message = "Unable to remove %s!" % path
         if self._is_windows():
             # Call _rmtree_windows() directly, since even checking
@@ -213,6 +238,77 @@ class ScriptMixin(PlatformMixin):
         else:
             self.debug("%s doesn't exist." % path)
 
+    def _defer_rmtree(self, path, log_level=INFO):
+        """ Move `path` to the trash and make sure a trash emptier is running
+        for it. See mozharness.base.trash.
+
+        The `deferred_delete_min_free` config item (in GB) lets the emptier
+        stop once that much space is free, leaving the rest for later.
+
+        Args:
+            path (str): path to the directory tree root to remove.
+            log_level (str, optional): log level name to for this operation.
+
+        Returns:
+            bool: True if the tree was moved to the trash, False if it has to
+                  be deleted synchronously instead.
+        """
+        if not os.path.isdir(path) or os.path.islink(path):
+            return False
+        try:
+            trash_dir = trash_dir_for(path)
+            trash_path = move_to_trash(path, trash_dir)
+        except OSError, e:
+            self.info("Can't move %s to the trash (%s); deleting it now." %
+                      (path, str(e)))
+            return False
+        self.log("Moved %s to %s for deletion in the background." %
+                 (path, trash_path), level=log_level)
+        if self._trash_emptiers is None:
+            self._trash_emptiers = {}
+        emptier = self._trash_emptiers.get(trash_dir)
+        if emptier is None or emptier.poll() is not None:
+            min_free = self.config.get('deferred_delete_min_free')
+            if min_free:
+                min_free = int(min_free * 1024 ** 3)
+            try:
+                self._trash_emptiers[trash_dir] = spawn_trash_emptier(
+                    trash_dir, min_free=min_free)
+            except OSError, e:
+                # The tree is out of the way; whatever empties this trash
+                # next will delete it.
+                self.warning("Unable to start the trash emptier for %s: %s" %
+                             (trash_dir, str(e)))
+        return True
+
+    def stamp_dir_used(self, path, share=False):
+        """ Record in the purge index that `path` was just used, so that
+        purge_builds.py deletes least recently used directories first and
+        doesn't have to walk the disk to find them.
+
+        Does nothing unless the `purge_index` config item is set. Stamps
+        are appended to `<purge_index>.journal`, which purge_builds.py
+        folds into the index on its next run.
+
+        Args:
+            path (str): directory that was used.
+            share (bool, optional): whether `path` is a shared hg repo.
+                                    Defaults to False.
+        """
+        index = self.config.get('purge_index')
+        if not index:
+            return
+        stamp = {'path': os.path.realpath(path), 'last_used': time.time()}
+        if share:
+            stamp['share'] = True
+        try:
+            # One write() of a short line in append mode, so concurrent
+            # jobs' stamps don't interleave.
+            with open(index + '.journal', 'a') as fh:
+                fh.write(json.dumps(stamp) + '\n')
+        except IOError, e:
+            self.warning("Unable to stamp %s in %s: %s" % (path, index, str(e)))
+
     def query_msys_path(self, path):
         """ replaces the Windows harddrive letter path style with a linux
         path style, e.g. C:// --> /C/
@@ -316,7 +412,29 @@ class ScriptMixin(PlatformMixin):
         """
         return urllib2.urlopen(url, **kwargs)
 
-    def _download_file(self, url, file_name):
+    def query_download_cache(self):
+        """ Return the download cache configured by `download_cache_dir`, or
+        None if caching is disabled.
+
+        The cache is shared by every object in this process that uses the
+        same `download_cache_dir`. `download_cache_max_size` (bytes) sets
+        the size it is evicted down to.
+
+        Returns:
+            DownloadCache: the cache for `download_cache_dir`.
+            None: if `download_cache_dir` isn't set.
+        """
+        if self.download_cache:
+            return self.download_cache
+        cache_dir = self.config.get('download_cache_dir')
+        if not cache_dir:
+            return None
+        self.download_cache = DownloadCache.get(
+            cache_dir, max_size=self.config.get('download_cache_max_size'),
+            log_obj=self.log_obj)
+        return self.download_cache
+
+    def _download_file(self, url, file_name, digest=None):
         """ Helper script for download_file()
         Additionaly this function logs all exceptions as warnings before
         re-raising them
@@ -325,6 +443,8 @@ class ScriptMixin(PlatformMixin):
             url (str): string containing the URL with the file location
             file_name (str): name of the file where the downloaded file
                              is written.
+            digest (str, optional): known sha512 hex digest of the file, used
+                                    as the download cache key. Defaults to None.
 
         Returns:
             str: filename of the written file on disk
@@ -343,23 +463,64 @@ class ScriptMixin(PlatformMixin):
             url = 'file://%s' % os.path.abspath(url)
 
         try:
+            download_cache = None
+            if url.startswith("http"):
+                download_cache = self.query_download_cache()
+            if download_cache:
+                return download_cache.download(url, file_name, self._urlopen,
+                                               digest=digest)
+            partial = self._query_partial_download(url, file_name)
+            if partial:
+                self.info("Resuming download of %s; %d bytes missing." %
+                          (url, sum(end - start + 1 for start, end in partial['ranges'])))
+                if self._download_ranges(url, file_name, partial):
+                    return file_name
+                self.info("Server won't resume %s; starting over." % url)
+
             f_length = None
             f = self._urlopen(url, timeout=30)
 
             if f.info().get('content-length') is not None:
                 f_length = int(f.info()['content-length'])
-                got_length = 0
+            validator = self._query_range_validator(f)
+
+            num_chunks = self.config.get('download_parallel_chunks', 1)
+            if (num_chunks > 1 and url.startswith("http") and f_length and
+                    f_length >= self.config.get('download_parallel_min_size', 64 * 1024 ** 2) and
+                    f.info().get('accept-ranges') == 'bytes'):
+                f.close()
+                chunk_size = (f_length + num_chunks - 1) / num_chunks
+                partial = self._save_partial_download(
+                    url, file_name, f_length, validator,
+                    [(start, min(start + chunk_size, f_length) - 1)
+                     for start in range(0, f_length, chunk_size)])
+                with open(file_name, 'wb') as local_file:
+                    local_file.truncate(f_length)
+                self.info("Downloading %s in %d ranges." % (url, len(partial['ranges'])))
+                if self._download_ranges(url, file_name, partial):
+                    return file_name
+                self.info("Server won't serve ranges of %s; downloading it whole." % url)
+                f = self._urlopen(url, timeout=30)
+
+            got_length = 0
             local_file = open(file_name, 'wb')
-            while True:
-                block = f.read(1024 ** 2)
-                if not block:
-                    if f_length is not None and got_length != f_length:
-                        raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
-                    break
-                local_file.write(block)
-                if f_length is not None:
+            try:
+                while True:
+                    block = f.read(1024 ** 2)
+                    if not block:
+                        if f_length is not None and got_length != f_length:
+                            raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
+                        break
+                    local_file.write(block)
                     got_length += len(block)
-            local_file.close()
+            except Exception:
+                # Keep what we have so the next attempt can ask for the rest.
+                if url.startswith("http") and f_length and got_length and validator:
+                    self._save_partial_download(url, file_name, f_length, validator,
+                                                [(got_length, f_length - 1)])
+                raise
+            finally:
+                local_file.close()
             return file_name
         except urllib2.HTTPError, e:
             self.warning("Server returned status %s %s for %s" % (str(e.code), str(e), url))
@@ -390,7 +551,112 @@ class ScriptMixin(PlatformMixin):
             self.warning("Socket error when accessing %s: %s" % (url, str(e)))
             raise
 
-    def _retry_download_file(self, url, file_name, error_level, retry_config=None):
+    def _query_range_validator(self, f):
+        """ Return the value to send as If-Range when resuming the download
+        behind response `f`, so a changed file is sent whole instead of
+        being spliced: a strong ETag, or else Last-Modified.
+
+        Returns:
+            str: the validator.
+            None: if the response has neither.
+        """
+        etag = f.info().get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return f.info().get('last-modified')
+
+    def _query_partial_downloads(self):
+        """ Return the {file_name: state} dict of interrupted downloads."""
+        if self._partial_downloads is None:
+            self._partial_downloads = {}
+        return self._partial_downloads
+
+    def _query_partial_download(self, url, file_name):
+        """ Return the saved state of an interrupted download of `url` into
+        `file_name`, or None if there is nothing to resume.
+        """
+        partial_downloads = self._query_partial_downloads()
+        partial = partial_downloads.get(file_name)
+        if not partial or partial['url'] != url or not os.path.exists(file_name):
+            partial_downloads.pop(file_name, None)
+            return None
+        partial['ranges'] = [r for r in partial['ranges'] if r[0] <= r[1]]
+        return partial
+
+    def _save_partial_download(self, url, file_name, length, validator, ranges):
+        """ Remember that `ranges` (inclusive byte offsets) of `file_name`
+        are still missing.
+
+        Returns:
+            dict: the saved state, which _download_ranges() keeps updated.
+        """
+        partial = {
+            'url': url,
+            'length': length,
+            'validator': validator,
+            'ranges': ranges,
+        }
+        self._query_partial_downloads()[file_name] = partial
+        return partial
+
+    def _download_ranges(self, url, file_name, partial):
+        """ Fetch the missing byte ranges of a download with HTTP Range
+        requests and write them in place, up to `download_parallel_chunks`
+        at a time. Progress is recorded in `partial` as it is made, so if
+        this raises, a retry only fetches what is still missing.
+
+        Returns:
+            bool: True once every range is written; False if the server
+                  ignored a range request (e.g. the file has changed).
+
+        Raises:
+            urllib2.URLError: on a short range.
+            anything `self._urlopen` raises.
+        """
+        ranges = partial['ranges']
+        lock = threading.Lock()
+
+        def fetch(i):
+            start, end = ranges[i]
+            request = urllib2.Request(url)
+            request.add_header('Range', 'bytes=%d-%d' % (start, end))
+            if partial['validator']:
+                request.add_header('If-Range', partial['validator'])
+            try:
+                f = self._urlopen(request, timeout=30)
+            except urllib2.HTTPError, e:
+                if e.code == 416:
+                    # Range Not Satisfiable; the file must have shrunk
+                    return False
+                raise
+            try:
+                if f.getcode() != 206:
+                    return False
+                with open(file_name, 'r+b') as local_file:
+                    local_file.seek(start)
+                    while start <= end:
+                        block = f.read(min(1024 ** 2, end - start + 1))
+                        if not block:
+                            raise urllib2.URLError("Download incomplete; range ended at byte %d of %d" % (start, end))
+                        local_file.write(block)
+                        start += len(block)
+                        with lock:
+                            ranges[i] = (start, end)
+            finally:
+                f.close()
+            return True
+
+        results = run_in_parallel(fetch, range(len(ranges)),
+                                  max_workers=self.config.get('download_parallel_chunks', 1))
+        self._query_partial_downloads().pop(file_name, None)
+        if not all(results):
+            return False
+        if os.path.getsize(file_name) != partial['length']:
+            raise urllib2.URLError("Download incomplete; content-length was %d, but the file is %d bytes" % (partial['length'], os.path.getsize(file_name)))
+        return True
+
+    def _retry_download_file(self, url, file_name, error_level, retry_config=None,
+                             digest=None):
         """ Helper method to retry _download_file().
         Split out so we can alter the retry logic in mozharness.mozilla.testing.gaia_test.
 
@@ -403,6 +669,8 @@ class ScriptMixin(PlatformMixin):
             error_level (str): log level to use in case an error occurs.
             retry_config (dict, optional): key-value pairs to be passed to
                                            `self.retry`. Defaults to `None`
+            digest (str, optional): known sha512 hex digest of the file.
+                                    Defaults to `None`
 
         Returns:
             str: `self._download_file` return value is returned
@@ -424,14 +692,16 @@ class ScriptMixin(PlatformMixin):
         return self.retry(
             self._download_file,
             args=(url, file_name),
+            kwargs={'digest': digest},
             **retry_args
         )
 
     # http://www.techniqal.com/blog/2008/07/31/python-file-read-write-with-urllib2/
     # TODO thinking about creating a transfer object.
+    @traced('download', 'url')
     def download_file(self, url, file_name=None, parent_dir=None,
                       create_parent_dir=True, error_level=ERROR,
-                      exit_code=3, retry_config=None):
+                      exit_code=3, retry_config=None, digest=None):
         """ Python wget.
         Download the filename at `url` into `file_name` and put it on `parent_dir`.
         On error log with the specified `error_level`, on fatal exit with `exit_code`.
@@ -450,6 +720,10 @@ class ScriptMixin(PlatformMixin):
                                          Defaults to `ERROR`
             retry_config (dict, optional): key-value pairs to be passed to
                                           `self.retry`. Defaults to `None`
+            digest (str, optional): known sha512 hex digest of the file. When
+                                    the download cache is enabled this lets a
+                                    cached copy be used without any request.
+                                    Defaults to `None`
 
         Returns:
             str: filename where the downloaded file was written to.
@@ -467,9 +741,13 @@ class ScriptMixin(PlatformMixin):
             if create_parent_dir:
                 self.mkdir_p(parent_dir, error_level=error_level)
         self.info("Downloading %s to %s" % (url, file_name))
-        status = self._retry_download_file(url, file_name, error_level, retry_config=retry_config)
+        status = self._retry_download_file(url, file_name, error_level,
+                                           retry_config=retry_config,
+                                           digest=digest)
         if status == file_name:
-            self.info("Downloaded %d bytes." % os.path.getsize(file_name))
+            num_bytes = os.path.getsize(file_name)
+            self.annotate_span(bytes=num_bytes)
+            self.info("Downloaded %d bytes." % num_bytes)
         return status
 
     def move(self, src, dest, log_level=INFO, error_level=ERROR,
@@ -514,7 +792,8 @@ class ScriptMixin(PlatformMixin):
         self.info("Chmoding %s to %s" % (path, str(oct(mode))))
         os.chmod(path, mode)
 
-    def copyfile(self, src, dest, log_level=INFO, error_level=ERROR, copystat=False, compress=False):
+    def copyfile(self, src, dest, log_level=INFO, error_level=ERROR, copystat=False, compress=False,
+                 link_mode='copy'):
         """ copy or compress `src` into `dest`.
 
         Args:
@@ -527,6 +806,8 @@ class ScriptMixin(PlatformMixin):
                                        Defaults to `False`.
             compress (bool, optional): whether or not to compress the destination file.
                                        Defaults to `False`.
+            link_mode (str, optional): 'copy', 'reflink' or 'hardlink'; see
+                                       mozharness.base.copying. Defaults to `copy`.
 
         Returns:
             int: -1 on error
@@ -548,8 +829,8 @@ class ScriptMixin(PlatformMixin):
         else:
             self.log("Copying %s to %s" % (src, dest), level=log_level)
             try:
-                shutil.copyfile(src, dest)
-            except (IOError, shutil.Error), e:
+                copy_file(src, dest, link_mode=link_mode, copystat=False)
+            except (IOError, OSError, shutil.Error), e:
                 self.log("Can't copy %s to %s: %s!" % (src, dest, str(e)),
                          level=error_level)
                 return -1
@@ -563,7 +844,7 @@ class ScriptMixin(PlatformMixin):
                 return -1
 
     def copytree(self, src, dest, overwrite='no_overwrite', log_level=INFO,
-                 error_level=ERROR):
+                 error_level=ERROR, link_mode='copy', max_workers=4):
         """ An implementation of `shutil.copytree` that allows for `dest` to exist
         and implements different overwrite levels:
         - 'no_overwrite' will keep all(any) existing files in destination tree
@@ -572,6 +853,10 @@ class ScriptMixin(PlatformMixin):
                                 src and destination tree
         - 'clobber' will replace the whole destination tree(clobber) if it exists
 
+        The tree is laid out first and the files are then copied
+        `max_workers` at a time, reflinked or hardlinked where `link_mode`
+        allows it.
+
         Args:
             src (str): directory path to move.
             dest (str): directory path where to move the content to.
@@ -579,6 +864,10 @@ class ScriptMixin(PlatformMixin):
             log_level (str, optional): log level to use for normal operation. Defaults to
                                       `INFO`
             error_level (str, optional): log level to use on error. Defaults to `ERROR`
+            link_mode (str, optional): 'copy', 'reflink' or 'hardlink'; see
+                                       mozharness.base.copying. Defaults to `copy`.
+            max_workers (int, optional): number of files to copy at once.
+                                         Defaults to 4.
 
         Returns:
             int: -1 on error
@@ -586,46 +875,70 @@ class ScriptMixin(PlatformMixin):
         """
 
         self.info('copying tree: %s to %s' % (src, dest))
+        stats = CopyStats()
         try:
-            if overwrite == 'clobber' or not os.path.exists(dest):
-                self.rmtree(dest)
-                shutil.copytree(src, dest)
-            elif overwrite == 'no_overwrite' or overwrite == 'overwrite_if_exists':
-                files = os.listdir(src)
-                for f in files:
-                    abs_src_f = os.path.join(src, f)
-                    abs_dest_f = os.path.join(dest, f)
-                    if not os.path.exists(abs_dest_f):
-                        if os.path.isdir(abs_src_f):
-                            self.mkdir_p(abs_dest_f)
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='clobber')
-                        else:
-                            shutil.copy2(abs_src_f, abs_dest_f)
-                    elif overwrite == 'no_overwrite':  # destination path exists
-                        if os.path.isdir(abs_src_f) and os.path.isdir(abs_dest_f):
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='no_overwrite')
-                        else:
-                            self.debug('ignoring path: %s as destination: \
-                                    %s exists' % (abs_src_f, abs_dest_f))
-                    else:  # overwrite == 'overwrite_if_exists' and destination exists
-                        self.debug('overwriting: %s with: %s' %
-                                   (abs_dest_f, abs_src_f))
-                        self.rmtree(abs_dest_f)
-
-                        if os.path.isdir(abs_src_f):
-                            self.mkdir_p(abs_dest_f)
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='overwrite_if_exists')
-                        else:
-                            shutil.copy2(abs_src_f, abs_dest_f)
-            else:
-                self.fatal("%s is not a valid argument for param overwrite" % (overwrite))
-        except (IOError, shutil.Error):
+            files, dirs = [], []
+            self._query_copytree_files(src, dest, overwrite, files, dirs)
+            copy_files(files, link_mode=link_mode, max_workers=max_workers,
+                       stats=stats)
+            # after the files, as adding them changes the directory times
+            for src_dir, dest_dir in reversed(dirs):
+                shutil.copystat(src_dir, dest_dir)
+        except (IOError, OSError, shutil.Error):
             self.exception("There was an error while copying %s to %s!" % (src, dest),
                            level=error_level)
             return -1
+        self.log(str(stats), level=log_level)
+
+    def _query_copytree_files(self, src, dest, overwrite, files, dirs):
+        """ copytree() helper: create the directories of the tree and remove
+        whatever is being overwritten, appending the (src, dest) pairs of the
+        files that still need copying to `files`, and of new directories to
+        `dirs`.
+        """
+        if overwrite == 'clobber' or not os.path.exists(dest):
+            self.rmtree(dest)
+            # symlinks are followed, like shutil.copytree(symlinks=False)
+            for root, dir_names, file_names in os.walk(src, followlinks=True):
+                dest_root = dest
+                if root != src:
+                    dest_root = os.path.join(dest, os.path.relpath(root, src))
+                os.makedirs(dest_root)
+                dirs.append((root, dest_root))
+                for f in file_names:
+                    files.append((os.path.join(root, f),
+                                  os.path.join(dest_root, f)))
+        elif overwrite == 'no_overwrite' or overwrite == 'overwrite_if_exists':
+            for f in os.listdir(src):
+                abs_src_f = os.path.join(src, f)
+                abs_dest_f = os.path.join(dest, f)
+                if not os.path.exists(abs_dest_f):
+                    if os.path.isdir(abs_src_f):
+                        self._query_copytree_files(abs_src_f, abs_dest_f,
+                                                   'clobber', files, dirs)
+                    else:
+                        files.append((abs_src_f, abs_dest_f))
+                elif overwrite == 'no_overwrite':  # destination path exists
+                    if os.path.isdir(abs_src_f) and os.path.isdir(abs_dest_f):
+                        self._query_copytree_files(abs_src_f, abs_dest_f,
+                                                   'no_overwrite', files, dirs)
+                    else:
+                        self.debug('ignoring path: %s as destination: \
+                                %s exists' % (abs_src_f, abs_dest_f))
+                else:  # overwrite == 'overwrite_if_exists' and destination exists
+                    self.debug('overwriting: %s with: %s' %
+                               (abs_dest_f, abs_src_f))
+                    self.rmtree(abs_dest_f)
+
+                    if os.path.isdir(abs_src_f):
+                        self.mkdir_p(abs_dest_f)
+                        self._query_copytree_files(abs_src_f, abs_dest_f,
+                                                   'overwrite_if_exists',
+                                                   files, dirs)
+                    else:
+                        files.append((abs_src_f, abs_dest_f))
+        else:
+            self.fatal("%s is not a valid argument for param overwrite" % (overwrite))
 
     def write_to_file(self, file_path, contents, verbose=True,
                       open_mode='w', create_parent_dir=False,
@@ -769,6 +1082,31 @@ class ScriptMixin(PlatformMixin):
                     return exe_file
         return None
 
+    # Tracing {{{2
+    def trace_span(self, name, category, **args):
+        """ Context manager recording the work done inside it as a span:
+        its start, duration and parent span, plus `args`. See
+        mozharness.base.tracing.
+
+        Args:
+            name (str | list | callable): what's being done, e.g. a command.
+            category (str): kind of work, e.g. 'action' or 'command'.
+            **args: extra information to record with the span.
+
+        Yields:
+            Span: the span, or None if there's nothing to record it.
+        """
+        if self._tracer is None:
+            return null_span()
+        return self._tracer.span(name, category, **args)
+
+    def annotate_span(self, **args):
+        """ Record `args` (exit status, bytes transferred, ...) with the
+        innermost open span.
+        """
+        if self._tracer is not None:
+            self._tracer.annotate(**args)
+
     # More complex commands {{{2
     def retry(self, action, attempts=None, sleeptime=60, max_sleeptime=5 * 60,
               retry_exceptions=(Exception, ), good_statuses=None, cleanup=None,
@@ -827,16 +1165,19 @@ class ScriptMixin(PlatformMixin):
         while n <= attempts:
             retry = False
             n += 1
-            try:
-                self.log("retry: Calling %s with args: %s, kwargs: %s, attempt #%d" %
-                         (action.__name__, str(args), str(kwargs), n), level=log_level)
-                status = action(*args, **kwargs)
-                if good_statuses and status not in good_statuses:
+            with self.trace_span(action, 'retry', attempt=n):
+                try:
+                    self.log("retry: Calling %s with args: %s, kwargs: %s, attempt #%d" %
+                             (action.__name__, str(args), str(kwargs), n), level=log_level)
+                    status = action(*args, **kwargs)
+                    if good_statuses and status not in good_statuses:
+                        retry = True
+                except retry_exceptions, e:
                     retry = True
-            except retry_exceptions, e:
-                retry = True
-                error_message = "%s\nCaught exception: %s" % (error_message, str(e))
-                self.log('retry: attempt #%d caught exception: %s' % (n, str(e)), level=INFO)
+                    error_message = "%s\nCaught exception: %s" % (error_message, str(e))
+                    self.log('retry: attempt #%d caught exception: %s' % (n, str(e)), level=INFO)
+                    self.annotate_span(error=e.__class__.__name__)
+                self.annotate_span(success=not retry)
 
             if not retry:
                 return status
@@ -991,6 +1332,7 @@ class ScriptMixin(PlatformMixin):
             self.log("Unknown return_type type %s requested in query_exe!" % return_type, level=error_level)
         return exe
 
+    @traced('command', 'command')
     def run_command(self, command, cwd=None, error_list=None,
                     halt_on_failure=False, success_codes=None,
                     env=None, partial_env=None, return_type='status',
@@ -998,14 +1340,14 @@ class ScriptMixin(PlatformMixin):
                     output_timeout=None, fatal_exit_code=2,
                     error_level=ERROR, **kwargs):
         """Run a command, with logging and error parsing.
-        TODO: context_lines
 
         error_list example:
         [{'regex': re.compile('^Error: LOL J/K'), level=IGNORE},
-         {'regex': re.compile('^Error:'), level=ERROR, contextLines='5:5'},
-         {'substr': 'THE WORLD IS ENDING', level=FATAL, contextLines='20:'}
+         {'regex': re.compile('^Error:'), level=ERROR, context_lines='5:5'},
+         {'substr': 'THE WORLD IS ENDING', level=FATAL, context_lines='20:'}
         ]
-        (context_lines isn't written yet)
+        context_lines='pre:post' also logs that many lines before and after
+        the match at the match's level; see OutputParser.
 
         Args:
             command (str | list | tuple): command or sequence of commands to
@@ -1090,6 +1432,7 @@ class ScriptMixin(PlatformMixin):
                 self.info("Calling %s with output_timeout %d" % (command, output_timeout))
                 p.run(outputTimeout=output_timeout)
                 p.wait()
+                parser.finish()
                 if p.timedOut:
                     self.log(
                         'timed out after %s seconds of no output' % output_timeout,
@@ -1099,16 +1442,11 @@ class ScriptMixin(PlatformMixin):
             else:
                 p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
                                      cwd=cwd, stderr=subprocess.STDOUT, env=env)
-                loop = True
-                while loop:
-                    if p.poll() is not None:
-                        """Avoid losing the final lines of the log?"""
-                        loop = False
-                    while True:
-                        line = p.stdout.readline()
-                        if not line:
-                            break
-                        parser.add_lines(line)
+                pump = OutputPump()
+                pump.add_stream(p.stdout, parser.add_lines)
+                pump.run()
+                p.wait()
+                parser.finish()
                 returncode = p.returncode
         except OSError, e:
             level = error_level
@@ -1116,8 +1454,10 @@ class ScriptMixin(PlatformMixin):
                 level = FATAL
             self.log('caught OS error %s: %s while running %s' % (e.errno,
                      e.strerror, command), level=level)
+            self.annotate_span(error='OSError')
             return -1
 
+        self.annotate_span(exit_status=returncode)
         return_level = INFO
         if returncode not in success_codes:
             return_level = error_level
@@ -1144,13 +1484,83 @@ class ScriptMixin(PlatformMixin):
             return parser.num_errors
         return returncode
 
+    def run_commands_parallel(self, commands, max_workers=4,
+                              halt_on_failure=False, fatal_exit_code=2,
+                              **kwargs):
+        """Run several commands at once, each through run_command.
+
+        Every command gets its own OutputParser (unless it passes
+        `output_parser`), and its log lines are prefixed with its name so
+        the interleaved output can be followed.
+
+        commands example:
+        [{'command': ['hg', 'pull'], 'cwd': 'repo1', 'name': 'repo1'},
+         {'command': ['hg', 'pull'], 'cwd': 'repo2', 'name': 'repo2',
+          'error_list': HgErrorList}]
+
+        Args:
+            commands (list): dicts holding `command` and any other
+              run_command arguments for that command, plus an optional
+              `name` for its log prefix (defaults to its index).
+            max_workers (int, optional): how many commands to run at once.
+              Defaults to 4.
+            halt_on_failure (bool, optional): once a command exits with a code
+              not in its `success_codes`, or its output matches an error in
+              its `error_list`, start no more commands, and call `self.fatal`
+              once the running ones have finished. Defaults to False.
+            fatal_exit_code (int, optional): exit code to use for that
+              `self.fatal`. Defaults to 2.
+            **kwargs: run_command arguments shared by every command.
+
+        Returns:
+            list: the return code of each command, in the order given; -1 if
+              it couldn't be started, None if it was skipped because of
+              `halt_on_failure`.
+        """
+        failures = []
+
+        def _run(item):
+            index, spec = item
+            if halt_on_failure and failures:
+                return None
+            run_kwargs = dict(kwargs)
+            run_kwargs.update(spec)
+            name = run_kwargs.pop('name', str(index))
+            parser = run_kwargs.get('output_parser')
+            if parser is None:
+                parser = OutputParser(config=self.config, log_obj=self.log_obj,
+                                      error_list=run_kwargs.get('error_list'))
+            run_kwargs.update(output_parser=parser, return_type='status',
+                              halt_on_failure=False)
+            success_codes = run_kwargs.get('success_codes') or [0]
+            log_prefix(name)
+            try:
+                returncode = self.run_command(**run_kwargs)
+            finally:
+                log_prefix(None)
+            if returncode not in success_codes or parser.num_errors:
+                failures.append(name)
+            return returncode
+
+        self.info("Running %d commands, %d at a time." %
+                  (len(commands), max_workers))
+        returncodes = run_in_parallel(_run, list(enumerate(commands)),
+                                      max_workers=max_workers)
+        if halt_on_failure and failures:
+            self.return_code = fatal_exit_code
+            self.fatal("Halting on failure while running %s" %
+                       ', '.join(failures), exit_code=fatal_exit_code)
+        return returncodes
+
+    @traced('command', 'command')
     def get_output_from_command(self, command, cwd=None,
                                 halt_on_failure=False, env=None,
                                 silent=False, log_level=INFO,
                                 tmpfile_base_path='tmpfile',
                                 return_type='output', save_tmpfiles=False,
                                 throw_exception=False, fatal_exit_code=2,
-                                ignore_errors=False, success_codes=None):
+                                ignore_errors=False, success_codes=None,
+                                output_limit=None):
         """Similar to run_command, but where run_command is an
         os.system(command) analog, get_output_from_command is a `command`
         analog.
@@ -1161,7 +1571,6 @@ class ScriptMixin(PlatformMixin):
         TODO: binary mode? silent is kinda like that.
         TODO: since p.wait() can take a long time, optionally log something
         every N seconds?
-        TODO: optionally only keep the first or last (N) line(s) of output?
         TODO: optionally only return the tmp_stdout_filename?
 
         ignore_errors=True is for the case where a command might produce standard
@@ -1197,6 +1606,9 @@ class ScriptMixin(PlatformMixin):
               level to `ERROR` for the output of stderr. Defaults to False.
             success_codes (int, optional): numeric value to compare against
               the command return value.
+            output_limit (int, optional): if set, only the first and last
+              `output_limit` / 2 lines of stdout and stderr are kept in
+              memory, logged and returned. Defaults to None (keep everything).
 
         Returns:
             None: if the cwd is not a directory.
@@ -1225,41 +1637,61 @@ class ScriptMixin(PlatformMixin):
         if success_codes is None:
             success_codes = [0]
 
-        # TODO probably some more elegant solution than 2 similar passes
-        try:
-            tmp_stdout = open(tmp_stdout_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stdout_filename +
-                     self.exception(), level=level)
-            return None
-        try:
-            tmp_stderr = open(tmp_stderr_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stderr_filename +
-                     self.exception(), level=level)
-            return None
+        # The output is only written to disk if the caller wants the files.
+        use_tmpfiles = save_tmpfiles or return_type != 'output'
+        if use_tmpfiles:
+            try:
+                tmp_stdout = open(tmp_stdout_filename, 'w')
+            except IOError:
+                level = ERROR
+                if halt_on_failure:
+                    level = FATAL
+                self.log("Can't open %s for writing!" % tmp_stdout_filename +
+                         self.exception(), level=level)
+                return None
+            try:
+                tmp_stderr = open(tmp_stderr_filename, 'w')
+            except IOError:
+                level = ERROR
+                if halt_on_failure:
+                    level = FATAL
+                self.log("Can't open %s for writing!" % tmp_stderr_filename +
+                         self.exception(), level=level)
+                return None
+            # XXX: changed from self.debug to self.log due to this error:
+            #      TypeError: debug() takes exactly 1 argument (2 given)
+            self.log("Temporary files: %s and %s" % (tmp_stdout_filename, tmp_stderr_filename), level=DEBUG)
         shell = True
         if isinstance(command, list):
             shell = False
-        p = subprocess.Popen(command, shell=shell, stdout=tmp_stdout,
-                             cwd=cwd, stderr=tmp_stderr, env=env)
-        # XXX: changed from self.debug to self.log due to this error:
-        #      TypeError: debug() takes exactly 1 argument (2 given)
-        self.log("Temporary files: %s and %s" % (tmp_stdout_filename, tmp_stderr_filename), level=DEBUG)
+        stdout_lines = HeadTailBuffer(output_limit)
+        stderr_lines = HeadTailBuffer(output_limit)
+
+        def _collect(lines, fh):
+            def collect(line):
+                lines.append(line)
+                if fh:
+                    fh.write(line)
+            return collect
+
+        p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                             cwd=cwd, stderr=subprocess.PIPE, env=env)
+        pump = OutputPump()
+        pump.add_stream(p.stdout, _collect(stdout_lines, tmp_stdout))
+        pump.add_stream(p.stderr, _collect(stderr_lines, tmp_stderr))
+        pump.run()
         p.wait()
-        tmp_stdout.close()
-        tmp_stderr.close()
+        self.annotate_span(exit_status=p.returncode)
+        if use_tmpfiles:
+            tmp_stdout.close()
+            tmp_stderr.close()
+        if stdout_lines.num_omitted or stderr_lines.num_omitted:
+            self.info("Kept the first and last %d lines of output only." %
+                      (output_limit / 2))
         return_level = DEBUG
         output = None
-        if os.path.exists(tmp_stdout_filename) and os.path.getsize(tmp_stdout_filename):
-            output = self.read_from_file(tmp_stdout_filename,
-                                         verbose=False)
+        if stdout_lines:
+            output = ''.join(stdout_lines.lines())
             if not silent:
                 self.log("Output received:", level=log_level)
                 output_lines = output.rstrip().splitlines()
@@ -1269,12 +1701,11 @@ class ScriptMixin(PlatformMixin):
                     line = line.decode("utf-8")
                     self.log(' %s' % line, level=log_level)
                 output = '\n'.join(output_lines)
-        if os.path.exists(tmp_stderr_filename) and os.path.getsize(tmp_stderr_filename):
+        if stderr_lines:
             if not ignore_errors:
                 return_level = ERROR
             self.log("Errors received:", level=return_level)
-            errors = self.read_from_file(tmp_stderr_filename,
-                                         verbose=False)
+            errors = ''.join(stderr_lines.lines())
             for line in errors.rstrip().splitlines():
                 if not line or line.isspace():
                     continue
@@ -1283,7 +1714,7 @@ class ScriptMixin(PlatformMixin):
         elif p.returncode not in success_codes and not ignore_errors:
             return_level = ERROR
         # Clean up.
-        if not save_tmpfiles:
+        if use_tmpfiles and not save_tmpfiles:
             self.rmtree(tmp_stderr_filename, log_level=DEBUG)
             self.rmtree(tmp_stdout_filename, log_level=DEBUG)
         if p.returncode and throw_exception:
@@ -1324,13 +1755,15 @@ class ScriptMixin(PlatformMixin):
                 self.log(msg, error_level=error_level)
         os.utime(file_name, times)
 
-    def unpack(self, filename, extract_to):
+    def unpack(self, filename, extract_to, target_unzip_dirs=None):
         '''
         This method allows us to extract a file regardless of its extension
 
         Args:
             filename (str): filename of the compressed file.
             extract_to (str): where to extract the compressed file.
+            target_unzip_dirs (list, optional): for zip files, `unzip`-style
+              patterns of the members to extract. Defaults to all members.
         '''
         # XXX: Make sure that filename has a extension of one of our supported file formats
         m = re.search('\.tar\.(bz2|gz)$', filename)
@@ -1341,10 +1774,116 @@ class ScriptMixin(PlatformMixin):
                 tar_cmd = "zxfv"
             command.extend([tar_cmd, filename, "-C", extract_to])
             self.run_command(command, halt_on_failure=True)
+        elif filename.endswith('.zip'):
+            with self.opened(filename, open_mode='rb', error_level=FATAL) as (fh, err):
+                self.unzip_stream(fh, extract_to,
+                                  target_unzip_dirs=target_unzip_dirs,
+                                  error_level=FATAL)
         else:
             # XXX implement
             pass
 
+    def unzip_stream(self, fileobj, extract_to, target_unzip_dirs=None,
+                     error_level=ERROR):
+        """ Extract a zip archive while reading it forwards from `fileobj`,
+        without writing the archive itself to disk.
+
+        Only the members matching `target_unzip_dirs` are written. If the
+        archive can't be read in a single forward pass, the remainder is
+        spooled to a temporary file (see `mozfile.extract_zip_stream`).
+
+        Args:
+            fileobj (file-like): object to read the archive from, e.g. an
+              HTTP response.
+            extract_to (str): directory to extract into.
+            target_unzip_dirs (list, optional): `unzip`-style patterns, e.g.
+              ['bin/*', 'mochitest/*']. Defaults to all members.
+            error_level (str, optional): log level name to use on error.
+              Defaults to `ERROR`.
+
+        Returns:
+            list: names of the extracted members.
+            None: if the archive can't be extracted.
+
+        Raises:
+            socket.error, urllib2.URLError, httplib.HTTPException: if reading
+              `fileobj` fails; these aren't logged.
+        """
+        members = None
+        if target_unzip_dirs:
+            def members(name):
+                return any(fnmatch.fnmatch(name, pattern)
+                           for pattern in target_unzip_dirs)
+        self.mkdir_p(extract_to)
+        try:
+            namelist = mozfile.extract_zip_stream(fileobj, extract_to,
+                                                  members=members)
+        except (socket.error, urllib2.URLError, httplib.HTTPException):
+            # reading `fileobj` failed, not the archive; leave it to the
+            # caller, e.g. download_unzip() retries these
+            raise
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError, OSError), e:
+            self.log("Can't extract zip to %s: %s" % (extract_to, str(e)),
+                     level=error_level)
+            return None
+        self.info("Extracted %d members to %s." % (len(namelist), extract_to))
+        return namelist
+
+    def _download_unzip_stream(self, url, extract_to, target_unzip_dirs=None):
+        """ Helper for download_unzip(); raises on network errors so
+        self.retry() can catch them.
+        """
+        if not (url.startswith("http") or url.startswith("file://")):
+            if not os.path.isfile(url):
+                self.fatal("The file %s does not exist" % url)
+            url = 'file://%s' % os.path.abspath(url)
+        f = self._urlopen(url, timeout=30)
+        try:
+            namelist = self.unzip_stream(f, extract_to,
+                                         target_unzip_dirs=target_unzip_dirs)
+        finally:
+            f.close()
+        if namelist is None:
+            raise urllib2.URLError("Unable to extract %s" % url)
+        return namelist
+
+    def download_unzip(self, url, extract_to, target_unzip_dirs=None,
+                       error_level=ERROR, retry_config=None):
+        """ Download the zip at `url` and extract it into `extract_to` as it
+        arrives, without keeping a copy of the archive.
+
+        Args:
+            url (str): URL of the zip archive.
+            extract_to (str): directory to extract into.
+            target_unzip_dirs (list, optional): `unzip`-style patterns of the
+              members to extract. Defaults to all members.
+            error_level (str, optional): log level to use in case an error
+              occurs. Defaults to `ERROR`.
+            retry_config (dict, optional): key-value pairs to be passed to
+              `self.retry`. Defaults to `None`.
+
+        Returns:
+            list: names of the extracted members.
+            unknown: on failure, `failure_status` is returned.
+        """
+        self.info("Downloading and extracting %s to %s" % (url, extract_to))
+        retry_args = dict(
+            failure_status=None,
+            retry_exceptions=(urllib2.HTTPError, urllib2.URLError,
+                              httplib.BadStatusLine, httplib.IncompleteRead,
+                              socket.timeout, socket.error),
+            error_message="Can't download and extract %s to %s!" % (url, extract_to),
+            error_level=error_level,
+        )
+        if retry_config:
+            retry_args.update(retry_config)
+        return self.retry(
+            self._download_unzip_stream,
+            args=(url, extract_to),
+            kwargs={'target_unzip_dirs': target_unzip_dirs},
+            **retry_args
+        )
+
 
 def PreScriptRun(func):
     """Decorator for methods that will be called before script execution.
@@ -1426,10 +1965,15 @@ def PostScriptAction(action=None):
 
 
 # BaseScript {{{1
+RESOURCE_USAGE_FILE = 'resource-usage.tsv'
+TRACE_FILE = 'trace.json'
+
+
 class BaseScript(ScriptMixin, LogMixin, object):
     def __init__(self, config_options=None, ConfigClass=BaseConfig,
                  default_log_level="info", **kwargs):
         self._return_code = 0
+        self._tracer = Tracer()
         super(BaseScript, self).__init__()
 
         # Collect decorated methods. We simply iterate over the attributes of
@@ -1466,6 +2010,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         self.log_obj = None
         self.abs_dirs = None
+        self._resource_sampler = None
         if config_options is None:
             config_options = []
         self.summary_list = []
@@ -1493,6 +2038,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
         self._config_lock()
 
         self.info("Run as %s" % rw_config.command_line)
+        self._start_resource_sampler()
         if self.config.get("dump_config_hierarchy"):
             # we only wish to dump and display what self.config is made up of,
             # against the current script + args, without actually running any
@@ -1501,6 +2047,43 @@ class BaseScript(ScriptMixin, LogMixin, object):
         if self.config.get("dump_config"):
             self.dump_config(exit_on_finish=True)
 
+    def _start_resource_sampler(self):
+        """Sample resource usage from here on, per action, into
+        RESOURCE_USAGE_FILE in the log dir; see mozharness.base.resources.
+
+        Unless config['sample_resources'] is False, or there's no /proc.
+        """
+        if not self.config.get('sample_resources', True) or \
+                not resource_sampling_supported():
+            return
+        dirs = self.query_abs_dirs()
+        try:
+            sampler = ResourceSampler(
+                os.path.join(dirs['abs_log_dir'], RESOURCE_USAGE_FILE),
+                interval=self.config.get('resource_sample_interval', 1.0),
+                disk_path=dirs['abs_work_dir'])
+            sampler.start()
+        except Exception:
+            self.warning("Unable to start resource sampling: %s" %
+                         traceback.format_exc())
+            return
+        self._resource_sampler = sampler
+
+    @PreScriptAction
+    def _sample_resources_pre_action(self, action):
+        if self._resource_sampler:
+            self._resource_sampler.begin_phase(action)
+
+    @PostScriptAction
+    def _sample_resources_post_action(self, action, success=None):
+        if self._resource_sampler:
+            self._resource_sampler.finish_phase(action)
+
+    @PostScriptRun
+    def _sample_resources_post_run(self):
+        if self._resource_sampler:
+            self._resource_sampler.stop()
+
     def _dump_config_hierarchy(self, cfg_files):
         """ interpret each config file used.
 
@@ -1596,6 +2179,10 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self.action_message("Skipping %s step." % action)
             return
 
+        with self.trace_span(action, 'action'):
+            self._run_action(action)
+
+    def _run_action(self, action):
         method_name = action.replace("-", "_")
         self.action_message("Running %s step." % action)
 
@@ -1607,7 +2194,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
             try:
                 self.info("Running pre-action listener: %s" % fn)
                 method = getattr(self, fn)
-                method(action)
+                with self.trace_span(fn, 'listener'):
+                    method(action)
             except Exception:
                 self.error("Exception during pre-action for %s: %s" % (
                     action, traceback.format_exc()))
@@ -1619,7 +2207,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     try:
                         self.info("Running post-action listener: %s" % fn)
                         method = getattr(self, fn)
-                        method(action, success=False)
+                        with self.trace_span(fn, 'listener'):
+                            method(action, success=False)
                     except Exception:
                         self.error("An additional exception occurred during "
                                    "post-action for %s: %s" % (action,
@@ -1636,6 +2225,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self._possibly_run_method("postflight_%s" % method_name)
             success = True
         finally:
+            self.annotate_span(success=success and self.return_code == 0)
             post_success = True
             for fn, target in self._listeners['post_action']:
                 if target is not None and target != action:
@@ -1644,7 +2234,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
                 try:
                     self.info("Running post-action listener: %s" % fn)
                     method = getattr(self, fn)
-                    method(action, success=success and self.return_code == 0)
+                    with self.trace_span(fn, 'listener'):
+                        method(action, success=success and self.return_code == 0)
                 except Exception:
                     post_success = False
                     self.error("Exception during post-action for %s: %s" % (
@@ -1672,7 +2263,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
             try:
                 self.info("Running pre-run listener: %s" % fn)
                 method = getattr(self, fn)
-                method()
+                with self.trace_span(fn, 'listener'):
+                    method()
             except Exception:
                 self.error("Exception during pre-run listener: %s" %
                            traceback.format_exc())
@@ -1699,11 +2291,13 @@ class BaseScript(ScriptMixin, LogMixin, object):
                 try:
                     self.info("Running post-run listener: %s" % fn)
                     method = getattr(self, fn)
-                    method()
+                    with self.trace_span(fn, 'listener'):
+                        method()
                 except Exception:
                     post_success = False
                     self.error("Exception during post-run listener: %s" %
                                traceback.format_exc())
+            self.write_trace()
 
             if not post_success:
                 self.fatal("Aborting due to failure in post-run listener.")
@@ -1719,12 +2313,30 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self.warning("returning nonzero exit status %d" % rc)
         sys.exit(rc)
 
+    def write_trace(self, file_path=None):
+        """Write the spans recorded so far as a Chrome trace-event file,
+        TRACE_FILE in the upload dir by default; see mozharness.base.tracing.
+        """
+        if file_path is None:
+            file_path = os.path.join(self.query_abs_dirs()['abs_upload_dir'],
+                                     TRACE_FILE)
+        self.info("Writing trace of %d spans to %s" %
+                  (len(self._tracer.spans), file_path))
+        try:
+            self.mkdir_p(os.path.dirname(file_path))
+            self._tracer.write(file_path)
+        except (IOError, OSError), e:
+            self.warning("Can't write trace to %s: %s" % (file_path, str(e)))
+            return None
+        return file_path
+
     def clobber(self):
         """
         Delete the working directory
         """
         dirs = self.query_abs_dirs()
-        self.rmtree(dirs['abs_work_dir'], error_level=FATAL)
+        self.rmtree(dirs['abs_work_dir'], error_level=FATAL,
+                    deferred=self.config.get('deferred_delete', False))
 
     def query_abs_dirs(self):
         """We want to be able to determine where all the important things
@@ -1801,6 +2413,11 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         I'd like to revisit how to do this in a prettier fashion.
         """
+        # self.download_cache is only set once a download has used it;
+        # query_download_cache() would create the cache dir
+        download_cache = self.download_cache
+        if download_cache and (download_cache.hits or download_cache.misses):
+            self.add_summary(download_cache.query_summary())
         self.action_message("%s summary:" % self.__class__.__name__)
         if self.summary_list:
             for item in self.summary_list:
@@ -1810,6 +2427,12 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     """log is closed; print as a default. Ran into this
                     when calling from __del__()"""
                     print "### Log is closed! (%s)" % item['message']
+        slowest = self._tracer.slowest(self.config.get('trace_summary_spans', 10))
+        if slowest:
+            self.info("Slowest steps:")
+            for span in slowest:
+                self.info("%8.1fs %-8s %s" % (span.duration, span.category,
+                                              span.name))
 
     def add_summary(self, message, level=INFO):
         self.summary_list.append({'message': message, 'level': level})
@@ -1908,14 +2531,28 @@ class BaseScript(ScriptMixin, LogMixin, object):
             return None
 
     def file_sha512sum(self, file_path):
-        bs = 65536
-        hasher = hashlib.sha512()
-        with open(file_path, 'rb') as fh:
-            buf = fh.read(bs)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = fh.read(bs)
-        return hasher.hexdigest()
+        return file_digests(file_path)['sha512']
+
+    def query_files_digests(self, file_paths, algorithms=('sha512', ),
+                            max_workers=4):
+        """Hash several files at once, reading each only once for all of
+        `algorithms`. Digests are remembered for the rest of the run, so
+        asking again about an unchanged file is free.
+
+        Args:
+            file_paths (list): files to hash.
+            algorithms (tuple, optional): hashlib algorithm names. Defaults
+              to ('sha512', ).
+            max_workers (int, optional): how many files to hash at once.
+              Defaults to 4.
+
+        Returns:
+            dict: file path to a dict of algorithm name to hex digest.
+        """
+        self.info("Hashing %d files (%s)." % (len(file_paths),
+                                               ', '.join(algorithms)))
+        return files_digests(file_paths, algorithms=algorithms,
+                             max_workers=max_workers)
 
     @property
     def return_code(self):
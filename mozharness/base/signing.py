@@ -8,12 +8,12 @@
 """
 
 import getpass
-import hashlib
 import os
 import re
 import subprocess
 
 from mozharness.base.errors import JarsignerErrorList, ZipErrorList, ZipalignErrorList
+from mozharness.base.hashing import file_digests
 from mozharness.base.log import OutputParser, IGNORE, DEBUG, INFO, ERROR, FATAL
 
 UnsignApkErrorList = [{
@@ -41,14 +41,9 @@ class BaseSigningMixin(object):
         self.info(" %s" % str(length))
         return length
 
-    # TODO this should be parallelized with the to-be-written BaseHelper!
     def query_sha512sum(self, file_path):
         self.info("Determining sha512sum for %s" % file_path)
-        m = hashlib.sha512()
-        contents = self.read_from_file(file_path, verbose=False,
-                                       open_mode='rb')
-        m.update(contents)
-        sha512 = m.hexdigest()
+        sha512 = file_digests(file_path)['sha512']
         self.info(" %s" % sha512)
         return sha512
 
@@ -135,6 +130,7 @@ class AndroidSigningMixin(object):
                 loop = False
             for line in p.stdout:
                 parser.add_lines(line)
+        parser.finish()
         if parser.num_errors:
             self.log("(failure)", level=error_level)
         else:
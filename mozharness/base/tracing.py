@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Structured timing of what a script spends its time on.
+
+A Tracer records spans: named, timed pieces of work (an action, a listener,
+a command, a download, a retry attempt), each with the span it happened
+inside of as its parent, and whatever arguments (exit status, bytes) the
+code doing the work annotates it with.
+
+The spans can be written out in the Chrome trace event format, which
+chrome://tracing and Perfetto display as a timeline, and which is plain
+JSON for anything aggregating over many jobs: every event has a `name`,
+category (`cat`), start (`ts`) and duration (`dur`) in microseconds, and
+`args` including its `id` and its `parent`'s id.
+"""
+
+from contextlib import contextmanager
+import functools
+import itertools
+import os
+import subprocess
+import threading
+import time
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+MAX_NAME_LENGTH = 200
+
+
+class Span(object):
+    def __init__(self, id, parent_id, name, category, tid, args):
+        self.id = id
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.tid = tid
+        self.args = args
+        self.start = time.time()
+        self.duration = None
+
+    def to_event(self, pid):
+        args = dict(self.args)
+        args['id'] = self.id
+        args['parent'] = self.parent_id
+        return {
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': int(self.start * 1000000),
+            'dur': int(self.duration * 1000000),
+            'pid': pid,
+            'tid': self.tid,
+            'args': args,
+        }
+
+
+class Tracer(object):
+    """Records spans.  Thread safe.
+
+    Spans nest per thread.  A span started on a thread with nothing open,
+    like a worker of run_in_parallel(), gets the span currently open on the
+    thread that created the Tracer as its parent.
+    """
+    def __init__(self):
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._stacks = {}
+        self._main_thread = threading.current_thread().ident
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        ident = threading.current_thread().ident
+        stack = self._stacks.get(ident)
+        if stack is None:
+            stack = self._stacks[ident] = []
+        return stack
+
+    def current(self):
+        """Return the innermost span open on this thread, if any."""
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        main_stack = self._stacks.get(self._main_thread)
+        if main_stack:
+            return main_stack[-1]
+        return None
+
+    @contextmanager
+    def span(self, name, category, **args):
+        parent = self.current()
+        with self._lock:
+            span_id = next(self._ids)
+        span = Span(span_id, parent and parent.id, name_for(name), category,
+                    threading.current_thread().ident, args)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException, e:
+            # SystemExit included: that's how fatal() ends an action
+            span.args.setdefault('error', e.__class__.__name__)
+            raise
+        finally:
+            span.duration = time.time() - span.start
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def annotate(self, **args):
+        """Add `args` to the innermost open span on this thread."""
+        span = self.current()
+        if span:
+            span.args.update(args)
+
+    def slowest(self, num=10):
+        """Return the `num` longest finished spans, longest first."""
+        with self._lock:
+            spans = list(self.spans)
+        return sorted(spans, key=lambda s: s.duration, reverse=True)[:num]
+
+    def to_chrome_trace(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        pid = os.getpid()
+        return {
+            'traceEvents': [s.to_event(pid) for s in spans],
+            'displayTimeUnit': 'ms',
+        }
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.to_chrome_trace(), fh, separators=(',', ':'))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def _string(obj):
+    if isinstance(obj, basestring):
+        return obj
+    return str(obj)
+
+
+def name_for(obj):
+    """Return a span name for a command, url or callable."""
+    if callable(obj):
+        obj = getattr(obj, '__name__', repr(obj))
+    elif isinstance(obj, (list, tuple)):
+        obj = subprocess.list2cmdline([_string(o) for o in obj])
+    name = _string(obj)
+    if len(name) > MAX_NAME_LENGTH:
+        name = name[:MAX_NAME_LENGTH - 3] + '...'
+    return name
+
+
+@contextmanager
+def null_span():
+    yield None
+
+
+def traced(category, name_arg):
+    """Decorator for ScriptMixin methods whose first argument, `name_arg`,
+    (a command, a url) names the work; each call is recorded as a span in
+    `category`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            name = args[0] if args else kwargs.get(name_arg)
+            with self.trace_span(name, category):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
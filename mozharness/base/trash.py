@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Deferred deletion of large directory trees.
+
+Deleting an objdir means unlinking hundreds of thousands of files, which
+can take minutes.  Renaming it away takes milliseconds.  move_to_trash()
+renames a tree into a trash directory on the same volume, and
+spawn_trash_emptier() starts a detached process that deletes the trash
+afterwards (optionally only until a given amount of space is free), so the
+job can carry on immediately.
+
+Anything left in the trash, because the emptier was killed or stopped
+early, is deleted by the next emptier to run, or by purge_builds.py, which
+empties trash directories before it deletes any build directories.
+
+Can be run directly to empty a trash directory:
+
+    python -m mozharness.base.trash [--min-free BYTES] TRASH_DIR
+"""
+
+import Queue
+import errno
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from mozharness.base.diskutils import DiskSize
+
+TRASH_DIR_NAME = '.mozharness-trash'
+
+
+def query_free_space(path):
+    """Return the free space, in bytes, on the volume holding `path`."""
+    return DiskSize.get_size(path, unit='bytes', log_level='debug').free
+
+
+def trash_dir_for(path):
+    """Return the trash directory to use for `path`.
+
+    This is TRASH_DIR_NAME in the topmost writable directory above `path`
+    that is still on the same volume, so every tree deleted from one volume
+    ends up in the same place, and a rename() into it never has to copy.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    dev = os.stat(parent).st_dev
+    while True:
+        up = os.path.dirname(parent)
+        if up == parent:
+            break
+        try:
+            if os.stat(up).st_dev != dev:
+                break
+        except OSError:
+            break
+        if not os.access(up, os.W_OK | os.X_OK):
+            break
+        parent = up
+    return os.path.join(parent, TRASH_DIR_NAME)
+
+
+def move_to_trash(path, trash_dir=None):
+    """Atomically move `path` into `trash_dir` (default: trash_dir_for(path)).
+
+    Returns:
+        str: the new location of the tree.
+
+    Raises:
+        OSError: if `path` can't be renamed into the trash, e.g. because it
+          is on another volume. Nothing has been moved in that case.
+    """
+    if trash_dir is None:
+        trash_dir = trash_dir_for(path)
+    try:
+        os.makedirs(trash_dir)
+    except OSError:
+        if not os.path.isdir(trash_dir):
+            raise
+    # A fresh directory per entry, so names never collide and the emptier
+    # can delete entries oldest first.
+    entry = tempfile.mkdtemp(dir=trash_dir,
+                             prefix='%d-' % int(time.time()))
+    dest = os.path.join(entry, os.path.basename(os.path.normpath(path)))
+    try:
+        os.rename(path, dest)
+    except OSError:
+        os.rmdir(entry)
+        raise
+    return dest
+
+
+def _long_path(path):
+    if os.name == 'nt':
+        # Let Windows delete paths longer than MAX_PATH.
+        return u'\\\\?\\' + os.path.abspath(path)
+    return path
+
+
+def _make_writable_and_retry(func, path, exc_info):
+    if exc_info[0] is OSError and exc_info[1].errno == errno.ENOENT:
+        # someone else (another emptier) got there first
+        return
+    try:
+        os.chmod(path, stat.S_IRWXU)
+        parent = os.path.dirname(path)
+        os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+        func(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        _make_writable_and_retry(os.remove, path, sys.exc_info())
+
+
+def _remove_dir(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        _make_writable_and_retry(os.rmdir, path, sys.exc_info())
+
+
+def remove_tree(path, max_workers=4, done=None):
+    """Delete the tree at `path` with `max_workers` walker threads.
+
+    Unlinking is mostly waiting on the filesystem, so several walkers
+    working through different directories of a large tree get it deleted
+    much faster than one.  The walkers unlink every file, then the emptied
+    directories are removed deepest first.
+
+    Args:
+        path (str): tree to delete.
+        max_workers (int, optional): number of walkers. Defaults to 4.
+        done (callable, optional): checked before each directory is
+          emptied; once it returns True the rest of the tree is left alone.
+
+    Returns:
+        bool: True if the tree was deleted completely.
+    """
+    path = _long_path(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        if os.path.lexists(path):
+            _remove_file(path)
+        return True
+
+    pending = Queue.Queue()
+    walked = []
+    errors = []
+    stopped = []
+
+    def walk(d):
+        try:
+            names = os.listdir(d)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            if e.errno != errno.EACCES:
+                raise
+            os.chmod(d, os.stat(d).st_mode | stat.S_IRWXU)
+            names = os.listdir(d)
+        walked.append(d)
+        for name in names:
+            full_name = os.path.join(d, name)
+            if os.path.isdir(full_name) and not os.path.islink(full_name):
+                pending.put(full_name)
+            else:
+                _remove_file(full_name)
+
+    def worker():
+        while True:
+            d = pending.get()
+            try:
+                if d is None:
+                    return
+                if stopped or errors:
+                    continue
+                if done and done():
+                    stopped.append(True)
+                    continue
+                walk(d)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                pending.task_done()
+
+    pending.put(path)
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, max_workers))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    pending.join()
+    for t in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    if stopped:
+        return False
+    # children have longer paths than their parents
+    for d in sorted(walked, key=len, reverse=True):
+        _remove_dir(d)
+    return True
+
+
+def empty_trash(trash_dir, min_free=None, max_workers=4):
+    """Delete the contents of `trash_dir`, oldest first.
+
+    Args:
+        trash_dir (str): trash directory, as returned by trash_dir_for().
+        min_free (int, optional): stop once this many bytes are free on the
+          trash volume. By default everything is deleted.
+        max_workers (int, optional): number of parallel walkers.
+
+    Returns:
+        int: the number of trash entries deleted completely.
+    """
+    if not os.path.isdir(trash_dir):
+        return 0
+    done = None
+    if min_free:
+        done = lambda: query_free_space(trash_dir) >= min_free
+    num_removed = 0
+    for name in sorted(os.listdir(trash_dir)):
+        if done and done():
+            break
+        if remove_tree(os.path.join(trash_dir, name), max_workers=max_workers,
+                       done=done):
+            num_removed += 1
+    return num_removed
+
+
+def spawn_trash_emptier(trash_dir, min_free=None, max_workers=4):
+    """Start a detached process running empty_trash(trash_dir, ...).
+
+    The process outlives the caller, and doesn't hold on to its stdout or
+    stderr, so whatever is reading our output isn't kept waiting for it.
+
+    Returns:
+        subprocess.Popen: the emptier process.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    cmd = [sys.executable, '-m', 'mozharness.base.trash',
+           '--max-workers', str(max_workers)]
+    if min_free:
+        cmd.extend(['--min-free', str(int(min_free))])
+    cmd.append(trash_dir)
+    kwargs = {}
+    if os.name == 'nt':
+        DETACHED_PROCESS = 0x00000008
+        CREATE_NEW_PROCESS_GROUP = 0x00000200
+        kwargs['creationflags'] = DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['close_fds'] = True
+        kwargs['preexec_fn'] = os.setsid
+    devnull = open(os.devnull, 'r+')
+    try:
+        return subprocess.Popen(cmd, env=env, stdin=devnull, stdout=devnull,
+                                stderr=devnull, **kwargs)
+    finally:
+        devnull.close()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] TRASH_DIR")
+    parser.add_option('--min-free', dest='min_free', type='int',
+                      help='stop once this many bytes are free')
+    parser.add_option('--max-workers', dest='max_workers', type='int',
+                      default=4, help='number of parallel walkers')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Must specify one trash directory")
+    empty_trash(args[0], min_free=options.min_free,
+                max_workers=options.max_workers)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Reading, merging and searching git<->hg mapfiles.
+
+A mapfile has a "<git sha> <hg sha>" line per commit, sorted by hg sha
+(then git sha), which is how hg-git writes them and what mapper expects.
+
+Everything here streams over sorted mapfiles, so memory use stays flat
+however big they get:
+
+- read_mapfile() iterates over the (git sha, hg sha) pairs of a mapfile.
+- read_sorted() does the same for a mapfile that may not be sorted,
+  sorting it on disk if need be.
+- merge() merges sorted iterables of pairs, dropping duplicates.
+- difference() gives the pairs of one sorted iterable not in another.
+- write_mapfile() writes pairs to a mapfile.
+- MapFile looks up the git sha of an hg sha with a binary search over the
+  mmapped mapfile, and the hg sha of a git sha with one over a compact
+  index sorted by git sha, which it builds next to the mapfile the first
+  time it's needed.
+"""
+
+import binascii
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+
+# how many pairs to sort in memory at a time
+SORT_CHUNK_SIZE = 1000000
+
+INDEX_SUFFIX = '.gitidx'
+# magic, size and mtime of the mapfile indexed
+INDEX_HEADER = struct.Struct('>8sQd')
+INDEX_MAGIC = 'MAPIDX1\n'
+# binary git sha, offset of its line in the mapfile
+INDEX_RECORD = struct.Struct('>20sQ')
+
+
+class MapfileError(ValueError):
+    pass
+
+
+class UnsortedMapfileError(MapfileError):
+    pass
+
+
+# Streaming {{{1
+def read_mapfile(path, check_order=True):
+    """Iterate over the (git sha, hg sha) pairs in the mapfile `path`.
+
+    Raises:
+        MapfileError: for a line that isn't a pair of shas.
+        UnsortedMapfileError: for a line out of order, if `check_order`.
+    """
+    last_git = last_hg = ''
+    with open(path, 'rb') as fh:
+        for num, line in enumerate(fh, 1):
+            pair = line.split()
+            if len(pair) != 2:
+                raise MapfileError("%s:%d: not a mapping: %r" % (path, num, line))
+            git_sha, hg_sha = pair
+            if check_order:
+                if hg_sha <= last_hg and (hg_sha < last_hg or git_sha < last_git):
+                    raise UnsortedMapfileError("%s:%d: out of order" % (path, num))
+                last_git, last_hg = git_sha, hg_sha
+            yield git_sha, hg_sha
+
+
+def write_mapfile(path, pairs):
+    """Write `pairs` to the mapfile `path`, replacing it only once they're
+    all written.  Returns the number of pairs written.
+    """
+    count = 0
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            for git_sha, hg_sha in pairs:
+                fh.write('%s %s\n' % (git_sha, hg_sha))
+                count += 1
+    except:
+        # including the SystemExit of a fatal() while iterating over pairs
+        os.remove(tmp_path)
+        raise
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return count
+
+
+def _read_lines(fh):
+    with fh:
+        for line in fh:
+            yield line
+
+
+def _read_index_records(fh):
+    with fh:
+        while True:
+            record = fh.read(INDEX_RECORD.size)
+            if len(record) < INDEX_RECORD.size:
+                return
+            yield record
+
+
+def _sorted_records(records, read_run, chunk_size=SORT_CHUNK_SIZE):
+    """Sort string `records` on disk, `chunk_size` at a time, and iterate
+    over them in order.  read_run(fh) iterates over the records written to
+    `fh`.
+    """
+    runs = []
+    while True:
+        chunk = sorted(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        if not runs and len(chunk) < chunk_size:
+            # it all fit in memory
+            return iter(chunk)
+        run = tempfile.TemporaryFile()
+        run.write(''.join(chunk))
+        run.seek(0)
+        runs.append(run)
+        del chunk
+    return heapq.merge(*[read_run(fh) for fh in runs])
+
+
+def sort_pairs(pairs, chunk_size=SORT_CHUNK_SIZE):
+    """Iterate over `pairs` in mapfile order, sorting on disk rather than
+    in memory if there are more than `chunk_size` of them.
+    """
+    # these sort the way the pairs do, as a space sorts before any sha
+    records = ('%s %s\n' % (hg_sha, git_sha) for (git_sha, hg_sha) in pairs)
+    for record in _sorted_records(records, _read_lines, chunk_size):
+        hg_sha, git_sha = record.split()
+        yield git_sha, hg_sha
+
+
+def read_sorted(path, chunk_size=SORT_CHUNK_SIZE):
+    """Like read_mapfile(), but sort the mapfile `path` first if it isn't
+    already sorted.
+    """
+    try:
+        for pair in read_mapfile(path):
+            pass
+    except UnsortedMapfileError:
+        return sort_pairs(read_mapfile(path, check_order=False), chunk_size)
+    return read_mapfile(path)
+
+
+def _keyed(pairs, num):
+    for (git_sha, hg_sha) in pairs:
+        yield hg_sha, num, git_sha
+
+
+def merge(iterables, conflict=None):
+    """Merge sorted iterables of (git sha, hg sha) pairs into one sorted
+    iterable, with one pair per hg sha: the one from the first of
+    `iterables` to have one.
+
+    Args:
+        iterables (list): sorted iterables of pairs.
+        conflict (callable, optional): called with the pair kept and the
+          pair dropped when two pairs map an hg sha to different git shas.
+    """
+    last = None
+    keyed = [_keyed(pairs, num) for (num, pairs) in enumerate(iterables)]
+    for hg_sha, num, git_sha in heapq.merge(*keyed):
+        if last is not None and hg_sha == last[1]:
+            if git_sha != last[0] and conflict is not None:
+                conflict(last, (git_sha, hg_sha))
+            continue
+        last = (git_sha, hg_sha)
+        yield last
+
+
+def difference(pairs, other_pairs):
+    """Iterate over the pairs of sorted iterable `pairs` that aren't in
+    sorted iterable `other_pairs`.
+    """
+    other_pairs = iter(other_pairs)
+    other_git, other_hg = next(other_pairs, (None, None))
+    for pair in pairs:
+        git_sha, hg_sha = pair
+        while other_hg is not None and (other_hg < hg_sha or
+                                        (other_hg == hg_sha and other_git < git_sha)):
+            other_git, other_hg = next(other_pairs, (None, None))
+        if other_hg != hg_sha or other_git != git_sha:
+            yield pair
+
+
+# MapFile {{{1
+def _bisect_lines(buf, prefix, key_of):
+    """Return the offset of the first line of sorted `buf` whose
+    key_of(line) is at least `prefix`.
+    """
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # the line mid is in
+        line_start = buf.rfind('\n', lo, mid) + 1 or lo
+        line_end = buf.find('\n', line_start, hi)
+        if line_end < 0:
+            line_end = hi
+        if key_of(buf[line_start:line_end]) < prefix:
+            lo = line_end + 1
+        else:
+            hi = line_start
+    return lo
+
+
+def _hg_sha(line):
+    return line[line.find(' ') + 1:]
+
+
+class MapFile(object):
+    """A sorted mapfile, mmapped for lookups.
+
+    Lookups accept abbreviated shas, as `hg id` gives, and return the
+    first match.  Use as a context manager, or close() when done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, 'rb')
+        self.size = os.fstat(self._fh.fileno()).st_size
+        self._map = ''
+        if self.size:
+            self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = None
+        self._index_fh = None
+
+    def close(self):
+        for m in (self._map, self._index):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for fh in (self._fh, self._index_fh):
+            if fh is not None:
+                fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _line_at(self, offset):
+        end = self._map.find('\n', offset)
+        if end < 0:
+            end = self.size
+        return self._map[offset:end]
+
+    def git_sha(self, hg_sha):
+        """Return the git sha `hg_sha` maps to, or None."""
+        offset = _bisect_lines(self._map, hg_sha, _hg_sha)
+        if offset >= self.size:
+            return None
+        line = self._line_at(offset)
+        if not _hg_sha(line).startswith(hg_sha):
+            return None
+        return line.split()[0]
+
+    # index {{{2
+    @property
+    def index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    def _index_is_current(self):
+        try:
+            with open(self.index_path, 'rb') as fh:
+                header = INDEX_HEADER.unpack(fh.read(INDEX_HEADER.size))
+        except (IOError, OSError, struct.error):
+            return False
+        return header == self._index_header()
+
+    def _index_header(self):
+        return (INDEX_MAGIC, self.size, os.fstat(self._fh.fileno()).st_mtime)
+
+    def build_index(self):
+        """Write the index of git shas to index_path."""
+        def records():
+            offset = 0
+            for line in iter(self._fh.readline, ''):
+                yield INDEX_RECORD.pack(binascii.unhexlify(line[:40]), offset)
+                offset += len(line)
+        self._fh.seek(0)
+        tmp_path = '%s.tmp-%d' % (self.index_path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            fh.write(INDEX_HEADER.pack(*self._index_header()))
+            for record in _sorted_records(records(), _read_index_records):
+                fh.write(record)
+        if os.name == 'nt' and os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(tmp_path, self.index_path)
+
+    def _open_index(self):
+        if self._index is None:
+            if not self._index_is_current():
+                self.build_index()
+            self._index_fh = open(self.index_path, 'rb')
+            self._index = mmap.mmap(self._index_fh.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        return self._index
+
+    def hg_sha(self, git_sha):
+        """Return the hg sha `git_sha` maps to, or None, using the index."""
+        index = self._open_index()
+        num_records = (len(index) - INDEX_HEADER.size) // INDEX_RECORD.size
+        # unhexlify() needs whole bytes; the lowest sha with an odd length
+        # prefix ends in 0
+        prefix = binascii.unhexlify(git_sha + '0' * (len(git_sha) % 2))
+
+        def record(i):
+            start = INDEX_HEADER.size + i * INDEX_RECORD.size
+            return INDEX_RECORD.unpack(index[start:start + INDEX_RECORD.size])
+        lo, hi = 0, num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record(mid)[0] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == num_records:
+            return None
+        line = self._line_at(record(lo)[1])
+        git, hg = line.split()
+        return hg if git.startswith(git_sha) else None
@@ -383,6 +383,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
                 self.clone(repo, shared_repo)
         else:
             self.clone(repo, shared_repo)
+        self.stamp_dir_used(shared_repo, share=True)
 
         if os.path.exists(dest):
             try:
@@ -27,6 +27,7 @@ import sys
 from datetime import datetime
 import re
 from mozharness.base.config import BaseConfig, parse_config_file
+from mozharness.base.hashing import file_digests
 from mozharness.base.log import ERROR, OutputParser, FATAL
 from mozharness.base.script import PostScriptRun
 from mozharness.base.transfer import TransferMixin
@@ -1396,6 +1397,7 @@ or run without that action (ie: --no-{action})"
                          client_id,
                          access_token,
                          self.log_obj,
+                         max_uploads=self.config.get('taskcluster_max_uploads', 4),
                          )
 
         index = self.config.get('taskcluster_index', 'index.garbage.staging')
@@ -1470,18 +1472,23 @@ or run without that action (ie: --no-{action})"
         )
 
         # Also upload our mozharness log files
-        files.extend([os.path.join(self.log_obj.abs_log_dir, x) for x in self.log_obj.log_files.values()])
+        late_files = [os.path.join(self.log_obj.abs_log_dir, x) for x in self.log_obj.log_files.values()]
 
         # Also upload our buildprops.json file.
         dirs = self.query_abs_dirs()
-        files.extend([os.path.join(dirs['base_work_dir'], 'buildprops.json')])
-
+        late_files.append(os.path.join(dirs['base_work_dir'], 'buildprops.json'))
+
+        # Create an S3 artifact for each file that gets uploaded. We also
+        # check the uploaded file against the property conditions so that we
+        # can set the buildbot config with the correct URLs for package
+        # locations.
+        tc.create_artifacts(task, files)
+        # The uploads above (and below) keep logging, so the logs would
+        # grow while they're being sent; upload copies of them instead,
+        # once the rest are done.
+        tc.create_artifact_snapshots(task, late_files)
+        files.extend(late_files)
         for upload_file in files:
-            # Create an S3 artifact for each file that gets uploaded. We also
-            # check the uploaded file against the property conditions so that we
-            # can set the buildbot config with the correct URLs for package
-            # locations.
-            tc.create_artifact(task, upload_file)
             if upload_file.endswith(valid_extensions):
                 for prop, condition in property_conditions:
                     if condition(upload_file):
@@ -1518,13 +1525,12 @@ or run without that action (ie: --no-{action})"
             self.error("Can't determine filepath with cmd: %s" % (str(cmd),))
             return
 
-        cmd = [
-            self.query_exe('openssl'), 'dgst',
-            '-%s' % (c.get("hash_type", "sha512"),), file_path
-        ]
-        hash_prop = self.get_output_from_command(cmd, dirs['abs_work_dir'])
-        if not hash_prop:
-            self.log("undetermined hash_prop with cmd: %s" % (str(cmd),),
+        hash_type = c.get("hash_type", "sha512")
+        try:
+            hash_prop = file_digests(os.path.join(dirs['abs_work_dir'], file_path),
+                                     (hash_type, ))[hash_type]
+        except (IOError, OSError, ValueError), e:
+            self.log("undetermined hash_prop for %s: %s" % (file_path, str(e)),
                      level=error_level)
             self.log(error_msg, level=error_level)
             return
@@ -1535,7 +1541,7 @@ or run without that action (ie: --no-{action})"
                                    os.path.getsize(file_path),
                                    write_to_file=True)
         self.set_buildbot_property(prop_type + 'Hash',
-                                   hash_prop.strip().split(' ', 2)[1],
+                                   hash_prop,
                                    write_to_file=True)
 
     def _query_previous_buildid(self):
@@ -422,7 +422,8 @@ class GaiaMixin(object):
         self.copytree(
             os.path.join(os.path.dirname(self.binary_path)),
             b2g_dest,
-            overwrite='clobber'
+            overwrite='clobber',
+            link_mode='reflink'
         )
         # Ensure modified time is more recent than node_modules!
         self.run_command(['touch', '-c', b2g_dest])
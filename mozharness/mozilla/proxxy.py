@@ -50,7 +50,12 @@ class Proxxy(ScriptMixin, LogMixin):
         # just the 'proxxy' element
         # if configuration has no 'proxxy' section use the default
         # configuration instead
-        self.config = config.get('proxxy', self.PROXXY_CONFIG)
+        self.config = dict(config.get('proxxy', self.PROXXY_CONFIG))
+        # share the script's download cache and ranged download settings
+        for key in ('download_cache_dir', 'download_cache_max_size',
+                    'download_parallel_chunks', 'download_parallel_min_size'):
+            if key in config:
+                self.config[key] = config[key]
         self.log_obj = log_obj
 
     def get_proxies_for_url(self, url):
@@ -126,7 +131,7 @@ class Proxxy(ScriptMixin, LogMixin):
 
     def download_proxied_file(self, url, file_name, parent_dir=None,
                               create_parent_dir=True, error_level=ERROR,
-                              exit_code=3):
+                              exit_code=3, digest=None):
         """
         Wrapper around BaseScript.download_file that understands proxies
         retry dict is set to 3 attempts, sleeping time 30 seconds.
@@ -143,6 +148,8 @@ class Proxxy(ScriptMixin, LogMixin):
                     defaults to ERROR
                 exit_code (int, optional): return code to log if file_name
                     is not defined and it cannot be determined from the url
+                digest (str, optional): known sha512 hex digest of the file,
+                    passed on to download_file
             Returns:
                 string: file_name if the download has succeded, None in case of
                     error. In case of error, if error_level is set to FATAL,
@@ -156,7 +163,7 @@ class Proxxy(ScriptMixin, LogMixin):
             retval = self.download_file(
                 url, file_name=file_name, parent_dir=parent_dir,
                 create_parent_dir=create_parent_dir, error_level=ERROR,
-                exit_code=exit_code,
+                exit_code=exit_code, digest=digest,
                 retry_config=dict(
                     attempts=3,
                     sleeptime=30,
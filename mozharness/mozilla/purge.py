@@ -17,6 +17,7 @@ external_tools_path = os.path.join(
 )
 
 from mozharness.base.log import ERROR
+from mozharness.base.trash import trash_dir_for
 
 
 # PurgeMixin {{{1
@@ -62,6 +63,16 @@ class PurgeMixin(object):
         for s in skip:
             cmd.extend(['--not', s])
 
+        if c.get('purge_index'):
+            self.stamp_dir_used(dirs['base_work_dir'])
+            cmd.extend(['--index', c['purge_index']])
+
+        if c.get('deferred_delete'):
+            # Directories deleted only for being too old can go in the
+            # background; trees our clobbers left in the trash go first.
+            cmd.extend(['--background',
+                        '--trash-dir', trash_dir_for(dirs['abs_work_dir'])])
+
         cmd.extend(basedirs)
 
         # purge_builds.py can also clean up old shared hg repos if we set
@@ -105,6 +116,9 @@ class PurgeMixin(object):
         if periodic_clobber:
             cmd.extend(['-t', str(periodic_clobber)])
 
+        if c.get('deferred_delete'):
+            cmd.append('--background')
+
         cmd.extend([clobberer_url, branch, buildername, builddir, slave, master])
         error_list = [{
             'substr': 'Error contacting server', 'level': ERROR,
@@ -141,7 +155,7 @@ class PurgeMixin(object):
                 if always_clobber_dirs is None:
                     always_clobber_dirs = []
                 for path in always_clobber_dirs:
-                    self.rmtree(path)
+                    self.rmtree(path, deferred=c.get('deferred_delete', False))
             # run purge_builds / check clobberer
             self.purge_builds()
         else:
@@ -2,8 +2,12 @@
    client.
 """
 import os
+import shutil
+import tempfile
+import time
 from datetime import datetime, timedelta
 from mozharness.base.log import LogMixin
+from mozharness.base.parallel import run_in_parallel
 
 
 # Taskcluster {{{1
@@ -11,9 +15,14 @@ class Taskcluster(LogMixin):
     """
     Helper functions to report data to Taskcluster
     """
-    def __init__(self, branch, rank, client_id, access_token, log_obj):
+    upload_attempts = 5
+    upload_sleeptime = 10
+
+    def __init__(self, branch, rank, client_id, access_token, log_obj,
+                 max_uploads=4):
         self.rank = rank
         self.log_obj = log_obj
+        self.max_uploads = max_uploads
 
         # Try builds use a different set of credentials which have access to the
         # buildbot-try scope.
@@ -31,7 +40,15 @@ class Taskcluster(LogMixin):
         taskcluster.config['credentials']['accessToken'] = access_token
         self.taskcluster_queue = taskcluster.Queue()
         self.task_id = taskcluster.slugId()
-        self.put_file = taskcluster.utils.putFile
+
+        # requests comes with the taskcluster client. Uploads share one
+        # keep-alive connection pool, sized for the concurrent uploads.
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_uploads,
+                                                pool_maxsize=max_uploads)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def create_task(self, routes):
         curdate = datetime.utcnow()
@@ -72,6 +89,9 @@ class Taskcluster(LogMixin):
             })
 
     def create_artifact(self, task, filename):
+        """Create an S3 artifact for `filename` and upload it, retrying both
+        steps up to `upload_attempts` times.
+        """
         mime_types = {
             ".asc": "text/plain",
             ".checksums": "text/plain",
@@ -87,17 +107,67 @@ class Taskcluster(LogMixin):
 
         self.info("Uploading to S3: filename=%s mimetype=%s length=%s" % (filename, mime_type, content_length))
 
-        expiration = datetime.utcnow() + timedelta(weeks=52)
-        artifact = self.taskcluster_queue.createArtifact(
-            task['status']['taskId'],
-            task['status']['runs'][0]['runId'],
-            'public/build/%s' % os.path.basename(filename),
-            {
-                "storageType": "s3",
-                "expires": expiration,
-                "contentType": mime_type,
+        for attempt in range(1, self.upload_attempts + 1):
+            try:
+                # A fresh createArtifact call each time, in case the
+                # previous putUrl expired while we were failing.
+                expiration = datetime.utcnow() + timedelta(weeks=52)
+                artifact = self.taskcluster_queue.createArtifact(
+                    task['status']['taskId'],
+                    task['status']['runs'][0]['runId'],
+                    'public/build/%s' % os.path.basename(filename),
+                    {
+                        "storageType": "s3",
+                        "expires": expiration,
+                        "contentType": mime_type,
+                    })
+                self._put_file(filename, artifact['putUrl'], mime_type,
+                               content_length)
+                return
+            except Exception, e:
+                if attempt == self.upload_attempts:
+                    self.error("Failed to upload %s after %d attempts: %s" %
+                               (filename, attempt, str(e)))
+                    raise
+                sleeptime = self.upload_sleeptime * attempt
+                self.warning("Uploading %s failed: %s; retrying in %d seconds." %
+                             (filename, str(e), sleeptime))
+                time.sleep(sleeptime)
+
+    def _put_file(self, filename, put_url, mime_type, content_length):
+        """PUT `filename` to `put_url`, streaming it from disk."""
+        with open(filename, 'rb') as fh:
+            response = self.session.put(put_url, data=fh, headers={
+                'Content-Type': mime_type,
+                'Content-Length': str(content_length),
             })
-        self.put_file(filename, artifact['putUrl'], mime_type)
+        response.raise_for_status()
+
+    def create_artifacts(self, task, filenames):
+        """Create and upload artifacts for all of `filenames`, up to
+        `max_uploads` at a time. Each artifact is retried on its own; the
+        first one that still fails is raised once the uploads in flight
+        have finished, so only call report_completed() after this returns.
+        """
+        self.info("Uploading %d artifacts, %d at a time." %
+                  (len(filenames), self.max_uploads))
+        run_in_parallel(lambda filename: self.create_artifact(task, filename),
+                        filenames, max_workers=self.max_uploads)
+
+    def create_artifact_snapshots(self, task, filenames):
+        """Like create_artifacts(), but upload copies of `filenames` taken
+        now, for files that are still being written to, like our logs.
+        """
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            snapshots = []
+            for filename in filenames:
+                snapshot = os.path.join(snapshot_dir, os.path.basename(filename))
+                shutil.copyfile(filename, snapshot)
+                snapshots.append(snapshot)
+            self.create_artifacts(task, snapshots)
+        finally:
+            shutil.rmtree(snapshot_dir)
 
     def report_completed(self, task):
         self.taskcluster_queue.reportCompleted(
@@ -174,7 +174,8 @@ class GaiaTest(TestingMixin, MercurialScript, TransferMixin, GaiaMixin, BlobUplo
             self.proxxy = proxxy
         return self.proxxy
 
-    def _retry_download_file(self, url, file_name, error_level=FATAL, retry_config=None):
+    def _retry_download_file(self, url, file_name, error_level=FATAL, retry_config=None,
+                             digest=None):
         if self.config.get("bypass_download_cache"):
             n = 0
             # ignore retry_config in this case
@@ -198,6 +199,7 @@ class GaiaTest(TestingMixin, MercurialScript, TransferMixin, GaiaMixin, BlobUplo
         else:
             return super(GaiaTest, self)._retry_download_file(
                 url, file_name, error_level, retry_config=retry_config,
+                digest=digest,
             )
 
     def run_tests(self):
@@ -485,7 +485,7 @@ class Talos(TestingMixin, MercurialScript, BlobUploadMixin):
         # the apache server needs the talos directory (talos/talos)
         # to be in the webroot
         src_talos_webdir = os.path.join(self.talos_path, 'talos')
-        self.copytree(src_talos_webdir, talos_webdir)
+        self.copytree(src_talos_webdir, talos_webdir, link_mode='reflink')
 
         if c.get('use_talos_json'):
             if self.query_pagesets_url():
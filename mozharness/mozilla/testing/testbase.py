@@ -10,12 +10,15 @@ import os
 import platform
 import pprint
 import re
+import threading
+import time
 import urllib2
 import json
 
 from mozharness.base.config import ReadOnlyDict, parse_config_file
 from mozharness.base.errors import BaseErrorList
-from mozharness.base.log import FATAL, WARNING
+from mozharness.base.log import FATAL, INFO, WARNING
+from mozharness.base.parallel import run_in_parallel
 from mozharness.base.python import (
     ResourceMonitoringMixin,
     VirtualenvMixin,
@@ -82,6 +85,22 @@ testing_config_options = [
      "choices": ['ondemand', 'true'],
      "help": "Download and extract crash reporter symbols.",
       }],
+    [["--download-workers"],
+     {"action": "store",
+     "type": "int",
+     "dest": "download_workers",
+     "default": None,
+     "help": "Download the test packages, installer and symbols concurrently "
+             "on this many threads, extracting each archive as soon as it "
+             "has been downloaded.",
+      }],
+    [["--stream-extract"],
+     {"action": "store_true",
+     "dest": "stream_extract",
+     "default": False,
+     "help": "Extract test and symbols zips while they download, without "
+             "writing the archives to disk.",
+      }],
 ] + copy.deepcopy(virtualenv_config_options)
 
 
@@ -115,13 +134,14 @@ class TestingMixin(VirtualenvMixin, BuildbotMixin, ResourceMonitoringMixin, Tool
 
     def download_proxied_file(self, url, file_name=None, parent_dir=None,
                               create_parent_dir=True, error_level=FATAL,
-                              exit_code=3):
+                              exit_code=3, digest=None):
         proxxy = self._query_proxxy()
         return proxxy.download_proxied_file(url=url, file_name=file_name,
                                             parent_dir=parent_dir,
                                             create_parent_dir=create_parent_dir,
                                             error_level=error_level,
-                                            exit_code=exit_code)
+                                            exit_code=exit_code,
+                                            digest=digest)
 
     def download_file(self, *args, **kwargs):
         '''
@@ -240,7 +260,11 @@ class TestingMixin(VirtualenvMixin, BuildbotMixin, ResourceMonitoringMixin, Tool
             # This creates a password manager
             passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
             # Because we have put None at the start it will use this username/password combination from here on
-            passman.add_password(None, url, self.https_username, self.https_password)
+            if isinstance(url, urllib2.Request):
+                passman.add_password(None, url.get_full_url(),
+                                     self.https_username, self.https_password)
+            else:
+                passman.add_password(None, url, self.https_username, self.https_password)
             authhandler = urllib2.HTTPBasicAuthHandler(passman)
 
             return urllib2.build_opener(authhandler).open(url, **kwargs)
@@ -350,18 +374,6 @@ You can set this by:
                         "You are currently using version %s. Please update to at least 6.0.\n" \
                         "You can visit http://www.info-zip.org/UnZip.html" % version)
 
-    def _download_test_zip(self):
-        dirs = self.query_abs_dirs()
-        file_name = None
-        if self.test_zip_path:
-            file_name = self.test_zip_path
-        # try to use our proxxy servers
-        # create a proxxy object and get the binaries from it
-        source = self.download_file(self.test_url, file_name=file_name,
-                                    parent_dir=dirs['abs_work_dir'],
-                                    error_level=FATAL)
-        self.test_zip_path = os.path.realpath(source)
-
     def _read_packages_manifest(self):
         dirs = self.query_abs_dirs()
         source = self.download_file(self.test_packages_url,
@@ -379,7 +391,10 @@ You can set this by:
                   pprint.pformat(package_requirements))
         return package_requirements
 
-    def _download_test_packages(self, suite_categories, target_unzip_dirs):
+    def _query_test_packages(self, suite_categories, target_unzip_dirs):
+        """Return a list of (url, target_dir, unzip_dirs) tuples, one per
+        test package needed by `suite_categories`.
+        """
         # Some platforms define more suite categories/names than others.
         # This is a difference in the convention of the configs more than
         # to how these tests are run, so we pave over these differences here.
@@ -398,6 +413,7 @@ You can set this by:
                                     os.path.join(dirs['abs_work_dir'], 'tests'))
         self.mkdir_p(test_install_dir)
         package_requirements = self._read_packages_manifest()
+        packages = []
         for category in suite_categories:
             if category in package_requirements:
                 target_packages = package_requirements[category]
@@ -415,16 +431,44 @@ You can set this by:
                     unzip_dirs = None
                     target_dir = dirs['abs_test_bin_dir']
                 url = self.query_build_dir_url(file_name)
-                self._download_unzip(url, target_dir,
-                                     target_unzip_dirs=unzip_dirs)
+                packages.append((url, target_dir, unzip_dirs))
+        return packages
 
     def _download_unzip(self, url, parent_dir, target_unzip_dirs=None):
         """Generic download+unzip.
         This is hardcoded to halt on failure.
         We should probably change some other methods to call this."""
+        if self.config.get('stream_extract'):
+            self._stream_unzip(url, parent_dir, target_unzip_dirs=target_unzip_dirs)
+            return
         dirs = self.query_abs_dirs()
         zipfile = self.download_file(url, parent_dir=dirs['abs_work_dir'],
                                              error_level=FATAL)
+        self._unzip(zipfile, parent_dir, target_unzip_dirs=target_unzip_dirs)
+
+    def _stream_unzip(self, url, parent_dir, target_unzip_dirs=None):
+        """Download and extract `url` into `parent_dir` without keeping the
+        archive, trying the proxxy mirrors first like download_file().
+        This is hardcoded to halt on failure."""
+        urls = [url]
+        if not self.config.get("developer_mode"):
+            urls = self._query_proxxy().get_proxies_and_urls(urls)
+        for candidate in urls:
+            self.info("trying %s" % candidate)
+            namelist = self.download_unzip(candidate, parent_dir,
+                                           target_unzip_dirs=target_unzip_dirs,
+                                           retry_config=dict(
+                                               attempts=3,
+                                               sleeptime=30,
+                                               error_level=INFO,
+                                           ))
+            if namelist is not None:
+                return namelist
+        self.fatal("Failed to download and extract %s from all available URLs, aborting" % url,
+                   exit_code=3)
+
+    def _unzip(self, zipfile, parent_dir, target_unzip_dirs=None):
+        """Extract `zipfile` into `parent_dir`, halting on failure."""
         command = self.query_exe('unzip', return_type='list')
         command.extend(['-q', '-o', zipfile])
         if target_unzip_dirs:
@@ -433,24 +477,6 @@ You can set this by:
                          success_codes=[0, 11],
                          fatal_exit_code=3, output_timeout=1760)
 
-    def _extract_test_zip(self, target_unzip_dirs=None):
-        dirs = self.query_abs_dirs()
-        unzip = self.query_exe("unzip")
-        test_install_dir = dirs.get('abs_test_install_dir',
-                                    os.path.join(dirs['abs_work_dir'], 'tests'))
-        self.mkdir_p(test_install_dir)
-        # adding overwrite flag otherwise subprocess.Popen hangs on waiting for
-        # input in a hidden pipe whenever this action is run twice without
-        # clobber
-        unzip_cmd = [unzip, '-q', '-o', self.test_zip_path]
-        if target_unzip_dirs:
-            unzip_cmd.extend(target_unzip_dirs)
-        # TODO error_list
-        # unzip return code 11 is 'no matching files were found'
-        self.run_command(unzip_cmd, cwd=test_install_dir,
-                         halt_on_failure=True, success_codes=[0, 11],
-                         fatal_exit_code=3)
-
     def _read_tree_config(self):
         """Reads an in-tree config file"""
         dirs = self.query_abs_dirs()
@@ -512,35 +538,6 @@ You can set this by:
         self.info("Structured output parser in use for %s." % suite_category)
         return StructuredOutputParser(suite_category=suite_category, strict=strict, **kwargs)
 
-    def _download_installer(self):
-        file_name = None
-        if self.installer_path:
-            file_name = self.installer_path
-        dirs = self.query_abs_dirs()
-        source = self.download_file(self.installer_url,
-                                            file_name=file_name,
-                                            parent_dir=dirs['abs_work_dir'],
-                                            error_level=FATAL)
-        self.installer_path = os.path.realpath(source)
-        self.set_buildbot_property("build_url", self.installer_url, write_to_file=True)
-
-    def _download_and_extract_symbols(self):
-        dirs = self.query_abs_dirs()
-        self.symbols_url = self.query_symbols_url()
-        if self.config.get('download_symbols') == 'ondemand':
-            self.symbols_path = self.symbols_url
-            return
-        if not self.symbols_path:
-            self.symbols_path = os.path.join(dirs['abs_work_dir'], 'symbols')
-        self.mkdir_p(self.symbols_path)
-        source = self.download_file(self.symbols_url,
-                                            parent_dir=self.symbols_path,
-                                            error_level=FATAL)
-        self.set_buildbot_property("symbols_url", self.symbols_url,
-                                   write_to_file=True)
-        self.run_command(['unzip', '-q', source], cwd=self.symbols_path,
-                         halt_on_failure=True, fatal_exit_code=3)
-
     def download_and_extract(self, target_unzip_dirs=None, suite_categories=None):
         """
         download and extract test zip / download installer
@@ -556,16 +553,42 @@ You can set this by:
                 self.info("Replacing url %s -> %s" % (url, new_url))
                 setattr(self, attr, new_url)
 
-        if 'test_url' in self.config:
+        artifacts = self._query_download_artifacts(target_unzip_dirs=target_unzip_dirs,
+                                                   suite_categories=suite_categories)
+        if self.config.get('download_workers'):
+            self._pipelined_download_and_extract(artifacts)
+            return
+        results = [self._download_artifact(artifact) for artifact in artifacts]
+        self._record_downloads(artifacts, results)
+
+    def _query_download_artifacts(self, target_unzip_dirs=None, suite_categories=None):
+        """Return the artifacts download_and_extract() needs, as dicts of
+        kind, name, url, file_name and parent_dir to download to, and the
+        extract_to dir and unzip_dirs to extract them with, if any.
+        """
+        c = self.config
+        dirs = self.query_abs_dirs()
+        test_install_dir = dirs.get('abs_test_install_dir',
+                                    os.path.join(dirs['abs_work_dir'], 'tests'))
+        self.mkdir_p(test_install_dir)
+
+        artifacts = []
+        if 'test_url' in c:
             # A user has specified a test_url directly, any test_packages_url will
             # be ignored.
             if self.test_packages_url:
                 self.error('Test data will be downloaded from "%s", the specified test '
                            ' package data at "%s" will be ignored.' %
-                           (self.config('test_url'), self.test_packages_url))
-
-            self._download_test_zip()
-            self._extract_test_zip(target_unzip_dirs=target_unzip_dirs)
+                           (c['test_url'], self.test_packages_url))
+            artifacts.append({
+                'kind': 'test_zip',
+                'name': 'tests',
+                'url': self.test_url,
+                'file_name': self.test_zip_path,
+                'parent_dir': dirs['abs_work_dir'],
+                'extract_to': test_install_dir,
+                'unzip_dirs': target_unzip_dirs,
+            })
         else:
             if not self.test_packages_url:
                 # The caller intends to download harness specific packages, but doesn't know
@@ -573,14 +596,134 @@ You can set this by:
                 # test package manifest isn't set as a buildbot property, which is true
                 # for some self-serve jobs and platforms using parse_make_upload.
                 self.test_packages_url = self.query_build_dir_url('test_packages.json')
+            seen = set()
+            for url, target_dir, unzip_dirs in self._query_test_packages(
+                    suite_categories or ['common'], target_unzip_dirs):
+                if url in seen:
+                    continue
+                seen.add(url)
+                artifacts.append({
+                    'kind': 'test_package',
+                    'name': self.get_filename_from_url(url),
+                    'url': url,
+                    'file_name': None,
+                    'parent_dir': dirs['abs_work_dir'],
+                    'extract_to': target_dir,
+                    'unzip_dirs': unzip_dirs,
+                })
+        artifacts.append({
+            'kind': 'installer',
+            'name': 'installer',
+            'url': self.installer_url,
+            'file_name': self.installer_path,
+            'parent_dir': dirs['abs_work_dir'],
+            'extract_to': None,
+            'unzip_dirs': None,
+        })
+        if c.get('download_symbols'):
+            self.symbols_url = self.query_symbols_url()
+            if c['download_symbols'] == 'ondemand':
+                self.symbols_path = self.symbols_url
+            else:
+                if not self.symbols_path:
+                    self.symbols_path = os.path.join(dirs['abs_work_dir'], 'symbols')
+                self.mkdir_p(self.symbols_path)
+                artifacts.append({
+                    'kind': 'symbols',
+                    'name': 'symbols',
+                    'url': self.symbols_url,
+                    'file_name': None,
+                    'parent_dir': self.symbols_path,
+                    'extract_to': self.symbols_path,
+                    'unzip_dirs': None,
+                })
+        return artifacts
+
+    def _download_artifact(self, artifact, extract_lock=None):
+        """Download one of the _query_download_artifacts() and extract it,
+        halting on failure.
+
+        Returns:
+            tuple: the path it was saved to, or None if it was extracted
+              without being saved (stream_extract), and the download and
+              extract times.
+        """
+        start = time.time()
+        if artifact['extract_to'] and self.config.get('stream_extract'):
+            # Extraction overlaps the download itself, so there is no
+            # separate extract time or archive path to report.
+            self._stream_unzip(artifact['url'], artifact['extract_to'],
+                               target_unzip_dirs=artifact['unzip_dirs'])
+            download_time = time.time() - start
+            self.info("%s: downloaded and extracted in %.1fs" %
+                      (artifact['name'], download_time))
+            return (None, download_time, 0)
+        # try to use our proxxy servers
+        path = self.download_file(artifact['url'],
+                                  file_name=artifact['file_name'],
+                                  parent_dir=artifact['parent_dir'],
+                                  error_level=FATAL)
+        download_time = time.time() - start
+        extract_time = 0
+        if artifact['extract_to']:
+            if extract_lock is None:
+                extract_lock = threading.Lock()
+            with extract_lock:
+                start = time.time()
+                self._unzip(path, artifact['extract_to'],
+                            target_unzip_dirs=artifact['unzip_dirs'])
+                extract_time = time.time() - start
+        self.info("%s: downloaded in %.1fs, extracted in %.1fs" %
+                  (artifact['name'], download_time, extract_time))
+        return (os.path.realpath(path), download_time, extract_time)
+
+    def _record_downloads(self, artifacts, results):
+        """Remember where the _download_artifact() `results` were saved and
+        read the in-tree config they brought.
+        """
+        for artifact, (path, download_time, extract_time) in zip(artifacts, results):
+            if path is None:
+                # streamed; keep any configured path
+                continue
+            if artifact['kind'] == 'test_zip':
+                self.test_zip_path = path
+            elif artifact['kind'] == 'installer':
+                self.installer_path = path
+        self.set_buildbot_property("build_url", self.installer_url, write_to_file=True)
+        if self.config.get('download_symbols') and \
+                self.config['download_symbols'] != 'ondemand':
+            self.set_buildbot_property("symbols_url", self.symbols_url,
+                                       write_to_file=True)
+        self._read_tree_config()
 
-            suite_categories = suite_categories or ['common']
-            self._download_test_packages(suite_categories, target_unzip_dirs)
+    def _pipelined_download_and_extract(self, artifacts):
+        """Like the serial part of download_and_extract(), but fetch every
+        artifact concurrently on `download_workers` threads and extract each
+        archive as soon as its download finishes.
 
-        self._read_tree_config()
-        self._download_installer()
-        if self.config.get('download_symbols'):
-            self._download_and_extract_symbols()
+        Downloads are still FATAL on failure; the first failure stops any
+        artifacts that haven't started yet and exits from the main thread.
+        """
+        # Several archives may unpack into the same directory; only let one
+        # unzip run in each directory at a time.
+        extract_locks = dict((a['extract_to'], threading.Lock())
+                             for a in artifacts if a['extract_to'])
+
+        def _fetch(artifact):
+            return self._download_artifact(artifact,
+                                           extract_lock=extract_locks.get(artifact['extract_to']))
+
+        num_workers = self.config['download_workers']
+        self.info("Downloading %d artifacts with %d workers." %
+                  (len(artifacts), num_workers))
+        start = time.time()
+        results = run_in_parallel(_fetch, artifacts, max_workers=num_workers)
+        for artifact, (path, download_time, extract_time) in zip(artifacts, results):
+            self.add_summary("%s: downloaded in %.1fs, extracted in %.1fs" %
+                             (artifact['name'], download_time, extract_time))
+        self.add_summary("download-and-extract: %d artifacts in %.1fs" %
+                         (len(artifacts), time.time() - start))
+        self._record_downloads(artifacts, results)
 
     # create_virtualenv is in VirtualenvMixin.
 
@@ -11,12 +11,17 @@ type conversions, as well as many-to-many (l10n, build repos, etc.)
 """
 
 from copy import deepcopy
-import mmap
 import os
 import pprint
+import random
 import re
+import socket
+import subprocess
 import sys
+import threading
 import time
+import urllib2
+import urlparse
 
 try:
     import simplejson as json
@@ -33,12 +38,54 @@ external_tools_path = os.path.join(
 )
 
 from mozharness.base.errors import HgErrorList, GitErrorList
-from mozharness.base.log import INFO, ERROR, FATAL
+from mozharness.base.log import INFO, ERROR, FATAL, log_prefix
+from mozharness.base.parallel import run_in_parallel
 from mozharness.base.python import VirtualenvMixin, virtualenv_config_options
 from mozharness.base.transfer import TransferMixin
+from mozharness.base.vcs.mapfile import (
+    MapFile, MapfileError, UnsortedMapfileError, difference, merge,
+    read_mapfile, read_sorted, write_mapfile,
+)
 from mozharness.base.vcs.vcssync import VCSSyncScript
 from mozharness.mozilla.tooltool import TooltoolMixin
 
+# Regexes {{{1
+# Backreferences, conditionals and inline flags mean something else inside
+# a bigger regex.
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]')
+_compiled_regexes = {}
+
+
+def compile_regexes(regexes):
+    """ Compile a list of regexes into as few patterns as possible: a
+        single alternation, plus any regexes that can't be part of one.
+        A name matches the list if any of the patterns search() it.
+        """
+    key = tuple(regexes)
+    if key not in _compiled_regexes:
+        combinable = [r for r in key if not _UNCOMBINABLE_RE.search(r)]
+        patterns = [re.compile(r) for r in key if r not in combinable]
+        if len(combinable) > 1:
+            try:
+                patterns.insert(0, re.compile('|'.join('(?:%s)' % r for r in combinable)))
+            except (re.error, AssertionError):
+                # e.g. a group name used twice, or more than the 100 groups
+                # python 2 supports in one regex
+                patterns[:0] = [re.compile(r) for r in combinable]
+        elif combinable:
+            patterns.insert(0, re.compile(combinable[0]))
+        _compiled_regexes[key] = patterns
+    return _compiled_regexes[key]
+
+
+def search_regexes(patterns, name):
+    """ Whether any of the compile_regexes() patterns match name.
+        """
+    for pattern in patterns:
+        if pattern.search(name) is not None:
+            return True
+    return False
+
 
 # HgGitScript {{{1
 class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
@@ -52,8 +99,8 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
         script with some changes.
         """
 
-    mapfile_binary_search = None
     all_repos = None
+    git_version = None
     successful_repos = []
     config_options = [
         [["--no-check-incoming", ], {
@@ -72,6 +119,29 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
                     "embed two separate log samples into the email - so maximum "
                     "email body size can end up a little over 2x this amount).",
          }],
+        [["--incoming-check-workers", ], {
+            "action": "store",
+            "dest": "incoming_check_workers",
+            "type": "int",
+            "default": 16,
+            "help": "Fetch this many remote heads at once when checking "
+                    "repos for incoming changes.",
+        }],
+        [["--repo-workers", ], {
+            "action": "store",
+            "dest": "repo_workers",
+            "type": "int",
+            "default": 1,
+            "help": "Update this many repos at once in update-stage-mirror "
+                    "and update-work-mirror.",
+        }],
+        [["--no-bulk-git-notes", ], {
+            "action": "store_false",
+            "dest": "bulk_git_notes",
+            "default": True,
+            "help": "Add git notes one commit at a time, rather than all "
+                    "at once with git fast-import.",
+        }],
     ]
 
     def __init__(self, require_config_file=True):
@@ -106,6 +176,18 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             require_config_file=require_config_file
         )
         self.remote_targets = None
+        # repo_name -> remote heads, from _query_all_remote_heads()
+        self.remote_heads = {}
+        # Guards self.failures and repo_update.json when repos are updated
+        # concurrently; see _for_each_repo().
+        self._repo_lock = threading.RLock()
+        # (repo_path, vcs, kind) -> branch/tag/bookmark names, so each
+        # source repo is only asked once per cycle; see _query_repo_names().
+        self._repo_names = {}
+        self._repo_names_locks = {}
+        self._repo_names_lock = threading.Lock()
+        # (repo_name, target_dest, test_push) -> refs to push
+        self._refs_lists = {}
 
     # Helper methods {{{1
     def query_abs_dirs(self):
@@ -307,6 +389,30 @@ intree=1
         all_repos = self.query_all_repos()
         return [repo for repo in all_repos if repo.get('repo_name') not in self.failures]
 
+    def _for_each_repo(self, func, repos):
+        """ Call func(repo_config) for each repo in repos, up to
+            config['repo_workers'] at a time. With more than one worker, log
+            lines are prefixed with the repo name.
+            """
+        workers = self.config.get('repo_workers') or 1
+        if workers <= 1:
+            for repo_config in repos:
+                func(repo_config)
+            return
+
+        def _run(repo_config):
+            log_prefix(repo_config['repo_name'])
+            try:
+                func(repo_config)
+            finally:
+                log_prefix(None)
+        self.info("Updating %d repos, %d at a time." % (len(repos), workers))
+        run_in_parallel(_run, repos, max_workers=workers)
+
+    def add_failure(self, *args, **kwargs):
+        with self._repo_lock:
+            super(HgGitScript, self).add_failure(*args, **kwargs)
+
     def _query_repo_previous_status(self, repo_name, repo_map=None):
         """ Return False if previous run was unsuccessful.
             Return None if no previous run information.
@@ -318,12 +424,54 @@ intree=1
     def _update_repo_previous_status(self, repo_name, successful_flag, repo_map=None, write_update=False):
         """ Set the repo_name to successful_flag (False for unsuccessful, True for successful)
             """
-        if repo_map is None:
+        with self._repo_lock:
+            if repo_map is None:
+                repo_map = self._read_repo_update_json()
+            repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
+            if write_update:
+                self._write_repo_update_json(repo_map)
+        return repo_map
+
+    def _query_remote_heads(self, repo_url):
+        """ Ask the hgweb server at repo_url for its heads in a single
+            request, without starting hg.
+            Return the sorted list of heads, or None if they can't be found.
+            """
+        url = '%s?cmd=heads' % repo_url.rstrip('/')
+        try:
+            heads = self._urlopen(url, timeout=60).read().split()
+        except (urllib2.URLError, socket.error, ValueError), e:
+            self.info("Can't query heads of %s: %s" % (repo_url, str(e)))
+            return None
+        if not heads or not all(re.match('^[0-9a-f]{40}$', h) for h in heads):
+            self.info("Unexpected heads response from %s." % url)
+            return None
+        return sorted(heads)
+
+    def _query_all_remote_heads(self, repos):
+        """ Fetch the remote heads of every http(s) repo that will be
+            checked for incoming changes, --incoming-check-workers at a time.
+            Return a dict of repo_name to heads (None where the fetch failed).
+            """
+        repos = [r for r in repos
+                 if r.get('check_incoming', True) and
+                 r['repo'].startswith(('http://', 'https://'))]
+        if not repos:
+            return {}
+        self.info("Checking %d repos for remote changes." % len(repos))
+        heads = run_in_parallel(
+            lambda r: self._query_remote_heads(r['repo']), repos,
+            max_workers=self.config.get('incoming_check_workers', 16)
+        )
+        return dict(zip([r['repo_name'] for r in repos], heads))
+
+    def _update_repo_remote_heads(self, repo_name, remote_heads):
+        """ Record the remote heads a repo's stage mirror was pulled at.
+            """
+        with self._repo_lock:
             repo_map = self._read_repo_update_json()
-        repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
-        if write_update:
+            repo_map.setdefault('repos', {}).setdefault(repo_name, {})['remote_heads'] = remote_heads
             self._write_repo_update_json(repo_map)
-        return repo_map
 
     def _update_stage_repo(self, repo_config, retry=True, clobber=False):
         """ Update a stage repo.
@@ -334,6 +482,8 @@ intree=1
         repo_name = repo_config['repo_name']
         source_dest = os.path.join(dirs['abs_source_dir'],
                                    repo_name)
+        remote_heads = self.remote_heads.get(repo_name)
+        self._forget_repo_names(source_dest, repo_name)
         if clobber:
             self.rmtree(source_dest)
         if not os.path.exists(source_dest):
@@ -371,6 +521,16 @@ intree=1
                 self.info("No previous status for %s; skipping incoming check!" % repo_name)
             elif previous_status is False:
                 self.info("Previously unsuccessful status for %s; skipping incoming check!" % repo_name)
+            elif remote_heads:
+                # update_stage_mirror() already fetched the remote heads;
+                # compare them to the ones we last pulled.
+                repo_map = self._read_repo_update_json()
+                if repo_map.get('repos', {}).get(repo_name, {}).get('remote_heads') == remote_heads:
+                    self.info("No changes for %s; skipping." % repo_name)
+                    with self._repo_lock:
+                        self.failures.append(repo_name)
+                    return
+                self.info("Remote heads of %s changed; pulling." % repo_name)
             else:
                 # Run |hg incoming| and skip all subsequent actions if there
                 # are no no changes.
@@ -392,7 +552,8 @@ intree=1
                     self.info("No changes for %s; skipping." % repo_name)
                     # Overload self.failures to tell downstream actions to noop on
                     # this repo
-                    self.failures.append(repo_name)
+                    with self._repo_lock:
+                        self.failures.append(repo_name)
                     return
                 elif status != 0:
                     self.add_failure(
@@ -422,6 +583,10 @@ intree=1
                     message="Can't pull %s!" % repo_config['repo'],
                     level=ERROR,
                 )
+        elif remote_heads:
+            # These were fetched before the pull, so anything pushed since
+            # shows up as a change next time.
+            self._update_repo_remote_heads(repo_name, remote_heads)
         # commenting out hg verify since it takes ~5min per repo; hopefully
         # exit codes will save us
 #        if self.run_command(hg + ["verify"], cwd=source_dest):
@@ -430,34 +595,134 @@ intree=1
 #            else:
 #                self.fatal("Can't verify %s!" % source_dest)
 
-    def _do_push_repo(self, base_command, refs_list=None, kwargs=None):
-        """ Helper method for _push_repo() since it has to be able to break
-            out of the target_repo list loop, and the commands loop borks that.
+    def _query_git_version(self):
+        """ Returns the version of git as a tuple of ints, or () if unknown.
+            """
+        if self.git_version is None:
+            git = self.query_exe('git', return_type='list')
+            output = self.get_output_from_command(git + ['--version'], silent=True)
+            match = re.search(r'(\d+(?:\.\d+)+)', output or '')
+            self.git_version = ()
+            if match:
+                self.git_version = tuple(int(n) for n in match.group(1).split('.'))
+        return self.git_version
+
+    def _query_unchanged_refs(self, target, refs_list, cwd, partial_env=None):
+        """ Returns the refspecs in refs_list whose destination ref on target
+            already has the value of the local source ref, from one
+            |git ls-remote|.
+            """
+        git = self.query_exe('git', return_type='list')
+        env = self.query_env(partial_env=partial_env or {})
+        # If the target can't be listed, we just don't know of any
+        # unchanged refs; the push reports the real problem.
+        remote_refs = self.get_output_from_command(
+            git + ['ls-remote', target], cwd=cwd, env=env, silent=True,
+            ignore_errors=True,
+        )
+        local_refs = self.get_output_from_command(
+            git + ['for-each-ref', '--format=%(objectname) %(refname)'],
+            cwd=cwd, silent=True,
+        )
+        if remote_refs is None or local_refs is None:
+            return set()
+        remote = dict(reversed(line.split()) for line in remote_refs.splitlines() if line)
+        local = dict(reversed(line.split()) for line in local_refs.splitlines() if line)
+        unchanged = set()
+        for refspec in refs_list:
+            src, _, dest = refspec.lstrip('+').partition(':')
+            if src in local and remote.get(dest or src) == local[src]:
+                unchanged.add(refspec)
+        return unchanged
+
+    def _do_push_repo(self, base_command, refs_list=None, kwargs=None,
+                      target=None, batch_size=None, atomic=False):
+        """ Helper method for _push_repo(); pushes refs_list to the target
+            at the end of base_command.
+
+            Refs are pushed batch_size (default: push_batch_size) at a time,
+            each batch with --atomic if atomic is set and git supports it.
+            If target is given, refs it already has are skipped.
+
+            Returns -1 on failure.
             """
+        if kwargs is None:
+            kwargs = {}
+        if batch_size is None:
+            batch_size = self.config.get('push_batch_size', 1000)
         commands = []
         if refs_list:
-            while len(refs_list) > 10:
-                commands.append(base_command + refs_list[0:10])
-                refs_list = refs_list[10:]
-            commands.append(base_command + refs_list)
+            if target:
+                unchanged = self._query_unchanged_refs(
+                    target, refs_list, kwargs.get('cwd'), kwargs.get('partial_env'))
+                if unchanged:
+                    self.info("%d of %d refs are already up to date on %s." %
+                              (len(unchanged), len(refs_list), target))
+                    refs_list = [r for r in refs_list if r not in unchanged]
+                if not refs_list:
+                    return
+            if atomic and self._query_git_version() >= (2, 4):
+                # insert before the target
+                base_command = base_command[:-1] + ['--atomic'] + base_command[-1:]
+            else:
+                atomic = False
+            for i in range(0, len(refs_list), batch_size):
+                commands.append(base_command + refs_list[i:i + batch_size])
         else:
             commands = [base_command]
-        if kwargs is None:
-            kwargs = {}
         for command in commands:
+            if atomic:
+                # Only once: if the remote doesn't support atomic pushes,
+                # retrying won't help.
+                if not self.retry(
+                    self.run_command,
+                    attempts=1,
+                    args=(command, ),
+                    kwargs=kwargs,
+                ):
+                    continue
+                self.warning("Atomic push failed; trying again without --atomic.")
             # Do the push, with retry!
             if self.retry(
                 self.run_command,
-                args=(command, ),
+                args=([c for c in command if c != '--atomic'], ),
                 kwargs=kwargs,
             ):
                 return -1
+            if atomic:
+                # the remote probably doesn't support atomic pushes; don't
+                # try them for the rest of the batches
+                atomic = False
 
     def _push_repo(self, repo_config):
         """ Push a repo to a path ("test_push") or remote server.
 
             This was meant to be a cross-vcs method, but currently only
             covers git pushes.
+
+            Test pushes are done first, in order, and a failed one stops
+            the rest.  Then all the remote targets are pushed to at once.
+            """
+        if self.remote_targets is None:
+            self.remote_targets = self.config.get('remote_targets', {})
+        test_targets = [t for t in repo_config['targets'] if t.get("test_push")]
+        remote_targets = [t for t in repo_config['targets'] if not t.get("test_push")]
+        return_status = ''
+        for target_config in test_targets:
+            error_msg = self._push_target(repo_config, target_config)
+            if error_msg:
+                return error_msg + "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
+        statuses = run_in_parallel(
+            lambda target_config: self._push_target(repo_config, target_config),
+            remote_targets,
+            max_workers=self.config.get('push_workers', 4),
+        )
+        for status in statuses:
+            return_status += status
+        return return_status
+
+    def _push_target(self, repo_config, target_config):
+        """ Push a repo to one target.  Returns an error message on failure.
             """
         dirs = self.query_abs_dirs()
         conversion_dir = self.query_abs_conversion_dir(repo_config)
@@ -465,134 +730,109 @@ intree=1
             self.fatal("No conversion_dir for %s!" % repo_config['repo_name'])
         source_dir = os.path.join(dirs['abs_source_dir'], repo_config['repo_name'])
         git = self.query_exe('git', return_type='list')
-        hg = self._query_hg_exe()
-        return_status = ''
-        for target_config in repo_config['targets']:
-            test_push = False
-            remote_config = {}
-            if target_config.get("test_push"):
-                test_push = True
-                force_push = target_config.get("force_push")
-                target_name = os.path.join(
-                    dirs['abs_target_dir'], target_config['target_dest'])
-                target_vcs = target_config.get("vcs")
-            else:
-                target_name = target_config['target_dest']
-                if self.remote_targets is None:
-                    self.remote_targets = self.config.get('remote_targets', {})
-                remote_config = self.remote_targets.get(target_name, target_config)
-                force_push = remote_config.get("force_push", target_config.get("force_push"))
-                target_vcs = remote_config.get("vcs", target_config.get("vcs"))
-            if target_vcs == "git":
-                base_command = git + ['push']
-                env = {}
-                if force_push:
-                    base_command.append("-f")
-                if test_push:
-                    target_git_repo = target_name
-                else:
-                    target_git_repo = remote_config['repo']
-                    # Allow for using a custom git ssh key.
-                    env['GIT_SSH_KEY'] = remote_config['ssh_key']
-                    env['GIT_SSH'] = os.path.join(external_tools_path, 'git-ssh-wrapper.sh')
-                base_command.append(target_git_repo)
-                # Allow for pushing a subset of repo branches to the target.
-                # If we specify that subset, we can also specify different
-                # names for those branches (e.g. b2g18 -> master for a
-                # standalone b2g18 repo)
-                # We query hg for these because the conversion dir will have
-                # branches from multiple hg repos, and the regexes may match
-                # too many things.
-                refs_list = []
-                if repo_config.get('generate_git_notes', False):
-                    refs_list.append('+refs/notes/commits:refs/notes/commits')
-                branch_map = self.query_branches(
-                    target_config.get('branch_config', repo_config.get('branch_config', {})),
-                    source_dir,
-                )
-                # If the target_config has a branch_config, the key is the
-                # local git branch and the value is the target git branch.
-                if target_config.get("branch_config"):
-                    for (branch, target_branch) in branch_map.items():
-                        refs_list += ['+refs/heads/%s:refs/heads/%s' % (branch, target_branch)]
-                # Otherwise the key is the hg branch and the value is the git
-                # branch; use the git branch for both local and target git
-                # branch names.
-                else:
-                    for (hg_branch, git_branch) in branch_map.items():
-                        refs_list += ['+refs/heads/%s:refs/heads/%s' % (git_branch, git_branch)]
-                # Allow for pushing a subset of tags to the target, via name or
-                # regex.  Again, query hg for this list because the conversion
-                # dir will contain tags from multiple hg repos, and the regexes
-                # may match too many things.
-                tag_config = target_config.get('tag_config', repo_config.get('tag_config', {}))
-                if tag_config.get('tags'):
-                    for (tag, target_tag) in tag_config['tags'].items():
-                        refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag, target_tag)]
-                if tag_config.get('tag_regexes'):
-                    regex_list = []
-                    for regex in tag_config['tag_regexes']:
-                        regex_list.append(re.compile(regex))
-                    tag_list = self.get_output_from_command(
-                        hg + ['tags'],
-                        cwd=source_dir,
-                    )
-                    if tag_list is not None:
-                        for tag_line in tag_list.splitlines():
-                            if not tag_line:
-                                continue
-                            tag_parts = tag_line.split()
-                            if not tag_parts:
-                                self.error("Bogus tag_line? %s" % str(tag_line))
-                                continue
-                            tag_name = tag_parts[0]
-                            for regex in regex_list:
-                                if tag_name != 'tip' and regex.search(tag_name) is not None:
-                                    refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
-                                    continue
-                error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_git_repo)
-                if self._do_push_repo(
-                    base_command,
-                    refs_list=refs_list,
-                    kwargs={
-                        'output_timeout': target_config.get("output_timeout", 90 * 60),
-                        'cwd': os.path.join(conversion_dir, '.git'),
-                        'error_list': GitErrorList,
-                        'partial_env': env,
-                    }
-                ):
-                    if target_config.get("test_push"):
-                        error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
-                    self.error(error_msg)
-                    return_status += error_msg
-                    if target_config.get("test_push"):
-                        break
-            else:
-                # TODO write hg
-                error_msg = "%s: Don't know how to deal with vcs %s!\n" % (
-                    target_config['target_dest'], target_vcs)
-                self.error(error_msg)
-                return_status += error_msg
-        return return_status
+        test_push = False
+        remote_config = {}
+        if target_config.get("test_push"):
+            test_push = True
+            force_push = target_config.get("force_push")
+            target_name = os.path.join(
+                dirs['abs_target_dir'], target_config['target_dest'])
+            target_vcs = target_config.get("vcs")
+        else:
+            target_name = target_config['target_dest']
+            remote_config = self.remote_targets.get(target_name, target_config)
+            force_push = remote_config.get("force_push", target_config.get("force_push"))
+            target_vcs = remote_config.get("vcs", target_config.get("vcs"))
+        if target_vcs != "git":
+            # TODO write hg
+            error_msg = "%s: Don't know how to deal with vcs %s!\n" % (
+                target_config['target_dest'], target_vcs)
+            self.error(error_msg)
+            return error_msg
+        base_command = git + ['push']
+        env = {}
+        if force_push:
+            base_command.append("-f")
+        if test_push:
+            target_git_repo = target_name
+        else:
+            target_git_repo = remote_config['repo']
+            # Allow for using a custom git ssh key.
+            env['GIT_SSH_KEY'] = remote_config['ssh_key']
+            env['GIT_SSH'] = os.path.join(external_tools_path, 'git-ssh-wrapper.sh')
+        base_command.append(target_git_repo)
+        refs_key = (repo_config['repo_name'], target_config['target_dest'], test_push)
+        refs_list = self._refs_lists.get(refs_key)
+        if refs_list is None:
+            refs_list = self._query_refs_list(repo_config, target_config, source_dir)
+            self._refs_lists[refs_key] = refs_list
+        if self._do_push_repo(
+            base_command,
+            refs_list=refs_list,
+            kwargs={
+                'output_timeout': target_config.get("output_timeout", 90 * 60),
+                'cwd': os.path.join(conversion_dir, '.git'),
+                'error_list': GitErrorList,
+                'partial_env': env,
+            },
+            target=target_git_repo,
+            batch_size=target_config.get('push_batch_size', remote_config.get('push_batch_size')),
+            atomic=target_config.get('atomic_push', remote_config.get('atomic_push', self.config.get('atomic_push', True))),
+        ):
+            error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_git_repo)
+            self.error(error_msg)
+            return error_msg
+        return ''
+
+    def _query_refs_list(self, repo_config, target_config, source_dir):
+        """ Return the refspecs to push from repo_config's conversion dir
+            to a target.
+            """
+        # Allow for pushing a subset of repo branches to the target.
+        # If we specify that subset, we can also specify different
+        # names for those branches (e.g. b2g18 -> master for a
+        # standalone b2g18 repo)
+        # We query hg for these because the conversion dir will have
+        # branches from multiple hg repos, and the regexes may match
+        # too many things.
+        refs_list = []
+        if repo_config.get('generate_git_notes', False):
+            refs_list.append('+refs/notes/commits:refs/notes/commits')
+        branch_map = self.query_branches(
+            target_config.get('branch_config', repo_config.get('branch_config', {})),
+            source_dir,
+        )
+        # If the target_config has a branch_config, the key is the
+        # local git branch and the value is the target git branch.
+        if target_config.get("branch_config"):
+            for (branch, target_branch) in branch_map.items():
+                refs_list += ['+refs/heads/%s:refs/heads/%s' % (branch, target_branch)]
+        # Otherwise the key is the hg branch and the value is the git
+        # branch; use the git branch for both local and target git
+        # branch names.
+        else:
+            for (hg_branch, git_branch) in branch_map.items():
+                refs_list += ['+refs/heads/%s:refs/heads/%s' % (git_branch, git_branch)]
+        # Allow for pushing a subset of tags to the target, via name or
+        # regex.  Again, query hg for this list because the conversion
+        # dir will contain tags from multiple hg repos, and the regexes
+        # may match too many things.
+        tag_config = target_config.get('tag_config', repo_config.get('tag_config', {}))
+        if tag_config.get('tags'):
+            for (tag, target_tag) in tag_config['tags'].items():
+                refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag, target_tag)]
+        if tag_config.get('tag_regexes'):
+            patterns = compile_regexes(tag_config['tag_regexes'])
+            for tag_name in self._query_repo_names(source_dir, 'tags'):
+                if tag_name != 'tip' and search_regexes(patterns, tag_name):
+                    refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
+        return refs_list
 
     def _query_mapped_revision(self, revision=None, mapfile=None):
-        """ Use the virtualenv mapper module to search a mapfile for a
-            revision.
+        """ Search a mapfile for the git revision of an hg revision.
             """
-        if not callable(self.mapfile_binary_search):
-            site_packages_path = self.query_python_site_packages_path()
-            sys.path.append(os.path.join(site_packages_path, 'mapper'))
-            try:
-                from bsearch import mapfile_binary_search
-                global log
-                log = self.log_obj
-                self.mapfile_binary_search = mapfile_binary_search
-            except ImportError, e:
-                self.fatal("Can't import mapfile_binary_search! %s\nDid you create-virtualenv?" % str(e))
-        # I wish mapper did this for me, but ...
-        fd = open(mapfile, 'rb')
-        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        return self.mapfile_binary_search(m, revision)
+        with MapFile(mapfile) as m:
+            return m.git_sha(revision)
 
     def _post_fatal(self, message=None, exit_code=None):
         """ After we call fatal(), run this method before exiting.
@@ -633,12 +873,13 @@ intree=1
         """ The write portion of _read_repo_update_json().
             """
         dirs = self.query_abs_dirs()
-        contents = json.dumps(repo_map, sort_keys=True, indent=4)
-        self.write_to_file(
-            os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
-            contents,
-            create_parent_dir=True
-        )
+        with self._repo_lock:
+            contents = json.dumps(repo_map, sort_keys=True, indent=4)
+            self.write_to_file(
+                os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
+                contents,
+                create_parent_dir=True
+            )
 
     def _query_hg_exe(self):
         """Returns the hg executable command as a list
@@ -653,6 +894,70 @@ intree=1
         exe_command.extend(hg_options)
         return exe_command
 
+    def _query_repo_names(self, repo_path, kind, vcs='hg'):
+        """ Return the names of the branches, tags or bookmarks (`kind`)
+            in repo_path.  Each is only listed once per repo per cycle,
+            however many targets and regexes need it.
+            """
+        key = (repo_path, vcs, kind)
+        with self._repo_names_lock:
+            lock = self._repo_names_locks.setdefault(key, threading.Lock())
+        # Concurrent pushes of the same repo wait for the first to list it.
+        with lock:
+            if key not in self._repo_names:
+                names = self._list_repo_names(repo_path, kind, vcs)
+                if names is None:
+                    # Don't remember a failure.
+                    return []
+                self._repo_names[key] = names
+            return self._repo_names[key]
+
+    def _list_repo_names(self, repo_path, kind, vcs='hg'):
+        """ Ask hg or git for the names of the branches, tags or bookmarks
+            in repo_path.  Returns None on failure.
+            """
+        if vcs == 'hg':
+            # This assumes we always want closed branches as well.
+            # If not we may need more options.
+            command = self._query_hg_exe() + {
+                'branches': ['branches', '-a'],
+                'tags': ['tags'],
+                'bookmarks': ['bookmarks'],
+            }[kind]
+        elif vcs == 'git':
+            command = self.query_exe("git", return_type="list") + {
+                'branches': ['branch', '-l'],
+                'tags': ['tag', '-l'],
+            }[kind]
+        else:
+            self.error("Don't know how to list %s for vcs %s!" % (kind, vcs))
+            return None
+        output = self.get_output_from_command(command, cwd=repo_path)
+        if output is None:
+            return None
+        names = []
+        for line in output.splitlines():
+            if vcs == 'hg' and kind == 'bookmarks' and line == 'no bookmarks set':
+                break
+            # The current branch or bookmark is starred.
+            parts = line.lstrip(' *').split()
+            if not parts:
+                continue
+            names.append(parts[0])
+        return names
+
+    def _forget_repo_names(self, repo_path, repo_name=None):
+        """ Forget the names listed for repo_path, e.g. before it's
+            updated, along with the refs to push for repo_name.
+            """
+        with self._repo_names_lock:
+            for key in self._repo_names.keys():
+                if key[0] == repo_path:
+                    del self._repo_names[key]
+            for key in self._refs_lists.keys():
+                if key[0] == repo_name:
+                    del self._refs_lists[key]
+
     def query_branches(self, branch_config, repo_path, vcs='hg'):
         """ Given a branch_config of branches and branch_regexes, return
             a dict of existing branch names to target branch names.
@@ -661,34 +966,11 @@ intree=1
         if "branches" in branch_config:
             branch_map = deepcopy(branch_config['branches'])
         if "branch_regexes" in branch_config:
-            regex_list = list(branch_config['branch_regexes'])
-            full_branch_list = []
-            if vcs == 'hg':
-                hg = self._query_hg_exe()
-                # This assumes we always want closed branches as well.
-                # If not we may need more options.
-                output = self.get_output_from_command(
-                    hg + ['branches', '-a'],
-                    cwd=repo_path
-                )
-                if output:
-                    for line in output.splitlines():
-                        full_branch_list.append(line.split()[0])
-            elif vcs == 'git':
-                git = self.query_exe("git", return_type="list")
-                output = self.get_output_from_command(
-                    git + ['branch', '-l'],
-                    cwd=repo_path
-                )
-                if output:
-                    for line in output.splitlines():
-                        full_branch_list.append(line.replace('*', '').split()[0])
-            for regex in regex_list:
-                for branch in full_branch_list:
-                    m = re.search(regex, branch)
-                    if m:
-                        # Don't overwrite branch_map[branch] if it exists
-                        branch_map.setdefault(branch, branch)
+            patterns = compile_regexes(branch_config['branch_regexes'])
+            for branch in self._query_repo_names(repo_path, 'branches', vcs=vcs):
+                if search_regexes(patterns, branch):
+                    # Don't overwrite branch_map[branch] if it exists
+                    branch_map.setdefault(branch, branch)
         return branch_map
 
     def _combine_mapfiles(self, mapfiles, combined_mapfile, cwd=None):
@@ -719,14 +1001,11 @@ intree=1
                 self.info("No new mapfiles to combine.")
                 return
             self.move(combined_mapfile_path, "%s.old" % combined_mapfile_path)
-        output = self.get_output_from_command(
-            ['sort', '--unique', '-t', ' ',
-             '--key=2'] + existing_mapfiles,
-            silent=True, halt_on_failure=True,
-            cwd=cwd,
-        )
-        self.write_to_file(combined_mapfile_path, output, verbose=False,
-                           error_level=FATAL)
+        try:
+            write_mapfile(combined_mapfile_path, merge(
+                [read_sorted(os.path.join(cwd, f)) for f in existing_mapfiles]))
+        except (IOError, OSError, MapfileError), e:
+            self.fatal("Can't combine mapfiles into %s: %s" % (combined_mapfile_path, str(e)))
         self.run_command(['ln', '-sf', combined_mapfile,
                           '%s-latest' % combined_mapfile],
                          cwd=cwd)
@@ -765,110 +1044,139 @@ intree=1
 
             We pull the stage mirror into the work mirror, where the conversion
             is done.
+
+            Repos are independent, so --repo-workers of them are updated at
+            once. The remote heads of every http(s) repo are fetched up
+            front, in parallel, so unchanged repos are skipped without
+            running |hg incoming| in each.
             """
-        for repo_config in self.query_all_non_failed_repos():
-            self._update_stage_repo(repo_config)
+        repos = self.query_all_non_failed_repos()
+        if self.config['check_incoming']:
+            self.remote_heads = self._query_all_remote_heads(repos)
+        self._for_each_repo(self._update_stage_repo, repos)
 
     def pull_out_new_sha_lookups(self, old_file, new_file):
-        """ This method will return an iterator which iterates through lines in file
+        """ This method will return a list of the lines in file
             new_file that do not exist in old_file. If old_file can't be read, all
             lines in new_file are returned. It does not cause any problems if lines
             exist in old_file that do not exist in new_file. Results are sorted by
             the second field (text after first space in line).
 
             This is somewhat equivalent to:
-               ( [ ! -f "${old_file}" ] && cat "${new_file}" || diff "${old_file}" "${new_file}" | sed -n 's/> //p' ) | sort -k2"""
-        with self.opened(old_file) as (old, err):
-            if err:
-                self.info('Map file %s not found - probably first time this has run.' % old_file)
-                old_set = frozenset()
-            else:
-                old_set = frozenset(old)
-        with self.opened(new_file, 'rt') as (new, err):
-            if err:
-                self.error('Could not read contents of map file %s:\n%s' % (new_file, err.message))
-                new_set = frozenset()
-            else:
-                new_set = frozenset(new)
-        for line in sorted(new_set.difference(old_set), key=lambda line: line.partition(' ')[2]):
-            yield line
+               ( [ ! -f "${old_file}" ] && cat "${new_file}" || diff "${old_file}" "${new_file}" | sed -n 's/> //p' ) | sort -k2
+
+            Both files are streamed, so this takes little memory however
+            big they are."""
+        if not os.path.exists(new_file):
+            self.error('Could not read contents of map file %s' % new_file)
+            return []
+        if not os.path.exists(old_file):
+            self.info('Map file %s not found - probably first time this has run.' % old_file)
+
+        def new_lookups(read):
+            old_pairs = []
+            if os.path.exists(old_file):
+                old_pairs = read(old_file)
+            return ['%s %s\n' % pair for pair in difference(read(new_file), old_pairs)]
+        try:
+            try:
+                return new_lookups(read_mapfile)
+            except UnsortedMapfileError, e:
+                # only sort them if we have to
+                self.warning('%s; sorting' % str(e))
+                return new_lookups(read_sorted)
+        except MapfileError, e:
+            self.fatal('Error in map file: %s' % str(e))
 
     def update_work_mirror(self):
         """ Pull the latest changes into the work mirror, update the repo_map
             json, and run |hg gexport| to convert those latest changes into
             the git conversion repo.
+
+            Repos are independent, so --repo-workers of them are updated at
+            once.
             """
-        hg = self._query_hg_exe()
-        git = self.query_exe("git", return_type="list")
-        dirs = self.query_abs_dirs()
         repo_map = self._read_repo_update_json()
         timestamp = int(time.time())
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
         repo_map['last_pull_timestamp'] = timestamp
         repo_map['last_pull_datetime'] = datetime
-        for repo_config in self.query_all_non_failed_repos():
-            repo_name = repo_config['repo_name']
-            source = os.path.join(dirs['abs_source_dir'], repo_name)
-            dest = self.query_abs_conversion_dir(repo_config)
-            if not dest:
-                self.fatal("No conversion_dir for %s!" % repo_name)
-            if not os.path.exists(dest):
-                self.mkdir_p(os.path.dirname(dest))
-                self.run_command(hg + ['clone', '--noupdate', source, dest],
-                                 error_list=HgErrorList,
-                                 halt_on_failure=False)
-                if os.path.exists(dest):
-                    if not self.config.get('cinnabar'):
-                        self.write_hggit_hgrc(dest)
-                    self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
-                    self.run_command(
-                        git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
-                    )
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Failed to clone %s!" % source,
-                        level=ERROR,
-                    )
-                    continue
-            # Build branch map.
-            branch_map = self.query_branches(
-                repo_config.get('branch_config', {}),
-                source,
+        self._for_each_repo(
+            lambda repo_config: self._update_work_repo(repo_config, repo_map),
+            self.query_all_non_failed_repos()
+        )
+        self._write_repo_update_json(repo_map)
+
+    def _update_work_repo(self, repo_config, repo_map):
+        """ Update one work mirror repo, recording its branches in repo_map.
+            See update_work_mirror().
+            """
+        hg = self._query_hg_exe()
+        git = self.query_exe("git", return_type="list")
+        dirs = self.query_abs_dirs()
+        repo_name = repo_config['repo_name']
+        source = os.path.join(dirs['abs_source_dir'], repo_name)
+        dest = self.query_abs_conversion_dir(repo_config)
+        if not dest:
+            self.fatal("No conversion_dir for %s!" % repo_name)
+        if not os.path.exists(dest):
+            self.mkdir_p(os.path.dirname(dest))
+            self.run_command(hg + ['clone', '--noupdate', source, dest],
+                             error_list=HgErrorList,
+                             halt_on_failure=False)
+            if os.path.exists(dest):
+                if not self.config.get('cinnabar'):
+                    self.write_hggit_hgrc(dest)
+                self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
+                self.run_command(
+                    git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
+                )
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Failed to clone %s!" % source,
+                    level=ERROR,
+                )
+                return
+        # Build branch map.
+        branch_map = self.query_branches(
+            repo_config.get('branch_config', {}),
+            source,
+        )
+        for (branch, target_branch) in branch_map.items():
+            output = self.get_output_from_command(
+                hg + ['id', '-r', branch],
+                cwd=source
             )
-            for (branch, target_branch) in branch_map.items():
-                output = self.get_output_from_command(
-                    hg + ['id', '-r', branch],
-                    cwd=source
+            if output:
+                rev = output.split(' ')[0]
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
+                    level=ERROR,
                 )
-                if output:
-                    rev = output.split(' ')[0]
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
-                        level=ERROR,
-                    )
-                    continue
-                timestamp = int(time.time())
-                datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-                if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
-                                    error_list=HgErrorList):
-                    # We shouldn't have an issue pulling!
-                    self.add_failure(
-                        repo_name,
-                        message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
-                        level=ERROR,
-                    )
-                    self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
-                    # don't leave a dirty checkout behind, and skip remaining branches
-                    self.rmtree(source)
-                    break
-                self.run_command(
-                    hg + ['bookmark', '-f', '-r', rev, target_branch],
-                    cwd=dest, error_list=HgErrorList,
+                continue
+            timestamp = int(time.time())
+            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+            if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
+                                error_list=HgErrorList):
+                # We shouldn't have an issue pulling!
+                self.add_failure(
+                    repo_name,
+                    message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
+                    level=ERROR,
                 )
-                # This might get a little large.
+                self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
+                # don't leave a dirty checkout behind, and skip remaining branches
+                self.rmtree(source)
+                break
+            self.run_command(
+                hg + ['bookmark', '-f', '-r', rev, target_branch],
+                cwd=dest, error_list=HgErrorList,
+            )
+            # This might get a little large.
+            with self._repo_lock:
                 repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {})[branch] = {
                     'hg_branch': branch,
                     'hg_revision': rev,
@@ -876,36 +1184,36 @@ intree=1
                     'pull_timestamp': timestamp,
                     'pull_datetime': datetime,
                 }
-            if self.query_failure(repo_name):
-                # We hit an error in the for loop above
-                continue
+        if self.query_failure(repo_name):
+            # We hit an error in the for loop above
+            return
 
-            generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            if self.config.get('cinnabar'):
-                self._update_cinnabar_mirror(repo_config, git, dest, generated_mapfile)
-            else:
-                self.retry(
-                    self.run_command,
-                    args=(hg + ['-v', 'gexport'], ),
-                    kwargs={
-                        'output_timeout': repo_config.get("export_timeout", 120 * 60),
-                        'cwd': dest,
-                        'error_list': HgErrorList,
-                    },
-                    error_level=FATAL,
-                )
+        generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        if self.config.get('cinnabar'):
+            self._update_cinnabar_mirror(repo_config, git, dest, generated_mapfile)
+        else:
+            self.retry(
+                self.run_command,
+                args=(hg + ['-v', 'gexport'], ),
+                kwargs={
+                    'output_timeout': repo_config.get("export_timeout", 120 * 60),
+                    'cwd': dest,
+                    'error_list': HgErrorList,
+                },
+                error_level=FATAL,
+            )
 
 
+        with self._repo_lock:
             self.copy_to_upload_dir(
                 generated_mapfile,
                 dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
                 log_level=INFO
             )
-            for (branch, target_branch) in branch_map.items():
-                git_revision = self._query_mapped_revision(
-                    revision=rev, mapfile=generated_mapfile)
-                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
-        self._write_repo_update_json(repo_map)
+        for (branch, target_branch) in branch_map.items():
+            git_revision = self._query_mapped_revision(
+                revision=rev, mapfile=generated_mapfile)
+            repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
 
     def _update_cinnabar_mirror(self, repo_config, git, dest, generated_mapfile):
         # Do things somewhat equivalent to hg gexport with git-cinnabar, which involves:
@@ -1022,41 +1330,16 @@ intree=1
         if not git_sha1s:
             return
 
-        def old_map():
-            with open(generated_mapfile) as map_file:
-                for line in map_file:
-                    l = line.split()
-                    if len(l) != 2:
-                        self.fatal('Error in git-mapfile')
-                    yield tuple(l)
-
-        # Merge two iterators of (git_sha1, hg_sha1), ordered by hg_sha1.
-        def merge_map(a, b):
-            a = iter(a)
-            b = iter(b)
-            item_a = next(a, None)
-            item_b = next(b, None)
-            while item_a is not None or item_b is not None:
-                while item_a and (item_b is None or item_a[1] < item_b[1]):
-                    yield item_a
-                    item_a = next(a, None)
-                while item_b and (item_a is None or item_b[1] < item_a[1]):
-                    yield item_b
-                    item_b = next(b, None)
-                if item_a is None or item_b is None:
-                    continue
-                if item_a[1] == item_b[1]:
-                    if item_a[0] != item_b[0]:
-                        self.fatal('%s already maps to %s ; cannot change that to %s',
-                                   item_a[1], item_a[0], item_b[0])
-                    yield item_a
-                    item_a = next(a, None)
-                    item_b = next(b, None)
-
-        new_map = sorted(zip(git_sha1s, hg_sha1s), key=lambda x: x[1])
-        with open(generated_mapfile + '.new', 'w') as new_map_file:
-            for git_sha1, hg_sha1 in merge_map(old_map(), new_map):
-                new_map_file.write('%s %s\n' % (git_sha1, hg_sha1))
+        def conflict(kept, dropped):
+            self.fatal('%s already maps to %s ; cannot change that to %s'
+                       % (kept[1], kept[0], dropped[0]))
+
+        new_map = sorted(zip(git_sha1s, hg_sha1s), key=lambda x: (x[1], x[0]))
+        try:
+            write_mapfile(generated_mapfile + '.new',
+                          merge([read_sorted(generated_mapfile), new_map], conflict=conflict))
+        except MapfileError, e:
+            self.fatal('Error in git-mapfile: %s' % str(e))
         os.rename(generated_mapfile, generated_mapfile + '.old')
         os.rename(generated_mapfile + '.new', generated_mapfile)
         if self.retry(
@@ -1094,39 +1377,378 @@ intree=1
                         git_notes_adding_successful = False
                         self.warn("Could not write list of unprocessed git note mappings to file %s - not critical" % delta_git_notes)
                     else:
-                        for sha_lookup in self.pull_out_new_sha_lookups(added_to_git_notes, complete_mapfile):
+                        sha_lookups = list(self.pull_out_new_sha_lookups(added_to_git_notes, complete_mapfile))
+                        for sha_lookup in sha_lookups:
                             print >>delta_out, sha_lookup,
-                            (git_sha, hg_sha) = sha_lookup.split()
-                            # only add git note if not already there - note
-                            # devs may have added their own notes, so don't
-                            # replace any existing notes, just add to them
-                            output = self.get_output_from_command(
-                                git + ['notes', 'show', git_sha],
-                                cwd=git_dir,
-                                ignore_errors=True
-                            )
-                            git_note_text = 'Upstream source: %s/rev/%s' % (repo, hg_sha)
-                            git_notes_add_return_code = 1
-                            if not output or output.find(git_note_text) < 0:
-                                git_notes_add_return_code = self.run_command(
-                                    git + ['notes', 'append', '-m', git_note_text, git_sha],
-                                    cwd=git_dir
-                                )
-                            # if note was successfully added, or it was already there, we can
-                            # mark it as added, by putting it in the delta file...
-                            if git_notes_add_return_code == 0 or output.find(git_note_text) >= 0:
-                                print >>delta_out, sha_lookup,
-                            else:
-                                self.error("Was not able to append required git note for git commit %s ('%s')" % (git_sha, git_note_text))
-                                git_notes_adding_successful = False
+                        noted = None
+                        if sha_lookups and self.config.get('bulk_git_notes', True):
+                            noted = self._add_git_notes_in_bulk(git, git_dir, repo, sha_lookups)
+                        if noted is None:
+                            noted = self._add_git_notes_one_by_one(git, git_dir, repo, sha_lookups)
+                        if len(noted) != len(sha_lookups):
+                            git_notes_adding_successful = False
                 if git_notes_adding_successful:
                     self.copyfile(complete_mapfile, added_to_git_notes)
             else:
                 self.info("Not creating git notes for repo %s (generate_git_notes not set to True)" % repo)
 
+    def _git_note_text(self, repo, hg_sha):
+        return 'Upstream source: %s/rev/%s' % (repo, hg_sha)
+
+    def _add_git_notes_one_by_one(self, git, git_dir, repo, sha_lookups):
+        """ Append the upstream source note to each git commit in sha_lookups
+            that doesn't have it yet, with a |git notes append| per commit.
+            Returns the sha_lookups that are now noted."""
+        noted = []
+        for sha_lookup in sha_lookups:
+            (git_sha, hg_sha) = sha_lookup.split()
+            # only add git note if not already there - note
+            # devs may have added their own notes, so don't
+            # replace any existing notes, just add to them
+            output = self.get_output_from_command(
+                git + ['notes', 'show', git_sha],
+                cwd=git_dir,
+                ignore_errors=True
+            )
+            git_note_text = self._git_note_text(repo, hg_sha)
+            git_notes_add_return_code = 1
+            if not output or output.find(git_note_text) < 0:
+                git_notes_add_return_code = self.run_command(
+                    git + ['notes', 'append', '-m', git_note_text, git_sha],
+                    cwd=git_dir
+                )
+            # if note was successfully added, or it was already there, we can
+            # mark it as added
+            if git_notes_add_return_code == 0 or (output and output.find(git_note_text) >= 0):
+                noted.append(sha_lookup)
+            else:
+                self.error("Was not able to append required git note for git commit %s ('%s')" % (git_sha, git_note_text))
+        return noted
+
+    def _run_git_with_input(self, command, git_dir, input_file):
+        """ Run command with the contents of input_file as its stdin, which
+            run_command() can't do.  Returns (return code, stdout)."""
+        self.info("Running command: %s < %s" % (command, input_file))
+        with self.trace_span(command, 'command'):
+            with open(input_file, 'rb') as fh:
+                proc = subprocess.Popen(command, cwd=git_dir, stdin=fh,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                output, errors = proc.communicate()
+            self.annotate_span(exit_status=proc.returncode)
+        if proc.returncode:
+            self.error("%s returned %d:\n%s" % (command, proc.returncode, errors))
+        return proc.returncode, output
+
+    def _query_git_notes(self, git, git_dir, git_shas):
+        """ Returns a dict of git sha -> note for those of git_shas that have
+            a note, reading all of them with one |git notes list| and one
+            |git cat-file --batch|."""
+        listing = self.get_output_from_command(
+            git + ['notes', 'list'],
+            cwd=git_dir,
+            silent=True,
+            ignore_errors=True
+        )
+        wanted = set(git_shas)
+        blobs = {}
+        for line in (listing or '').splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] in wanted:
+                blobs[fields[1]] = fields[0]
+        if not blobs:
+            return {}
+        blob_list = os.path.join(git_dir, 'mozharness-note-blobs')
+        self.write_to_file(blob_list, ''.join('%s\n' % b for b in set(blobs.values())))
+        return_code, output = self._run_git_with_input(
+            git + ['cat-file', '--batch'], git_dir, blob_list)
+        self.rmtree(blob_list)
+        if return_code:
+            return None
+        # each object is "<sha> <type> <size>\n<contents>\n", or
+        # "<sha> missing\n"
+        contents = {}
+        pos = 0
+        while pos < len(output):
+            header_end = output.index('\n', pos)
+            header = output[pos:header_end].split()
+            pos = header_end + 1
+            if len(header) == 3:
+                size = int(header[2])
+                contents[header[0]] = output[pos:pos + size]
+                pos += size + 1
+        return dict((git_sha, contents[blob]) for (git_sha, blob) in blobs.items()
+                    if blob in contents)
+
+    def _add_git_notes_in_bulk(self, git, git_dir, repo, sha_lookups):
+        """ Append the upstream source note to each git commit in sha_lookups
+            that doesn't have it yet, like _add_git_notes_one_by_one(), but
+            reading the existing notes once and writing all the new ones as a
+            single commit to the notes ref with |git fast-import|, so it takes
+            a handful of processes however many commits there are.
+
+            Returns the sha_lookups that are now noted, or None if the notes
+            couldn't be written this way."""
+        git_shas = [sha_lookup.split()[0] for sha_lookup in sha_lookups]
+        existing = self._query_git_notes(git, git_dir, git_shas)
+        if existing is None:
+            return None
+        notes = {}
+        for sha_lookup in sha_lookups:
+            (git_sha, hg_sha) = sha_lookup.split()
+            git_note_text = self._git_note_text(repo, hg_sha).encode('utf-8')
+            note = notes.get(git_sha, existing.get(git_sha))
+            if note and note.find(git_note_text) >= 0:
+                continue
+            # devs may have added their own notes, so add to them the way
+            # |git notes append| does
+            if note:
+                note = '%s\n\n%s\n' % (note.rstrip('\n'), git_note_text)
+            else:
+                note = '%s\n' % git_note_text
+            notes[git_sha] = note
+        if notes:
+            self.info("Writing %d git notes with git fast-import." % len(notes))
+            # fast-import only moves the ref forward from its current commit,
+            # so if anything else adds notes in the meantime this fails
+            # rather than losing them
+            parent = self.get_output_from_command(
+                git + ['rev-parse', '--verify', '-q', 'refs/notes/commits'],
+                cwd=git_dir,
+                ignore_errors=True
+            )
+            committer = self.get_output_from_command(
+                git + ['var', 'GIT_COMMITTER_IDENT'],
+                cwd=git_dir
+            )
+            if not committer:
+                return None
+            message = 'Notes added by vcs_sync.py\n'
+            stream = os.path.join(git_dir, 'mozharness-notes-import')
+            with open(stream, 'wb') as fh:
+                fh.write('commit refs/notes/commits\n')
+                fh.write('committer %s\n' % committer)
+                fh.write('data %d\n%s\n' % (len(message), message))
+                if parent:
+                    fh.write('from %s\n' % parent)
+                for git_sha in sorted(notes):
+                    fh.write('N inline %s\ndata %d\n%s\n' % (git_sha, len(notes[git_sha]), notes[git_sha]))
+                fh.write('\n')
+            return_code, output = self._run_git_with_input(
+                git + ['fast-import', '--quiet'], git_dir, stream)
+            self.rmtree(stream)
+            if return_code:
+                self.warning("Couldn't add git notes in bulk; adding them one by one.")
+                return None
+        return list(sha_lookups)
+
+    def _check_new_mappings(self, published_to_mapper, complete_mapfile, new_mappings):
+        """ bug 1193011 says there are problems on occasion, so independently
+            check the calculation of the new mappings against the mapfiles."""
+        published = set()
+        lines_last_time = 0
+        if os.path.exists(published_to_mapper):
+            with open(published_to_mapper) as fh:
+                for line in fh:
+                    published.add(line)
+                    lines_last_time += 1
+        lines_this_time = 0
+        if os.path.exists(complete_mapfile):
+            with open(complete_mapfile) as fh:
+                lines_this_time = sum(1 for line in fh)
+        if lines_this_time - lines_last_time != len(new_mappings):
+            self.error("Bad calc of new mappings: last %d, now %d, diff %d, calc %d"
+                       % (lines_last_time, lines_this_time, lines_this_time - lines_last_time,
+                          len(new_mappings)))
+        # correct # of entries, but are they the correct entries? None
+        # of the new mappings should have been published already
+        if any(mapping in published for mapping in new_mappings):
+            self.error("Bad selection of new mappings, some already there")
+
+    def _query_mapper_headers(self, insert_url):
+        """ Returns a function that gives the headers to post data to
+            insert_url with."""
+        content_type = 'text/plain'
+        tc_client_id = os.environ.get(
+            'RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_CLIENT_ID')
+        tc_access_token = os.environ.get(
+            'RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_ACCESS_TOKEN')
+        relengapi_token = os.environ.get(
+            'RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN')
+        if tc_client_id and tc_access_token:
+            # For taskcluster auth, we only import mohawk since we need
+            # content to create the header
+            try:
+                import mohawk
+            except ImportError as e:
+                self.fatal("Can't import mohawk: %s\nDid you create-virtualenv?" % str(e))
+
+            def headers(data):
+                return {
+                    'Content-Type': content_type,
+                    'Authentication': mohawk.Sender(
+                        credentials=dict(
+                            id=tc_client_id,
+                            key=tc_access_token,
+                            algorithm='sha256',
+                        ),
+                        ext=dict(),
+                        url=insert_url,
+                        content=data,
+                        content_type=content_type,
+                        method='POST',
+                    ).request_header,
+                }
+            return headers
+        elif relengapi_token:
+            return lambda data: {
+                'Content-Type': content_type,
+                'Authentication': 'Bearer %s' % relengapi_token,
+            }
+        self.fatal(
+            "Please provide either:\n"
+            "- RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN\n"
+            "- RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_ACCESS_TOKEN and RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_CLIENT_ID")
+
+    def _query_mapper_session(self, requests, mapper_config):
+        """ Returns a requests session that keeps a connection open to
+            mapper for each of the mapper_config 'workers'."""
+        workers = mapper_config.get('workers', 8)
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _publish_mappings(self, session, insert_url, mappings, headers, mapper_config):
+        """ Post mappings to insert_url in chunks, mapper_config 'workers'
+            chunks at a time.
+
+            Mapper has to answer each chunk before the load balancer times
+            out, so chunk sizes adapt to how fast it does: they start at
+            'chunk_size' lines, double (up to 'max_chunk_size') after a chunk
+            taking less than half of 'chunk_seconds', and halve (down to
+            'min_chunk_size') after a slower one or a failure.  A failed
+            chunk is retried in halves.  Duplicates are ignored by mapper,
+            so this is safe.
+
+            Returns True if all the mappings were published."""
+        workers = mapper_config.get('workers', 8)
+        min_size = mapper_config.get('min_chunk_size', 50)
+        max_size = mapper_config.get('max_chunk_size', 5000)
+        target_seconds = mapper_config.get('chunk_seconds', 10)
+        timeout = mapper_config.get('timeout', 120)
+        lock = threading.Lock()
+        state = {
+            'next': 0,
+            'size': mapper_config.get('chunk_size', 200),
+            'successful': True,
+        }
+
+        def next_chunk():
+            with lock:
+                start = state['next']
+                if start >= len(mappings):
+                    return None
+                end = min(start + state['size'], len(mappings))
+                state['next'] = end
+                return start, end
+
+        def resize(ok, elapsed):
+            with lock:
+                if ok and elapsed < target_seconds / 2.0:
+                    state['size'] = min(state['size'] * 2, max_size)
+                elif not ok or elapsed > target_seconds:
+                    state['size'] = max(state['size'] / 2, min_size)
+
+        def post(start, end):
+            data = "".join(mappings[start:end])
+            began = time.time()
+            try:
+                r = session.post(insert_url, data=data, headers=headers(data),
+                                 timeout=timeout)
+                result = "http %s" % r.status_code
+                ok = r.status_code == 200
+            except IOError as e:
+                # requests' exceptions are IOErrors
+                result = repr(e)
+                ok = False
+            elapsed = time.time() - began
+            resize(ok, elapsed)
+            if ok:
+                self.info("Published line range [%s, %s] to mapper (%s) in %.1fs"
+                          % (start, end, insert_url, elapsed))
+                return True
+            if end - start > min_size:
+                self.warning("Could not publish line range [%s, %s] to mapper (%s) - %s; retrying in halves"
+                             % (start, end, insert_url, result))
+                middle = (start + end) / 2
+                # both halves, even if the first fails
+                return all([post(start, middle), post(middle, end)])
+            self.error("Could not publish line range [%s, %s] to mapper (%s) - %s"
+                       % (start, end, insert_url, result))
+            return False
+
+        def worker(_):
+            while True:
+                chunk = next_chunk()
+                if chunk is None:
+                    return
+                if not post(*chunk):
+                    # we won't stop, since we may be able to publish other
+                    # mappings, and we will push the whole lot again next
+                    # time anyway
+                    state['successful'] = False
+
+        run_in_parallel(worker, range(workers), max_workers=workers)
+        return state['successful']
+
+    def _verify_mappings(self, session, insert_url, mappings, mapper_config):
+        """ Check that mapper gives back each of mappings when looked up by
+            its hg and by its git sha, mapper_config 'verify_workers' lookups
+            at a time.  With 'verify_sample' set, only that many of the
+            mappings are checked: the first, the last and a random selection
+            of the rest.
+
+            Returns True if they all check out."""
+        sample = mapper_config.get('verify_sample')
+        to_check = mappings
+        if sample and len(mappings) > max(sample, 2):
+            to_check = [mappings[0], mappings[-1]] + \
+                random.sample(mappings[1:-1], max(sample - 2, 0))
+        rev_url = urlparse.urljoin(insert_url, "../rev/")
+        timeout = mapper_config.get('timeout', 120)
+        lookups = []
+        for mapping in to_check:
+            mapping = mapping.rstrip()
+            git_sha, hg_sha = mapping.split()
+            lookups.append(("%shg/%s" % (rev_url, hg_sha), mapping))
+            lookups.append(("%sgit/%s" % (rev_url, git_sha), mapping))
+
+        def check(lookup):
+            check_url, expected = lookup
+            try:
+                r = session.get(check_url, timeout=timeout)
+            except IOError as e:
+                # every so often, we get an uncaught
+                # exception here. (Once a month.)
+                self.error("Mapper network error: %s" % repr(e))
+                return False
+            if r.status_code != 200 or r.text != expected:
+                self.error("Mapper lookup failure: %s on %s\n('%s') rcvd\n('%s') expected"
+                           % (r.status_code, check_url, r.text, expected))
+                return False
+            return True
+
+        self.info("Checking %d of %d new mappings on mapper." % (len(to_check), len(mappings)))
+        results = run_in_parallel(check, lookups,
+                                  max_workers=mapper_config.get('verify_workers', 8))
+        return all(results)
+
     def publish_to_mapper(self):
-        """ This method will attempt to create git notes for any new git<->hg mappings
-            found in the generated_mapfile file and also push new mappings to mapper service."""
+        """ This method will push new git<->hg mappings found in the
+            generated_mapfile file to the mapper service, and check that they
+            got there."""
         for repo_config in self.query_all_non_failed_repos():
             dest = self.query_abs_conversion_dir(repo_config)
             # 'git-mapfile' is created by hggit plugin, containing all the mappings
@@ -1150,7 +1772,7 @@ intree=1
                 try:
                     import requests
                 except ImportError as e:
-                    self.error("Can't import requests: %s\nDid you create-virtualenv?" % str(e))
+                    self.fatal("Can't import requests: %s\nDid you create-virtualenv?" % str(e))
                 mapper_url = mapper_config['url']
                 mapper_project = mapper_config['project']
                 insert_url = "%s/%s/insert/ignoredups" % (mapper_url, mapper_project)
@@ -1160,151 +1782,29 @@ intree=1
                 self.write_to_file(delta_for_mapper, "".join(all_new_mappings))
                 # bug 1193011 says there are problems on occasion, independently
                 # check calculation of additions and save off mapfiles
-                dirs = self.query_abs_dirs()
                 for mapfile in [delta_for_mapper, published_to_mapper, complete_mapfile]:
                     self.copyfile(src=mapfile, dest=os.path.join('logs',
                         os.path.basename(mapfile)))
-                import subprocess   # this is debug code
-                # from https://gist.github.com/edufelipe/1027906 because we're py 2.6
-                def check_output(*popenargs, **kwargs):
-                    r"""Run command with arguments and return its output as a byte string.
-                    Backported from Python 2.7 as it's implemented as pure python on stdlib.
-                    >>> check_output(['/usr/bin/python', '--version'])
-                    Python 2.6.2
-                    """
-                    process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-                    output, unused_err = process.communicate()
-                    retcode = process.poll()
-                    if retcode == 1:
-                        # assume bootstrap process (no file) so zero lines
-                        output = "0"
-                    elif retcode:
-                        cmd = kwargs.get("args")
-                        if cmd is None:
-                            cmd = popenargs[0]
-                        error = subprocess.CalledProcessError(retcode, cmd)
-                        error.output = output
-                        raise error
-                    return output
-                lines_last_time = 0
-                if os.path.exists(published_to_mapper):
-                    lines_last_time = int(check_output('wc -l <%s' % published_to_mapper, shell=True))
-                lines_this_time = 0
-                if os.path.exists(complete_mapfile):
-                    lines_this_time = int(check_output('wc -l <%s' % complete_mapfile, shell=True))
-                if lines_this_time - lines_last_time != len(all_new_mappings):
-                    self.error("Bad calc of new mappings: last %d, now %d, diff %d, calc %d"
-                               % (lines_last_time, lines_this_time, lines_this_time - lines_last_time,
-                                  len(all_new_mappings)))
-                # correct # of entries, but are they the correct
-                # entries? None of the lines in delta_for_mapper should
-                # be in published_to_mapper. grep -Ff can help verify
-                retcode = subprocess.call(['grep', '-Ff',
-                    delta_for_mapper, published_to_mapper])
-                if retcode != 1:
-                    self.error("Bad selection of new mappings, some already there")
-
-                # create authentication headers
-                content_type = 'text/plain'
-                tc_client_id = os.environ.get(
-                    'RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_CLIENT_ID')
-                tc_access_token = os.environ.get(
-                    'RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_ACCESS_TOKEN')
-                relengapi_token = os.environ.get(
-                    'RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN')
-
-                # For taskcluster auth, we only import mohawk since we need
-                # content to create the header
+                self._check_new_mappings(published_to_mapper, complete_mapfile, all_new_mappings)
+                if not all_new_mappings:
+                    self.copyfile(complete_mapfile, published_to_mapper)
+                    continue
+
+                headers = self._query_mapper_headers(insert_url)
+                session = self._query_mapper_session(requests, mapper_config)
+                # bug 1193011 says there are problems on occasion with delta
+                # uploads, so check that the mappings got there in an effort to
+                # find the root cause
                 try:
-                    import mohawk
-                except ImportError as e:
-                    self.fatal("Can't import mohawk: %s\nDid you create-virtualenv?" % str(e))
-
-                # due to timeouts on load balancer, we only push 200 lines at a time
-                # this means that we should get http response back within 30 seconds
-                # including the time it takes to insert the mappings in the database
-                publish_successful = True
-
-                for i in range(0, len(all_new_mappings), 200):
-                    data = "".join(all_new_mappings[i:i+200])
-
-                    if tc_client_id and tc_access_token:
-                        headers = {
-                            'Content-Type': content_type,
-                            'Authentication': mohawk.Sender(
-                                credentials=dict(
-                                    id=tc_client_id,
-                                    key=tc_access_token,
-                                    algorithm='sha256',
-                                ),
-                                ext=dict(),
-                                url=insert_url,
-                                content=data,
-                                content_type=content_type,
-                                method='POST',
-                            ).request_header,
-                        }
-                    elif relengapi_token:
-                        headers = {
-                            'Content-Type': content_type,
-                            'Authentication': 'Bearer %s' % relengapi_token,
-                        }
-                    else:
-                        self.fatal(
-                            "Please provide either:\n"
-                            "- RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN\n"
-                            "- RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_ACCESS_TOKEN and RELENGAPI_INSERT_HGGIT_MAPPINGS_TASKCLUSTER_CLIENT_ID")
-
-                    r = requests.post(insert_url, data=data, headers=headers)
-                    if (r.status_code != 200):
-                        self.error("Could not publish mapfile ('%s') line range [%s, %s] to mapper (%s) - received http %s code" % (delta_for_mapper, i, i+200, insert_url, r.status_code))
-                        publish_successful = False
-                        # we won't break out, since we may be able to publish other mappings
-                        # and duplicates are allowed, so we will push the whole lot again next
-                        # time anyway
-                    else:
-                        self.info("Published mapfile ('%s') line range [%s, %s] to mapper (%s)" % (delta_for_mapper, i, i+200, insert_url))
-
-                if publish_successful:
-                    # bug 1193011 says there are problems on occasion
-                    # with delta uploads. Check that items are in db in
-                    # an effort to find the root cause.
-                    global publish_verified
-                    publish_verified = True
-                    try:
-                        # previously checked first, last only. No errors
-                        # reported, yet map still drifted out of spec.. Check them all!
-                        # hashes_to_check = [all_new_mappings[0], all_new_mappings[-1]]
-                        hashes_to_check = all_new_mappings[:]
-                    except IndexError:
-                        hashes_to_check = []
-                    def _check_mapping(url, vcs, sha, expected):
-                        global publish_verified
-                        import urlparse
-                        check_url = urlparse.urljoin(url, "../rev/%s/%s"
-                                                     % (vcs, sha))
-                        try:
-                            r = requests.get(check_url)
-                        except OSError as e:
-                            # every so often, we get an uncaught
-                            # exception here. (Once a month.)
-                            publish_verified = False
-                            self.error("Mapper network error: %s" % repr(e))
-                        if r.status_code != 200 or r.text != expected:
-                            publish_verified = False
-                            self.error("Mapper lookup failure: %s on %s\n('%s') rcvd\n('%s') expected"
-                                       % (r.status_code, check_url, r.text, expected))
-                    for mapping in hashes_to_check:
-                        mapping = mapping.rstrip()
-                        git_sha, hg_sha = mapping.split()
-                        _check_mapping(insert_url, 'hg', hg_sha, mapping)
-                        _check_mapping(insert_url, 'git', git_sha, mapping)
-
-                    if publish_verified:
-                        # if we get this far, we know we could successfully post to mapper, so now
-                        # we can copy the mapfile over "previously generated" version
-                        # so that we don't push to mapper for these commits again
-                        self.copyfile(complete_mapfile, published_to_mapper)
+                    published = self._publish_mappings(session, insert_url, all_new_mappings, headers, mapper_config) and \
+                        self._verify_mappings(session, insert_url, all_new_mappings, mapper_config)
+                finally:
+                    session.close()
+                if published:
+                    # if we get this far, we know we could successfully post to mapper, so now
+                    # we can copy the mapfile over "previously generated" version
+                    # so that we don't push to mapper for these commits again
+                    self.copyfile(complete_mapfile, published_to_mapper)
             else:
                 self.copyfile(complete_mapfile, published_to_mapper)
 
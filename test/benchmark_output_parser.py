@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Replay a recorded build log through OutputParser and report lines/sec.
+
+Usage: benchmark_output_parser.py [--repeat N] [log_file]
+
+The log defaults to test/helper_files/build_log_sample.txt, which is
+replayed --repeat times (default 2000) to get a stable timing. Parsed
+output is not logged, so the numbers are for matching only.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mozharness.base.errors import (BaseErrorList, HgErrorList,
+                                    MakefileErrorList, PythonErrorList)
+from mozharness.base.log import OutputParser
+
+ERROR_LIST = HgErrorList + PythonErrorList + MakefileErrorList + BaseErrorList
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'helper_files', 'build_log_sample.txt')
+
+
+class LinearOutputParser(OutputParser):
+    """OutputParser without the combined matcher, for comparison."""
+    def _query_error_matcher(self):
+        return _AlwaysMatch
+
+
+class _AlwaysMatch(object):
+    @staticmethod
+    def search(line):
+        return True
+
+
+def run(parser_class, lines, repeat):
+    parser = parser_class(config={'log_to_console': False},
+                          error_list=ERROR_LIST, log_output=False)
+    start = time.time()
+    for _ in xrange(repeat):
+        parser.add_lines(lines)
+    elapsed = time.time() - start
+    return elapsed, parser.num_errors, parser.num_warnings
+
+
+def main():
+    option_parser = OptionParser(usage=__doc__)
+    option_parser.add_option('--repeat', type='int', default=2000)
+    options, args = option_parser.parse_args()
+    log_file = args[0] if args else DEFAULT_LOG
+    with open(log_file) as fh:
+        lines = fh.read().splitlines()
+    total = len(lines) * options.repeat
+    print "%d lines x %d, %d error_list entries" % (len(lines), options.repeat,
+                                                   len(ERROR_LIST))
+    results = {}
+    for name, parser_class in (('linear', LinearOutputParser),
+                               ('combined', OutputParser)):
+        elapsed, errors, warnings = run(parser_class, lines, options.repeat)
+        results[name] = (errors, warnings)
+        print "%-9s %7.3fs %10.0f lines/sec (%d errors, %d warnings)" % (
+            name, elapsed, total / elapsed, errors, warnings)
+    if results['linear'] != results['combined']:
+        print "ERROR: results differ!"
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import urllib2
+
+from mozharness.base.cache import DownloadCache
+
+
+class FakeResponse(StringIO.StringIO):
+    def __init__(self, contents, headers):
+        StringIO.StringIO.__init__(self, contents)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+
+class FakeServer(object):
+    """Serves `contents` with an ETag; answers 304 to a matching
+    If-None-Match."""
+    def __init__(self, contents, etag='"abc"'):
+        self.contents = contents
+        self.etag = etag
+        self.requests = []
+
+    def urlopen(self, request, timeout=None):
+        self.requests.append(request)
+        if request.get_header('If-none-match') == self.etag:
+            raise urllib2.HTTPError(request.get_full_url(), 304,
+                                    'Not Modified', {}, None)
+        return FakeResponse(self.contents, {
+            'content-length': str(len(self.contents)),
+            'etag': self.etag,
+        })
+
+
+class TestDownloadCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DownloadCache(os.path.join(self.tmpdir, 'cache'))
+        self.cache.config = {'log_level': 'error'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dest(self, name='file'):
+        return os.path.join(self.tmpdir, name)
+
+    def test_miss_then_revalidated_hit(self):
+        server = FakeServer('x' * 1000)
+        self.cache.download('http://example.com/f', self._dest('a'), server.urlopen)
+        self.cache.download('http://example.com/f', self._dest('b'), server.urlopen)
+        self.assertEqual(open(self._dest('b')).read(), 'x' * 1000)
+        self.assertEqual(server.requests[1].get_header('If-none-match'), '"abc"')
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.bytes_saved),
+                         (1, 1, 1000))
+
+    def test_evicted_by_another_job(self):
+        server = FakeServer('x' * 1000)
+        self.cache.download('http://example.com/f', self._dest('a'), server.urlopen)
+        urlopen = server.urlopen
+
+        def evict_then_urlopen(request, timeout=None):
+            # another job evicts the blob while we revalidate
+            for name in os.listdir(self.cache.blob_dir):
+                os.remove(os.path.join(self.cache.blob_dir, name))
+            return urlopen(request, timeout=timeout)
+        self.cache.download('http://example.com/f', self._dest('b'), evict_then_urlopen)
+        self.assertEqual(open(self._dest('b')).read(), 'x' * 1000)
+        # the 304, then the whole file again, unconditionally
+        self.assertEqual(server.requests[2].get_header('If-none-match'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_changed_file_is_downloaded_again(self):
+        server = FakeServer('old')
+        self.cache.download('http://example.com/f', self._dest('a'), server.urlopen)
+        server.contents, server.etag = 'new', '"def"'
+        self.cache.download('http://example.com/f', self._dest('b'), server.urlopen)
+        self.assertEqual(open(self._dest('b')).read(), 'new')
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_known_digest_skips_request(self):
+        server = FakeServer('contents')
+        digest = hashlib.sha512('contents').hexdigest()
+        self.cache.download('http://example.com/f', self._dest('a'), server.urlopen,
+                            digest=digest)
+        self.cache.download('http://mirror.example.com/f', self._dest('b'),
+                            server.urlopen, digest=digest)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_digest_mismatch(self):
+        server = FakeServer('contents')
+        self.assertRaises(urllib2.URLError, self.cache.download,
+                          'http://example.com/f', self._dest(), server.urlopen,
+                          digest='0' * 128)
+        self.assertEqual(os.listdir(self.cache.blob_dir), [])
+
+    def test_evict_lru(self):
+        self.cache.max_size = 100
+        for i, name in enumerate(('one', 'two')):
+            server = FakeServer(name * 25)
+            self.cache.download('http://example.com/%s' % name, self._dest(name),
+                                server.urlopen)
+            blob = os.path.join(self.cache.blob_dir,
+                                hashlib.sha512(name * 25).hexdigest())
+            os.utime(blob, (i, i))
+        self.cache.evict()
+        self.assertEqual(os.listdir(self.cache.blob_dir),
+                         [hashlib.sha512('two' * 25).hexdigest()])
@@ -1,4 +1,8 @@
+import cPickle
+import mock
 import os
+import shutil
+import tempfile
 import unittest
 
 JSON_TYPE = None
@@ -248,6 +252,116 @@ class TestReadOnlyDict(unittest.TestCase):
         self.assertEqual(c['e'], 'hey', "can't set var in ROD after deepcopy")
 
 
+    def test_locked_copies(self):
+        r = self.get_locked_ROD()
+        self.assertFalse(dict.__getitem__(r, 'd') is self.control_dict['d'])
+        self.assertTrue(isinstance(dict.__getitem__(r, 'd'), config.ReadOnlyDict))
+        self.assertTrue(isinstance(dict.__getitem__(r, 'e'), config.LockedTuple))
+        self.assertTrue(r['d'] is r['d'])
+
+    def _assert_mutations_fail(self, d):
+        with self.assertRaises(AttributeError):
+            d['e'].append(9)
+        with self.assertRaises(AttributeError):
+            d['e'][2]['turtles'].append('turtle2')
+        with self.assertRaises(AssertionError):
+            d['d']['turtles'] = 'turtle2'
+        with self.assertRaises(AttributeError):
+            dict(d['e'][2])['turtles'].append('turtle2')
+        self.assertEqual(self.control_dict['e'], ['f', 'g', {'turtles': ['turtle1']}])
+        self.assertEqual(self.control_dict['d'], {'turtles': ['turtle1']})
+
+    def test_locked_dict_copy(self):
+        self._assert_mutations_fail(dict(self.get_locked_ROD()))
+
+    def test_locked_update_other(self):
+        other = {}
+        other.update(self.get_locked_ROD())
+        self._assert_mutations_fail(other)
+
+    def test_locked_kwargs(self):
+        def f(**kwargs):
+            return kwargs
+        self._assert_mutations_fail(f(**self.get_locked_ROD()))
+
+    def test_locked_items_values_get(self):
+        r = self.get_locked_ROD()
+        for value in r.values() + [v for (k, v) in r.items()] + \
+                [r.get(k) for k in r] + r.copy().values() + list(r['e']):
+            self.assertFalse(isinstance(value, (dict, list)) and
+                             not isinstance(value, config.ReadOnlyDict))
+        self.assertEqual(r.get('missing', 'default'), 'default')
+
+    def test_locked_equal(self):
+        r = self.get_locked_ROD()
+        r['e'][2]['turtles']
+        self.assertEqual(r, self.get_locked_ROD())
+        self.assertNotEqual(r, self.get_unlocked_ROD())
+
+    def test_locked_slice(self):
+        r = self.get_locked_ROD()
+        with self.assertRaises(AttributeError):
+            r['e'][1:][1]['turtles'].append('turtle2')
+        self.assertEqual(r['e'][-1], r['e'][2])
+
+    def test_locked_deepcopy_doesnt_freeze(self):
+        r = self.get_locked_ROD()
+        with mock.patch.object(config, 'make_immutable') as make_immutable:
+            c = deepcopy(r)
+        self.assertFalse(make_immutable.called)
+        self.assertEqual(c, self.control_dict)
+        c['e'][2]['turtles'].append('turtle2')
+        self.assertEqual(self.control_dict['e'][2]['turtles'], ['turtle1'])
+
+    def test_locked_pickle(self):
+        r = cPickle.loads(cPickle.dumps(self.get_locked_ROD(), 2))
+        self.assertEqual(r, self.get_locked_ROD())
+        self.assertTrue(isinstance(r['e'], config.LockedTuple))
+        with self.assertRaises(AssertionError):
+            r['e'][2]['turtles'] = 'turtle2'
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.env = mock.patch.dict(os.environ,
+                                   {config.CONFIG_CACHE_ENV: self.cache_dir})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _write_config(self, contents, name='cfg.py'):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def test_parse_cached(self):
+        path = self._write_config("config = {'a': [1, {'b': 2}]}\n")
+        self.assertEqual(config.parse_config_file(path), {'a': [1, {'b': 2}]})
+        with mock.patch.object(config, 'execfile', create=True) as execfile:
+            parsed = config.parse_config_file(path)
+        self.assertFalse(execfile.called)
+        self.assertEqual(parsed, {'a': [1, {'b': 2}]})
+        # each caller gets its own copy
+        parsed['a'].append(3)
+        self.assertEqual(config.parse_config_file(path), {'a': [1, {'b': 2}]})
+
+    def test_parse_cache_invalidated(self):
+        path = self._write_config("config = {'a': 1}\n")
+        config.parse_config_file(path)
+        self._write_config("config = {'a': 2}\n")
+        self.assertEqual(config.parse_config_file(path), {'a': 2})
+
+    def test_parse_not_cached_with_imports(self):
+        path = self._write_config("import os\nconfig = {'cwd': os.getcwd()}\n")
+        config.parse_config_file(path)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
 class TestActions(unittest.TestCase):
     all_actions = ['a', 'b', 'c', 'd', 'e']
     default_actions = ['b', 'c', 'd']
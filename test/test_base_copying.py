@@ -0,0 +1,60 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import mozharness.base.copying as copying
+
+
+class TestCopyFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        with open(self.src, 'w') as fh:
+            fh.write('x' * (copying.BLOCK_SIZE + 10))
+        os.chmod(self.src, 0750)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_copy(self):
+        stats = copying.CopyStats()
+        self.assertEqual(copying.copy_file(self.src, self.dest, stats=stats),
+                         'copied')
+        self.assertEqual(open(self.dest).read(), open(self.src).read())
+        self.assertEqual(os.stat(self.dest).st_mode, os.stat(self.src).st_mode)
+        self.assertNotEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual((stats.num_files, stats.num_bytes, stats.methods),
+                         (1, copying.BLOCK_SIZE + 10, {'copied': 1}))
+        self.assertTrue(str(stats).startswith('Copied 1 files (%d bytes)' %
+                                              (copying.BLOCK_SIZE + 10)))
+
+    def test_hardlink(self):
+        with mock.patch.object(copying, '_reflink', return_value=False):
+            self.assertEqual(copying.copy_file(self.src, self.dest,
+                                               link_mode='hardlink'),
+                             'hardlinked')
+        self.assertEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+
+    def test_copy_over_hardlink(self):
+        os.link(self.src, self.dest)
+        copying.copy_file(self.src, self.dest)
+        self.assertNotEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual(os.path.getsize(self.src), copying.BLOCK_SIZE + 10)
+
+    def test_reflink_falls_back(self):
+        # whether or not this filesystem can reflink, we get a copy
+        method = copying.copy_file(self.src, self.dest, link_mode='reflink')
+        self.assertTrue(method in ('reflinked', 'copied'))
+        self.assertEqual(open(self.dest).read(), open(self.src).read())
+        self.assertNotEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+
+    def test_unknown_link_mode(self):
+        self.assertRaises(ValueError, copying.copy_file, self.src, self.dest,
+                          link_mode='symlink')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import mozharness.base.hashing as hashing
+
+
+class TestFileDigests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fh:
+            fh.write(contents)
+        return path
+
+    def test_multiple_digests(self):
+        contents = 'x' * (hashing.BLOCK_SIZE + 10)
+        path = self._write('f', contents)
+        self.assertEqual(hashing.file_digests(path, ('sha1', 'sha512', 'md5')), {
+            'sha1': hashlib.sha1(contents).hexdigest(),
+            'sha512': hashlib.sha512(contents).hexdigest(),
+            'md5': hashlib.md5(contents).hexdigest(),
+        })
+
+    def test_memoized(self):
+        path = self._write('f', 'contents')
+        hashing.file_digests(path)
+        with mock.patch('__builtin__.open') as mock_open:
+            digest = hashing.file_digests(path)['sha512']
+        self.assertFalse(mock_open.called)
+        self.assertEqual(digest, hashlib.sha512('contents').hexdigest())
+
+    def test_changed_file(self):
+        path = self._write('f', 'old')
+        hashing.file_digests(path)
+        self._write('f', 'new contents')
+        self.assertEqual(hashing.file_digests(path)['sha512'],
+                         hashlib.sha512('new contents').hexdigest())
+
+    def test_files_digests(self):
+        paths = [self._write(str(i), str(i) * 100) for i in range(10)]
+        digests = hashing.files_digests(paths, ('md5', ))
+        self.assertEqual(digests, dict(
+            (p, {'md5': hashlib.md5(str(i) * 100).hexdigest()})
+            for i, p in enumerate(paths)))
+
+if __name__ == '__main__':
+    unittest.main()
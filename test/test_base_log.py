@@ -1,9 +1,13 @@
 import os
+import re
 import shutil
 import subprocess
 import unittest
 
 import mozharness.base.log as log
+from mozharness.base.log import INFO
+from mozharness.base.errors import (BaseErrorList, HgErrorList,
+                                    MakefileErrorList, PythonErrorList)
 
 tmp_dir = "test_log_dir"
 log_name = "test"
@@ -38,5 +42,155 @@ class TestLog(unittest.TestCase):
         self.assertTrue(os.path.exists(get_log_file_path()))
         del(l)
 
+
+class RecordingOutputParser(log.OutputParser):
+    def __init__(self, **kwargs):
+        super(RecordingOutputParser, self).__init__(**kwargs)
+        self.logged = []
+        self.summaries = []
+
+    def log(self, message, level=INFO, exit_code=-1):
+        self.logged.append((level, message))
+
+    def add_summary(self, message, level=INFO):
+        self.summaries.append((level, message))
+
+
+def expected_log(error_list, line):
+    """The (level, message) the original linear walk over error_list
+    would log for line."""
+    for error_check in error_list:
+        if 'substr' in error_check:
+            match = error_check['substr'] in line
+        else:
+            match = error_check['regex'].search(line)
+        if match:
+            message = ' %s' % line
+            if error_check.get('explanation'):
+                message += '\n %s' % error_check['explanation']
+            return (error_check.get('level', log.INFO), message)
+    return (log.INFO, ' %s' % line)
+
+
+class TestOutputParser(unittest.TestCase):
+    error_list = (HgErrorList + PythonErrorList + MakefileErrorList +
+                  BaseErrorList)
+    lines = [
+        "compiling foo.cpp",
+        "abort: repository default not found!",
+        "remote: abort: No space left on device",
+        "Traceback (most recent call last):",
+        "  raise RuntimeError: boom",
+        "foo.c:12: error: expected ';'",
+        "foo.c:12: warning: unused variable",
+        "make[2]: *** [libs] Error 2",
+        "gmake: *** No rule to make target. Stop.",
+        "Child returned status 1",
+        "nothing to see here",
+        "",
+    ]
+
+    def test_same_results_as_linear_walk(self):
+        parser = RecordingOutputParser(error_list=self.error_list)
+        for line in self.lines:
+            parser.parse_single_line(line)
+        self.assertEqual(parser.logged,
+                         [expected_log(self.error_list, l) for l in self.lines])
+
+    def test_first_match_wins(self):
+        error_list = [
+            {'substr': 'abc', 'level': log.WARNING},
+            {'regex': re.compile('a.c'), 'level': log.ERROR},
+        ]
+        parser = RecordingOutputParser(error_list=error_list)
+        parser.parse_single_line('xabcx')
+        parser.parse_single_line('xaXcx')
+        self.assertEqual(parser.logged, [(log.WARNING, ' xabcx'),
+                                         (log.ERROR, ' xaXcx')])
+        self.assertEqual((parser.num_warnings, parser.num_errors), (1, 1))
+        self.assertEqual(parser.worst_log_level, log.ERROR)
+
+    def test_summary_and_explanation(self):
+        error_list = [{'substr': 'oops', 'level': log.ERROR,
+                       'explanation': 'it broke', 'summary': True}]
+        parser = RecordingOutputParser(error_list=error_list)
+        parser.parse_single_line('oops')
+        self.assertEqual(parser.summaries, [(log.ERROR, ' oops\n it broke')])
+        self.assertEqual(parser.logged, [])
+
+    def test_required_literal(self):
+        required_literal = log.ErrorListMatcher._required_literal
+        self.assertEqual(required_literal(re.compile(r'^abort:')), 'abort:')
+        self.assertEqual(required_literal(
+            re.compile(r'make\[\d+\]: \*\*\* \[.*\] Error \d+')), ']: *** [')
+        self.assertEqual(required_literal(re.compile(r'(?i)abort')), None)
+        self.assertEqual(required_literal(re.compile(r'\d+|\w+')), None)
+
+    def test_regexes_without_literal(self):
+        error_list = [
+            {'regex': re.compile(r'(\w)\1x'), 'level': log.ERROR},
+            {'regex': re.compile(r'(?i)shout'), 'level': log.WARNING},
+            {'regex': re.compile(r'quiet'), 'level': log.CRITICAL},
+        ]
+        parser = RecordingOutputParser(error_list=error_list)
+        for line in ('aax', 'abx', 'SHOUT', 'QUIET', 'quiet'):
+            parser.parse_single_line(line)
+        self.assertEqual(parser.logged, [
+            (log.ERROR, ' aax'), (log.INFO, ' abx'), (log.WARNING, ' SHOUT'),
+            (log.INFO, ' QUIET'), (log.CRITICAL, ' quiet'),
+        ])
+
+    def test_error_list_extended(self):
+        error_list = [{'substr': 'early', 'level': log.WARNING}]
+        parser = RecordingOutputParser(error_list=error_list)
+        parser.parse_single_line('late error')
+        error_list.append({'substr': 'late', 'level': log.ERROR})
+        parser.parse_single_line('late error')
+        self.assertEqual(parser.logged, [(log.INFO, ' late error'),
+                                         (log.ERROR, ' late error')])
+
+    def test_trie_pattern(self):
+        words = ['abort', 'abortion', 'about', 'a.b', 'x']
+        regex = re.compile(log.ErrorListMatcher._trie_pattern(words))
+        for word in words:
+            self.assertTrue(regex.search('--%s--' % word), word)
+        for line in ('abo', 'ab', 'aXb', 'abour'):
+            self.assertFalse(regex.search(line), line)
+
+    def test_context_lines(self):
+        error_list = [
+            {'substr': 'boom', 'level': log.ERROR, 'context_lines': '2:1'},
+            {'substr': 'meh', 'level': log.WARNING},
+        ]
+        parser = RecordingOutputParser(error_list=error_list)
+        for line in ('one', 'two', 'three', 'four', 'boom', 'five', 'six',
+                     'meh', 'seven'):
+            parser.parse_single_line(line)
+            # never more than the largest pre-context held back
+            self.assertTrue(len(parser.context_buffer) <= 2)
+        parser.finish()
+        self.assertEqual(parser.logged, [
+            (log.INFO, ' one'), (log.INFO, ' two'), (log.ERROR, ' three'),
+            (log.ERROR, ' four'), (log.ERROR, ' boom'), (log.ERROR, ' five'),
+            (log.INFO, ' six'), (log.WARNING, ' meh'), (log.INFO, ' seven'),
+        ])
+        self.assertEqual((parser.num_errors, parser.num_warnings), (1, 1))
+
+    def test_context_lines_fatal(self):
+        error_list = [{'substr': 'die', 'level': log.FATAL,
+                       'context_lines': (1, 0)}]
+        parser = RecordingOutputParser(error_list=error_list)
+        parser.parse_single_line('before')
+        parser.parse_single_line('die')
+        self.assertEqual(parser.logged, [(log.CRITICAL, ' before'),
+                                         (log.FATAL, ' die')])
+
+    def test_parse_context_lines(self):
+        self.assertEqual(log.parse_context_lines(None), (0, 0))
+        self.assertEqual(log.parse_context_lines('5:5'), (5, 5))
+        self.assertEqual(log.parse_context_lines('20:'), (20, 0))
+        self.assertEqual(log.parse_context_lines(':3'), (0, 3))
+        self.assertEqual(log.parse_context_lines(4), (4, 4))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from mozharness.base.output import HeadTailBuffer, OutputPump
+
+
+class TestHeadTailBuffer(unittest.TestCase):
+    def test_no_limit(self):
+        buf = HeadTailBuffer()
+        for i in range(100):
+            buf.append('%d\n' % i)
+        self.assertEqual(len(buf.lines()), 100)
+        self.assertEqual(buf.num_omitted, 0)
+
+    def test_limit(self):
+        buf = HeadTailBuffer(4)
+        for i in range(10):
+            buf.append('%d\n' % i)
+        self.assertEqual(buf.lines(), ['0\n', '1\n', '[... 6 lines omitted ...]\n',
+                                       '8\n', '9\n'])
+
+    def test_under_limit(self):
+        buf = HeadTailBuffer(4)
+        for i in range(3):
+            buf.append('%d\n' % i)
+        self.assertEqual(buf.lines(), ['0\n', '1\n', '2\n'])
+
+    def test_limit_one(self):
+        buf = HeadTailBuffer(1)
+        for i in range(3):
+            buf.append('%d\n' % i)
+        self.assertEqual(buf.lines(), ['0\n', '[... 2 lines omitted ...]\n'])
+
+
+class TestOutputPump(unittest.TestCase):
+    def test_separate_streams(self):
+        p = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys\n'
+             'for i in range(1000):\n'
+             '    sys.stdout.write("out %d\\n" % i)\n'
+             '    sys.stderr.write("err %d\\n" % i)\n'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = [], []
+        pump = OutputPump()
+        pump.add_stream(p.stdout, out.append)
+        pump.add_stream(p.stderr, err.append)
+        pump.run()
+        p.wait()
+        self.assertEqual(out, ['out %d\n' % i for i in range(1000)])
+        self.assertEqual(err, ['err %d\n' % i for i in range(1000)])
+
+    @unittest.skipUnless(hasattr(signal, 'setitimer'), "needs signal.setitimer")
+    def test_interruptible(self):
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(signum, frame):
+            raise Interrupted()
+        read_fd, write_fd = os.pipe()
+        pump = OutputPump()
+        pump.add_stream(os.fdopen(read_fd), lambda line: None)
+        # Nothing is written.  Closing the pipe only ends a run() that
+        # missed the signal, which then arrives too late.
+        closed = []
+
+        def close():
+            os.close(write_fd)
+            closed.append(True)
+        closer = threading.Timer(3, close)
+        old_handler = signal.signal(signal.SIGALRM, interrupt)
+        closer.start()
+        start = time.time()
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.1)
+            self.assertRaises(Interrupted, pump.run)
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+            closer.cancel()
+            closer.join()
+            if not closed:
+                os.close(write_fd)
+
+if __name__ == '__main__':
+    unittest.main()
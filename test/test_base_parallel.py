@@ -1,6 +1,6 @@
 import unittest
 
-from mozharness.base.parallel import ChunkingMixin
+from mozharness.base.parallel import ChunkingMixin, run_in_parallel
 
 
 class TestChunkingMixin(unittest.TestCase):
@@ -24,3 +24,29 @@ class TestChunkingMixin(unittest.TestCase):
         self.assertEquals(self.c.query_chunked_list(thing, 1, 3), [1, 3, 6])
         self.assertEquals(self.c.query_chunked_list(thing, 2, 3), [4, 3])
         self.assertEquals(self.c.query_chunked_list(thing, 3, 3), [2, 6])
+
+
+class TestRunInParallel(unittest.TestCase):
+    def test_results_in_order(self):
+        self.assertEquals(run_in_parallel(lambda x: x * 2, range(10), max_workers=3),
+                          [x * 2 for x in range(10)])
+
+    def test_empty(self):
+        self.assertEquals(run_in_parallel(lambda x: x, []), [])
+
+    def test_exception_reraised(self):
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError, run_in_parallel, func, range(5))
+
+    def test_system_exit_reraised(self):
+        def func(x):
+            raise SystemExit(3)
+        try:
+            run_in_parallel(func, range(5))
+        except SystemExit, e:
+            self.assertEquals(e.code, 3)
+        else:
+            self.fail("SystemExit not raised")
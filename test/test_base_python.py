@@ -1,7 +1,11 @@
+import mock
 import os
+import shutil
+import tempfile
 import unittest
 
 import mozharness.base.python as python
+from mozharness.base.script import BaseScript
 
 here = os.path.dirname(os.path.abspath(__file__))
 
@@ -33,5 +37,97 @@ class TestVirtualenvMixin(unittest.TestCase):
         self.assertEqual(packages, expected)
 
 
+class VirtualenvScript(python.VirtualenvMixin, BaseScript):
+    def __init__(self, tmpdir, **config):
+        config.update({
+            'base_work_dir': tmpdir,
+            'work_dir': 'build',
+            'log_dir': os.path.abspath('test_logs'),
+            'virtualenv': '/bin/true',
+            'virtualenv_path': 'venv',
+            'virtualenv_modules': ['mozinfo'],
+            'prebuilt_virtualenv_cache': os.path.join(tmpdir, 'venv-cache'),
+            'sample_resources': False,
+        })
+        # option_args, so nosetests' own arguments aren't parsed as ours
+        super(VirtualenvScript, self).__init__(
+            config=config, all_actions=['create-virtualenv'],
+            option_args=['dummy.py'])
+        self.python_paths = {}
+
+    def fake_virtualenv(self, command, **kwargs):
+        venv = command[-1]
+        os.makedirs(os.path.join(venv, 'bin'))
+        with open(os.path.join(venv, 'bin', 'python'), 'w') as fh:
+            fh.write('python')
+        os.symlink('bin', os.path.join(venv, 'local'))
+        os.makedirs(os.path.join(venv, 'cache'))
+        return 0
+
+    def fake_install(self, module=None, **kwargs):
+        with open(os.path.join(self.query_virtualenv_path(), module), 'w') as fh:
+            fh.write(module)
+        return 0
+
+
+class TestPrebuiltVirtualenv(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree('test_logs', ignore_errors=True)
+
+    def create_virtualenv(self, install_status=0, **config):
+        s = VirtualenvScript(self.tmpdir, **config)
+        s.rmtree(s.query_virtualenv_path())
+        install = mock.Mock(side_effect=lambda **kwargs: (
+            s.fake_install(**kwargs) or install_status))
+        with mock.patch.object(s, 'run_command', s.fake_virtualenv):
+            with mock.patch.object(s, 'install_module', install):
+                with mock.patch.object(s, 'package_versions'):
+                    s.create_virtualenv()
+        return s, install
+
+    def test_cache_miss_then_hit(self):
+        s, install = self.create_virtualenv()
+        self.assertTrue(install.called)
+        cached = os.listdir(s.config['prebuilt_virtualenv_cache'])
+        self.assertEqual(len(cached), 1)
+        s, install = self.create_virtualenv()
+        self.assertFalse(install.called)
+        venv = s.query_virtualenv_path()
+        self.assertEqual(sorted(os.listdir(venv)), ['bin', 'local', 'mozinfo'])
+        self.assertEqual(os.readlink(os.path.join(venv, 'local')), 'bin')
+
+    def test_key_changes(self):
+        s, install = self.create_virtualenv()
+        s, install = self.create_virtualenv(virtualenv_options=['--always-copy'])
+        self.assertTrue(install.called)
+        self.assertEqual(len(os.listdir(s.config['prebuilt_virtualenv_cache'])), 2)
+
+    def test_local_module_contents_in_key(self):
+        module_dir = os.path.join(self.tmpdir, 'build', 'mozbase')
+        os.makedirs(module_dir)
+        with open(os.path.join(module_dir, 'setup.py'), 'w') as fh:
+            fh.write('version 1')
+        config = {'mozinfo_url': 'mozbase'}
+        self.create_virtualenv(**config)
+        with open(os.path.join(module_dir, 'setup.py'), 'w') as fh:
+            fh.write('version 2')
+        s, install = self.create_virtualenv(**config)
+        self.assertTrue(install.called)
+
+    def test_incomplete_not_cached(self):
+        s, install = self.create_virtualenv(install_status=-1)
+        self.assertFalse(os.path.exists(s.config['prebuilt_virtualenv_cache']))
+
+    def test_too_old(self):
+        s, install = self.create_virtualenv()
+        s, install = self.create_virtualenv(prebuilt_virtualenv_max_age=-1)
+        self.assertTrue(install.called)
+        self.assertEqual(len(os.listdir(s.config['prebuilt_virtualenv_cache'])), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mozharness.base.resources as resources
+
+
+def make_sample(time, phase, **kwargs):
+    sample = dict((k, 0) for k in resources.COLUMNS)
+    sample.update(time=time, phase=phase, disk_free=1000)
+    sample.update(kwargs)
+    return sample
+
+
+@unittest.skipUnless(resources.is_supported(), "Needs /proc")
+class TestResourceSampler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'samples.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_readers(self):
+        busy, total = resources.read_cpu()
+        self.assertTrue(0 <= busy <= total)
+        self.assertTrue(resources.read_tree_rss(os.getpid()) > 0)
+        self.assertEqual(len(resources.read_disk_io(resources._disks())), 4)
+        self.assertEqual(len(resources.read_net_io()), 2)
+        self.assertTrue(resources.read_disk_free(self.tmpdir) > 0)
+        self.assertTrue(resources.read_disk_free(
+            os.path.join(self.tmpdir, 'gone', 'too')) > 0)
+
+    def test_sample_phases(self):
+        # long enough that only the phase boundaries are sampled
+        sampler = resources.ResourceSampler(self.path, interval=60,
+                                            disk_path=self.tmpdir)
+        sampler.start()
+        sampler.begin_phase('checkout')
+        sampler.finish_phase('checkout')
+        sampler.begin_phase('build')
+        sampler.finish_phase('build')
+        sampler.stop()
+        sampler.stop()
+        self.assertFalse(sampler.running)
+        samples = resources.read_samples(self.path)
+        self.assertEqual([s['phase'] for s in samples if s['phase'] != '-'],
+                         ['checkout', 'checkout', 'build', 'build'])
+        total, phases = resources.summarize(samples)
+        self.assertEqual([p for (p, usage) in phases], ['checkout', 'build'])
+        self.assertTrue(total.rss_max > 0)
+
+    def test_read_samples_truncated(self):
+        sampler = resources.ResourceSampler(self.path, disk_path=self.tmpdir)
+        sampler.start()
+        sampler.stop()
+        with open(self.path, 'a') as fh:
+            fh.write('123.4\tbuild\t5')
+        self.assertEqual(len(resources.read_samples(self.path)), 2)
+
+
+class TestSummarize(unittest.TestCase):
+    def test_summarize(self):
+        samples = [
+            make_sample(10.0, '-', cpu_busy=0, cpu_total=0, rss=5),
+            make_sample(11.0, 'checkout', cpu_busy=10, cpu_total=100, rss=10,
+                        net_rx=100, read_bytes=1),
+            make_sample(15.0, 'checkout', cpu_busy=60, cpu_total=200, rss=30,
+                        net_rx=600, read_bytes=3, disk_free=10),
+            make_sample(15.5, 'build', cpu_busy=60, cpu_total=200, rss=20,
+                        net_rx=600, read_bytes=3),
+            make_sample(16.5, 'build', cpu_busy=60, cpu_total=200, rss=20,
+                        net_rx=600, read_bytes=3),
+        ]
+        total, phases = resources.summarize(samples)
+        self.assertEqual(total.duration, 6.5)
+        self.assertEqual(total.cpu_percent, 30.0)
+        self.assertEqual(total.rss_max, 30)
+        self.assertEqual(total.disk_free_min, 10)
+        checkout = dict(phases)['checkout']
+        self.assertEqual(checkout.duration, 4.0)
+        self.assertEqual(checkout.cpu_percent, 50.0)
+        self.assertEqual(checkout.net_rx, 500)
+        self.assertEqual(checkout.read_bytes, 2)
+        self.assertEqual([p for (p, usage) in phases], ['checkout', 'build'])
+        self.assertEqual(dict(phases)['build'].cpu_percent, None)
+
+    def test_summarize_nothing(self):
+        self.assertEqual(resources.summarize([]), (None, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
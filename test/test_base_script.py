@@ -1,9 +1,14 @@
+import BaseHTTPServer
 import gc
+import json
 import mock
 import os
 import re
+import socket
+import threading
 import types
 import unittest
+import zipfile
 PYWIN32 = False
 if os.name == 'nt':
     try:
@@ -18,6 +23,9 @@ import mozharness.base.log as log
 from mozharness.base.log import DEBUG, INFO, WARNING, ERROR, CRITICAL, FATAL, IGNORE
 import mozharness.base.script as script
 from mozharness.base.config import parse_config_file
+from mozharness.mozilla.proxxy import Proxxy
+from mozharness.base.resources import read_samples, \
+    is_supported as resource_sampling_supported
 
 test_string = '''foo
 bar
@@ -285,6 +293,37 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(test_string, contents,
                          msg="get_output_from_command('cat file') differs from fh.write")
 
+    def test_get_output_from_command_output_limit(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        contents = self.s.get_output_from_command(["seq", "10"], output_limit=4)
+        self.assertEqual(contents, "1\n2\n[... 6 lines omitted ...]\n9\n10")
+
+    def test_get_output_from_command_stderr(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.get_output_from_command(["bash", "-c", "echo out; echo err >&2"])
+        self.assertTrue(' err' in open("test_logs/test_info.log").read())
+        self.assertFalse(os.path.exists('tmpfile_stdout'))
+
+    def test_run_commands_parallel(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        returncodes = self.s.run_commands_parallel([
+            {'command': ['bash', '-c', 'echo hello'], 'name': 'first'},
+            {'command': ['bash', '-c', 'exit 3']},
+            {'command': ['bash', '-c', 'exit 3'], 'success_codes': [3]},
+        ])
+        self.assertEqual(returncodes, [0, 3, 3])
+        self.assertTrue('[first]  hello' in open('test_logs/test_info.log').read())
+
+    def test_run_commands_parallel_halt_on_failure(self):
+        os.mkdir('test_dir')
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertRaises(SystemExit, self.s.run_commands_parallel, [
+            {'command': ['bash', '-c', 'echo error']},
+            {'command': ['touch', 'test_dir/ran']},
+        ], max_workers=1, halt_on_failure=True,
+            error_list=[{'substr': 'error', 'level': ERROR}])
+        self.assertFalse(os.path.exists('test_dir/ran'))
+
     def test_run_command(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -319,6 +358,41 @@ class TestHelperFunctions(unittest.TestCase):
                          msg="%s and %s are different sizes after copyfile()" %
                              (self.temp_file, temp_file2))
 
+    def _create_copytree_src(self):
+        self.s.mkdir_p('test_dir/src/sub')
+        for f in ('a', 'sub/b'):
+            self.s.write_to_file('test_dir/src/%s' % f, 'src %s' % f)
+
+    def test_copytree(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.assertEqual(self.s.copytree('test_dir/src', 'test_dir/dest'), None)
+        self.assertEqual(open('test_dir/dest/sub/b').read(), 'src sub/b')
+
+    def test_copytree_overwrite(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        for overwrite, expected in (('no_overwrite', 'dest a'),
+                                    ('overwrite_if_exists', 'src a'),
+                                    ('clobber', 'src a')):
+            self.s.rmtree('test_dir/dest')
+            self.s.mkdir_p('test_dir/dest')
+            self.s.write_to_file('test_dir/dest/a', 'dest a')
+            self.s.write_to_file('test_dir/dest/c', 'dest c')
+            self.s.copytree('test_dir/src', 'test_dir/dest', overwrite=overwrite)
+            self.assertEqual(open('test_dir/dest/a').read(), expected)
+            self.assertEqual(open('test_dir/dest/sub/b').read(), 'src sub/b')
+            self.assertEqual(os.path.exists('test_dir/dest/c'),
+                             overwrite != 'clobber')
+
+    def test_copytree_hardlink(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        with mock.patch('mozharness.base.copying._reflink', return_value=False):
+            self.s.copytree('test_dir/src', 'test_dir/dest', link_mode='hardlink')
+        self.assertEqual(os.stat('test_dir/dest/sub/b').st_ino,
+                         os.stat('test_dir/src/sub/b').st_ino)
+
     def test_existing_rmtree(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -327,6 +401,32 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertFalse(os.path.exists('test_dir'),
                          msg="rmtree unsuccessful")
 
+    def test_deferred_rmtree(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir/foo/bar/baz')
+        trash_dir = os.path.abspath('test_logs/trash')
+        with mock.patch.object(script, 'trash_dir_for',
+                               return_value=trash_dir):
+            self.s.rmtree('test_dir', deferred=True)
+        self.assertFalse(os.path.exists('test_dir'),
+                         msg="deferred rmtree didn't move test_dir away")
+        self.assertEqual(self.s._trash_emptiers[trash_dir].wait(), 0)
+        self.assertEqual(os.listdir(trash_dir), [])
+
+    def test_stamp_dir_used(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.stamp_dir_used('test_dir')
+        self.assertFalse(os.path.exists('test_logs/index.journal'))
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'purge_index': 'test_logs/index'})
+        self.s.stamp_dir_used('test_dir')
+        self.s.stamp_dir_used('test_logs', share=True)
+        stamps = [json.loads(l) for l in open('test_logs/index.journal')]
+        self.assertEqual([(st['path'], st.get('share')) for st in stamps],
+                         [(os.path.realpath('test_dir'), None),
+                          (os.path.realpath('test_logs'), True)])
+
     def test_nonexistent_rmtree(self):
         self.s = script.BaseScript(initial_config_file='test/test.json')
         status = self.s.rmtree('test_dir')
@@ -421,6 +521,152 @@ class TestHelperFunctions(unittest.TestCase):
         contents = self.s.read_from_file("nonexistent_file!!!")
         self.assertEqual(contents, None)
 
+    def _create_temp_zip(self):
+        os.mkdir('test_dir')
+        bundle = zipfile.ZipFile('test_dir/test.zip', 'w', zipfile.ZIP_DEFLATED)
+        bundle.writestr('bin/foo', test_string)
+        bundle.writestr('mochitest/bar', test_string * 100)
+        bundle.writestr('reftest/baz', test_string)
+        bundle.close()
+
+    def test_unpack_zip(self):
+        self._create_temp_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.unpack('test_dir/test.zip', 'test_dir/out',
+                      target_unzip_dirs=['bin/*', 'mochitest/*'])
+        self.assertEqual(self.s.read_from_file('test_dir/out/mochitest/bar'),
+                         test_string * 100)
+        self.assertTrue(os.path.exists('test_dir/out/bin/foo'))
+        self.assertFalse(os.path.exists('test_dir/out/reftest'))
+
+    def test_download_unzip(self):
+        self._create_temp_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        namelist = self.s.download_unzip('test_dir/test.zip', 'test_dir/out')
+        self.assertEqual(sorted(namelist),
+                         ['bin/foo', 'mochitest/bar', 'reftest/baz'])
+        self.assertEqual(self.s.read_from_file('test_dir/out/reftest/baz'),
+                         test_string)
+
+    def test_summary_download_cache(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'download_cache_dir': 'test_dir/cache'})
+        self.s.summary()
+        self.assertFalse(os.path.exists('test_dir/cache'))
+        self.s.query_download_cache().hits = 1
+        self.s.summary()
+        self.assertEqual([item['message'] for item in self.s.summary_list],
+                         ['Download cache: 1 hits, 0 misses, 0 bytes saved.'])
+
+    def test_download_unzip_network_error(self):
+        self._create_temp_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        urlopen = self.s._urlopen
+        attempts = []
+
+        def flaky_urlopen(url, **kwargs):
+            f = urlopen(url, **kwargs)
+            attempts.append(url)
+            if len(attempts) == 1:
+                def read(*args):
+                    raise socket.error(104, 'Connection reset by peer')
+                f.read = read
+            return f
+        self.s._urlopen = flaky_urlopen
+        with mock.patch.object(self.s, 'log', wraps=self.s.log) as log:
+            namelist = self.s.download_unzip('test_dir/test.zip', 'test_dir/out',
+                                             retry_config={'sleeptime': 0})
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(sorted(namelist),
+                         ['bin/foo', 'mochitest/bar', 'reftest/baz'])
+        # retried, but not logged as an error
+        self.assertEqual([c for c in log.call_args_list
+                          if c[1].get('level') in (ERROR, FATAL)], [])
+
+
+# TestDownloadFile {{{1
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves self.server.contents, honouring Range requests. The first
+    self.server.truncate_first full GETs are cut off halfway."""
+    def do_GET(self):
+        contents = self.server.contents
+        self.server.requests.append(self.headers.get('Range'))
+        start, end = 0, len(contents) - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == '"etag"':
+            start, end = [int(x) for x in range_header[len('bytes='):].split('-')]
+            status = 206
+        body = contents[start:end + 1]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"etag"')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(contents)))
+        self.end_headers()
+        if status == 200 and self.server.truncate_first:
+            self.server.truncate_first -= 1
+            body = body[:len(body) / 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFile(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.contents = os.urandom(300000)
+        self.server.requests = []
+        self.server.truncate_first = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/file' % self.server.server_address[1]
+        self.s = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if hasattr(self, 's') and isinstance(self.s, object):
+            del(self.s)
+        cleanup()
+
+    def test_resume(self):
+        self.server.truncate_first = 1
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        status = self.s.download_file(self.url, parent_dir='test_dir',
+                                      retry_config={'sleeptime': 0})
+        self.assertEqual(status, os.path.join('test_dir', 'file'))
+        self.assertEqual(open(status, 'rb').read(), self.server.contents)
+        self.assertEqual(self.server.requests, [None, 'bytes=150000-299999'])
+
+    def test_parallel_ranges(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'download_parallel_chunks': 3,
+                                           'download_parallel_min_size': 1})
+        status = self.s.download_file(self.url, parent_dir='test_dir')
+        self.assertEqual(open(status, 'rb').read(), self.server.contents)
+        self.assertEqual(sorted(self.server.requests[1:]),
+                         ['bytes=0-99999', 'bytes=100000-199999',
+                          'bytes=200000-299999'])
+
+    def test_proxxy_parallel_ranges(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json',
+                                   config={'download_parallel_chunks': 3,
+                                           'download_parallel_min_size': 1,
+                                           'proxxy': {'urls': [], 'instances': []}})
+        proxxy = Proxxy(self.s.config, self.s.log_obj)
+        status = proxxy.download_proxied_file(self.url, file_name='file',
+                                              parent_dir='test_dir')
+        self.assertEqual(open(status, 'rb').read(), self.server.contents)
+        self.assertEqual(sorted(self.server.requests[1:]),
+                         ['bytes=0-99999', 'bytes=100000-199999',
+                          'bytes=200000-299999'])
+
 
 # TestScriptLogging {{{1
 class TestScriptLogging(unittest.TestCase):
@@ -701,10 +947,11 @@ class TestScriptDecorators(unittest.TestCase):
     def test_decorators_registered(self):
         self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
 
+        # plus BaseScript's own resource sampling listeners
         self.assertEqual(len(self.s._listeners['pre_run']), 1)
-        self.assertEqual(len(self.s._listeners['pre_action']), 3)
-        self.assertEqual(len(self.s._listeners['post_action']), 3)
-        self.assertEqual(len(self.s._listeners['post_run']), 2)
+        self.assertEqual(len(self.s._listeners['pre_action']), 4)
+        self.assertEqual(len(self.s._listeners['post_action']), 4)
+        self.assertEqual(len(self.s._listeners['post_run']), 3)
 
     def test_pre_post_fired(self):
         self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
@@ -740,6 +987,43 @@ class TestScriptDecorators(unittest.TestCase):
 
         self.assertEqual(self.s.post_run_1_args[0], ((), {}))
 
+    @unittest.skipUnless(resource_sampling_supported(), "Needs /proc")
+    def test_resources_sampled(self):
+        self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
+        self.s.run()
+        self.assertFalse(self.s._resource_sampler.running)
+        path = os.path.join(self.s.query_abs_dirs()['abs_log_dir'],
+                            script.RESOURCE_USAGE_FILE)
+        phases = [sample['phase'] for sample in read_samples(path)]
+        self.assertEqual(phases[0], '-')
+        self.assertEqual(phases[-1], '-')
+        # the start and end of each, and maybe samples in between
+        self.assertEqual([p for (i, p) in enumerate(phases)
+                          if p != '-' and p != phases[i - 1]],
+                         ['clobber', 'build'])
+        self.assertTrue(phases.count('clobber') >= 2)
+        self.assertTrue(phases.count('build') >= 2)
+
+    def test_trace_written(self):
+        self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
+        self.s.build = lambda: self.s.run_command(['false'])
+        self.s.run()
+        path = os.path.join(self.s.query_abs_dirs()['abs_upload_dir'],
+                            script.TRACE_FILE)
+        with open(path) as fh:
+            events = json.load(fh)['traceEvents']
+        spans = dict((e['name'], e) for e in events)
+        self.assertEqual(spans['clobber']['cat'], 'action')
+        self.assertEqual(spans['clobber']['args']['success'], True)
+        self.assertEqual(spans['build']['args']['success'], True)
+        self.assertEqual(spans['false']['cat'], 'command')
+        self.assertEqual(spans['false']['args']['exit_status'], 1)
+        self.assertEqual(spans['false']['args']['parent'],
+                         spans['build']['args']['id'])
+        self.assertEqual(spans['pre_action_3']['args']['parent'],
+                         spans['clobber']['args']['id'])
+        self.assertEqual(spans['post_run_1']['cat'], 'listener')
+
     def test_post_always_fired(self):
         self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
         self.s.raise_during_build = 'Testing post always fired.'
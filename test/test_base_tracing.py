@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mozharness.base.tracing import Tracer, name_for
+
+
+class TestTracer(unittest.TestCase):
+    def test_nesting(self):
+        tracer = Tracer()
+        with tracer.span('build', 'action') as outer:
+            with tracer.span(['make', '-j4'], 'command') as inner:
+                tracer.annotate(exit_status=2)
+        self.assertEqual([s.name for s in tracer.spans], ['make -j4', 'build'])
+        self.assertEqual(inner.parent_id, outer.id)
+        self.assertEqual(outer.parent_id, None)
+        self.assertEqual(inner.args, {'exit_status': 2})
+        self.assertTrue(outer.duration >= inner.duration >= 0)
+
+    def test_error(self):
+        tracer = Tracer()
+        with self.assertRaises(SystemExit):
+            with tracer.span('build', 'action'):
+                raise SystemExit(2)
+        self.assertEqual(tracer.spans[0].args, {'error': 'SystemExit'})
+        self.assertEqual(tracer.current(), None)
+
+    def test_worker_threads(self):
+        tracer = Tracer()
+
+        def work():
+            with tracer.span('upload', 'command'):
+                pass
+        with tracer.span('upload-files', 'action') as action:
+            threads = [threading.Thread(target=work) for _ in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        commands = [s for s in tracer.spans if s.category == 'command']
+        self.assertEqual(len(commands), 3)
+        for span in commands:
+            self.assertEqual(span.parent_id, action.id)
+
+    def test_slowest(self):
+        tracer = Tracer()
+        for name in ('a', 'b', 'c'):
+            with tracer.span(name, 'action'):
+                pass
+        for span, duration in zip(tracer.spans, (2.0, 5.0, 1.0)):
+            span.duration = duration
+        self.assertEqual([s.name for s in tracer.slowest(2)], ['b', 'a'])
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tracer = Tracer()
+            with tracer.span('download', 'action'):
+                with tracer.span('http://example.com/a.zip', 'download'):
+                    tracer.annotate(bytes=1024)
+            path = os.path.join(tmpdir, 'trace.json')
+            tracer.write(path)
+            with open(path) as fh:
+                events = json.load(fh)['traceEvents']
+            self.assertEqual([e['name'] for e in events],
+                             ['download', 'http://example.com/a.zip'])
+            self.assertEqual(events[1]['args'],
+                             {'bytes': 1024, 'id': 2, 'parent': 1})
+            self.assertEqual(events[1]['ph'], 'X')
+            self.assertTrue(events[0]['ts'] <= events[1]['ts'])
+            self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_name_for(self):
+        self.assertEqual(name_for(['hg', 'clone', 'a b']), 'hg clone "a b"')
+        self.assertEqual(name_for(name_for), 'name_for')
+        self.assertEqual(len(name_for('x' * 1000)), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import itertools
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import mozharness.base.trash as trash
+
+
+def make_tree(root, num_dirs=3, num_files=5):
+    for i in range(num_dirs):
+        d = os.path.join(root, 'dir%d' % i, 'sub')
+        os.makedirs(d)
+        for j in range(num_files):
+            with open(os.path.join(d, 'file%d' % j), 'w') as fh:
+                fh.write('x' * 100)
+    os.symlink('dir0', os.path.join(root, 'link'))
+
+
+class TestTrash(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tree = os.path.join(self.tmpdir, 'objdir')
+        self.trash_dir = os.path.join(self.tmpdir, trash.TRASH_DIR_NAME)
+        make_tree(self.tree)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_trash_dir_for(self):
+        trash_dir = trash.trash_dir_for(self.tree)
+        self.assertEqual(os.path.basename(trash_dir), trash.TRASH_DIR_NAME)
+        parent = os.path.dirname(trash_dir)
+        self.assertTrue(self.tree.startswith(parent.rstrip(os.sep) + os.sep))
+        self.assertEqual(os.stat(parent).st_dev, os.stat(self.tmpdir).st_dev)
+
+    def test_move_to_trash(self):
+        moved = trash.move_to_trash(self.tree, self.trash_dir)
+        self.assertFalse(os.path.exists(self.tree))
+        self.assertEqual(os.path.basename(moved), 'objdir')
+        self.assertTrue(os.path.isfile(os.path.join(moved, 'dir1', 'sub', 'file1')))
+        # the same name can be trashed again
+        make_tree(self.tree)
+        trash.move_to_trash(self.tree, self.trash_dir)
+        self.assertEqual(len(os.listdir(self.trash_dir)), 2)
+
+    def test_move_to_trash_failure(self):
+        self.assertRaises(OSError, trash.move_to_trash,
+                          os.path.join(self.tmpdir, 'missing'), self.trash_dir)
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_empty_trash(self):
+        trash.move_to_trash(self.tree, self.trash_dir)
+        make_tree(self.tree)
+        os.chmod(os.path.join(self.tree, 'dir2', 'sub'), 0500)
+        trash.move_to_trash(self.tree, self.trash_dir)
+        self.assertEqual(trash.empty_trash(self.trash_dir, max_workers=2), 2)
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_empty_trash_stops_at_min_free(self):
+        trash.move_to_trash(self.tree, self.trash_dir)
+        # enough space once the trash entry's own directory was walked
+        free = itertools.chain([0, 0], itertools.repeat(10))
+        with mock.patch.object(trash, 'query_free_space',
+                               lambda path: next(free)):
+            self.assertEqual(trash.empty_trash(self.trash_dir, min_free=10,
+                                               max_workers=1), 0)
+        moved = os.listdir(self.trash_dir)
+        self.assertEqual(len(moved), 1)
+        objdir = os.path.join(self.trash_dir, moved[0], 'objdir')
+        self.assertEqual(len(os.listdir(objdir)), 4)
+
+    def test_spawn_trash_emptier(self):
+        trash.move_to_trash(self.tree, self.trash_dir)
+        emptier = trash.spawn_trash_emptier(self.trash_dir)
+        self.assertEqual(emptier.wait(), 0)
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mozharness.base.vcs.mapfile as mapfile
+
+
+def sha(*args):
+    return hashlib.sha1(repr(args)).hexdigest()
+
+
+def make_pairs(num, seed=0):
+    return sorted(((sha('git', seed, i), sha('hg', seed, i)) for i in range(num)),
+                  key=lambda p: (p[1], p[0]))
+
+
+class TestMapfile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pairs = make_pairs(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, pairs):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fh:
+            fh.write(''.join('%s %s\n' % p for p in pairs))
+        return path
+
+    def test_read_write(self):
+        path = os.path.join(self.tmpdir, 'mapfile')
+        self.assertEqual(mapfile.write_mapfile(path, self.pairs), len(self.pairs))
+        self.assertEqual(list(mapfile.read_mapfile(path)), self.pairs)
+        self.assertEqual(os.listdir(self.tmpdir), ['mapfile'])
+
+    def test_write_fails(self):
+        path = self._write('mapfile', self.pairs)
+
+        def pairs():
+            yield self.pairs[0]
+            raise SystemExit(1)
+        self.assertRaises(SystemExit, mapfile.write_mapfile, path, pairs())
+        self.assertEqual(list(mapfile.read_mapfile(path)), self.pairs)
+        self.assertEqual(os.listdir(self.tmpdir), ['mapfile'])
+
+    def test_read_bad(self):
+        path = self._write('mapfile', self.pairs[:2])
+        with open(path, 'a') as fh:
+            fh.write('junk\n')
+        self.assertRaises(mapfile.MapfileError, list, mapfile.read_mapfile(path))
+
+    def test_read_unsorted(self):
+        shuffled = self.pairs[:]
+        random.Random(1).shuffle(shuffled)
+        path = self._write('mapfile', shuffled)
+        self.assertRaises(mapfile.UnsortedMapfileError, list,
+                          mapfile.read_mapfile(path))
+        self.assertEqual(sorted(mapfile.read_mapfile(path, check_order=False)),
+                         sorted(shuffled))
+        self.assertEqual(list(mapfile.read_sorted(path)), self.pairs)
+        self.assertEqual(list(mapfile.read_sorted(path, chunk_size=64)), self.pairs)
+
+    def test_sort_pairs(self):
+        shuffled = self.pairs[:]
+        random.Random(2).shuffle(shuffled)
+        self.assertEqual(list(mapfile.sort_pairs(shuffled)), self.pairs)
+        # sorted on disk
+        self.assertEqual(list(mapfile.sort_pairs(shuffled, chunk_size=100)), self.pairs)
+        self.assertEqual(list(mapfile.sort_pairs([])), [])
+
+    def test_merge(self):
+        a = self.pairs[::2]
+        b = self.pairs[::3]
+        c = self.pairs[1::5] + self.pairs[1::5]
+        c.sort(key=lambda p: (p[1], p[0]))
+        expected = sorted(set(a + b + c), key=lambda p: (p[1], p[0]))
+        self.assertEqual(list(mapfile.merge([a, b, c])), expected)
+        self.assertEqual(list(mapfile.merge([])), [])
+
+    def test_merge_like_sort(self):
+        paths = [self._write('a', self.pairs[::2]),
+                 self._write('b', self.pairs[::3] + make_pairs(10, 1))]
+        expected = subprocess.check_output(['sort', '--unique', '-t', ' ', '--key=2'] + paths,
+                                           env=dict(os.environ, LC_ALL='C'))
+        merged = os.path.join(self.tmpdir, 'merged')
+        mapfile.write_mapfile(merged, mapfile.merge([mapfile.read_sorted(p) for p in paths]))
+        self.assertEqual(open(merged).read(), expected)
+
+    def test_merge_conflict(self):
+        hg_sha = self.pairs[5][1]
+        a = self.pairs[:10]
+        b = [(sha('other'), hg_sha)]
+        conflicts = []
+        merged = list(mapfile.merge([a, b], conflict=lambda *args: conflicts.append(args)))
+        self.assertEqual(merged, a)
+        self.assertEqual(conflicts, [(self.pairs[5], b[0])])
+
+    def test_difference(self):
+        old = self.pairs[::2] + make_pairs(10, 1)
+        old.sort(key=lambda p: (p[1], p[0]))
+        new = self.pairs + make_pairs(5, 2)
+        new.sort(key=lambda p: (p[1], p[0]))
+        expected = [p for p in new if p not in set(old)]
+        self.assertEqual(list(mapfile.difference(new, old)), expected)
+        self.assertEqual(list(mapfile.difference(new, [])), new)
+        self.assertEqual(list(mapfile.difference([], new)), [])
+
+
+class TestMapFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mapfile')
+        self.pairs = make_pairs(1000)
+        mapfile.write_mapfile(self.path, self.pairs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_git_sha(self):
+        with mapfile.MapFile(self.path) as m:
+            for git_sha, hg_sha in self.pairs[:100] + self.pairs[-100:]:
+                self.assertEqual(m.git_sha(hg_sha), git_sha)
+                # as `hg id` gives them
+                self.assertEqual(m.git_sha(hg_sha[:12]), git_sha)
+            self.assertEqual(m.git_sha(sha('missing')), None)
+            self.assertEqual(m.git_sha('f' * 40), None)
+            self.assertEqual(m.git_sha('0' * 40), None)
+        # the index is only built for hg_sha()
+        self.assertEqual(os.listdir(self.tmpdir), ['mapfile'])
+
+    def test_hg_sha(self):
+        with mapfile.MapFile(self.path) as m:
+            for git_sha, hg_sha in self.pairs:
+                self.assertEqual(m.hg_sha(git_sha), hg_sha)
+                self.assertEqual(m.hg_sha(git_sha[:7]), hg_sha)
+                self.assertEqual(m.hg_sha(git_sha[:12]), hg_sha)
+            self.assertEqual(m.hg_sha(sha('missing')), None)
+            self.assertEqual(m.hg_sha('f' * 40), None)
+        self.assertTrue(os.path.exists(self.path + mapfile.INDEX_SUFFIX))
+
+    def test_index_rebuilt(self):
+        with mapfile.MapFile(self.path) as m:
+            m.hg_sha(self.pairs[0][0])
+        index_mtime = os.path.getmtime(self.path + mapfile.INDEX_SUFFIX)
+        with mapfile.MapFile(self.path) as m:
+            self.assertEqual(m.hg_sha(self.pairs[1][0]), self.pairs[1][1])
+        self.assertEqual(os.path.getmtime(self.path + mapfile.INDEX_SUFFIX), index_mtime)
+        # same size, different contents
+        pairs = make_pairs(1000, 1)
+        mapfile.write_mapfile(self.path, pairs)
+        os.utime(self.path, (0, 0))
+        with mapfile.MapFile(self.path) as m:
+            self.assertEqual(m.hg_sha(pairs[1][0]), pairs[1][1])
+            self.assertEqual(m.hg_sha(self.pairs[1][0]), None)
+
+    def test_empty(self):
+        mapfile.write_mapfile(self.path, [])
+        with mapfile.MapFile(self.path) as m:
+            self.assertEqual(m.git_sha(self.pairs[0][1]), None)
+            self.assertEqual(m.hg_sha(self.pairs[0][0]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
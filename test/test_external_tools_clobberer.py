@@ -0,0 +1,54 @@
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from external_tools import clobberer
+
+
+class TestClobber(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        # do_clobber() works on the current directory, like clobberer.py
+        os.chdir(self.tmpdir)
+        for name in ('build', 'tools', 'old' + clobberer.clobber_suffix):
+            os.makedirs(os.path.join(name, 'sub'))
+        open('file', 'w').close()
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_clobber(self):
+        clobberer.do_clobber(self.tmpdir, skip=['tools'])
+        self.assertEqual(os.listdir('.'), ['tools'])
+
+    def test_clobber_dryrun(self):
+        clobberer.do_clobber(self.tmpdir, dryrun=True, background=True)
+        self.assertEqual(len(os.listdir('.')), 4)
+
+    def test_clobber_background(self):
+        deferred = []
+        with mock.patch.object(clobberer, 'rmdirRecursiveInBackground',
+                               deferred.extend):
+            clobberer.do_clobber(self.tmpdir, skip=['tools'], background=True)
+        # files go right away; directories are renamed and left to the
+        # background
+        build = os.path.join(os.getcwd(), 'build' + clobberer.clobber_suffix)
+        old = os.path.join(os.getcwd(), 'old' + clobberer.clobber_suffix)
+        self.assertEqual(sorted(deferred), [build, old])
+        self.assertEqual(sorted(os.listdir('.')),
+                         sorted([os.path.basename(build), os.path.basename(old), 'tools']))
+
+    def test_rmdir_recursive_in_background(self):
+        dirs = [os.path.join(self.tmpdir, d) for d in ('build', 'tools')]
+        os.chmod(os.path.join('build', 'sub'), 0500)
+        clobberer.rmdirRecursiveInBackground(dirs)
+        deadline = time.time() + 10
+        while [d for d in dirs if os.path.exists(d)] and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(sorted(os.listdir('.')),
+                         ['file', 'old' + clobberer.clobber_suffix])
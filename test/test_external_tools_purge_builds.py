@@ -0,0 +1,265 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from external_tools import purge_builds
+
+GB = 1024 * 1024 * 1024
+DAY = 24 * 3600
+
+
+def wait_for_removal(paths, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not [p for p in paths if os.path.exists(p)]:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class TestPurge(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmpdir, 'builds')
+        self.trash_dir = os.path.join(self.tmpdir, 'trash')
+        os.mkdir(self.base_dir)
+        os.mkdir(self.trash_dir)
+        self.now = time.time()
+        # directory -> the GB deleting it frees, as far as freespace() knows
+        self.sizes = {}
+        self.deferred = []
+        patchers = [
+            mock.patch.object(purge_builds, 'freespace', self._freespace),
+            mock.patch.object(purge_builds, 'rmdirRecursiveInBackground',
+                              self.deferred.extend),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _freespace(self, p):
+        return sum(size for d, size in self.sizes.items()
+                   if not os.path.exists(d) and
+                   not os.path.exists(d + purge_builds.clobber_suffix)) * GB
+
+    def _make_dir(self, name, age, size=1, parent=None):
+        d = os.path.join(parent or self.base_dir, name)
+        os.makedirs(os.path.join(d, 'sub'))
+        with open(os.path.join(d, 'sub', 'file'), 'w') as fh:
+            fh.write('x' * 100)
+        mtime = self.now - age * DAY
+        os.utime(d, (mtime, mtime))
+        self.sizes[d] = size
+        return d
+
+    def _purge(self, gigs, max_age=10, **kwargs):
+        purge_builds.purge([self.base_dir], gigs, [], self.now - max_age * DAY,
+                           **kwargs)
+        return sorted(os.listdir(self.base_dir))
+
+    def test_purge(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        self._make_dir('old', age=20)
+        # the old one goes regardless, then the oldest until there's room
+        self.assertEqual(self._purge(2), ['build0', 'build1', 'build2'])
+        self.assertEqual(self.deferred, [])
+
+    def test_purge_trash_first(self):
+        self._make_dir('build0', age=1)
+        self._make_dir('build1', age=2)
+        self._make_dir('clobbered', age=0, size=2, parent=self.trash_dir)
+        self.assertEqual(self._purge(2, trash_dirs=[self.trash_dir]),
+                         ['build0', 'build1'])
+        self.assertEqual(os.listdir(self.trash_dir), [])
+        # once the trash is empty, the builds are next
+        self.assertEqual(self._purge(3, trash_dirs=[self.trash_dir]), ['build0'])
+
+    def test_purge_background(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        old = [self._make_dir('old%d' % i, age=20 + i) for i in range(2)]
+        # old1 is needed for space, so it's gone before we return; old0
+        # is only too old, and can go to the background
+        self.assertEqual(self._purge(1, background=True),
+                         ['build0', 'build1', 'build2', 'build3',
+                          'old0' + purge_builds.clobber_suffix])
+        self.assertEqual(self.deferred, [old[0] + purge_builds.clobber_suffix])
+
+    def test_purge_background_needs_space(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        self._make_dir('old', age=20)
+        self.assertEqual(self._purge(3, background=True), ['build0', 'build1'])
+        self.assertEqual(self.deferred, [])
+
+    def _index(self, **last_used):
+        index = purge_builds.UsageIndex(os.path.join(self.tmpdir, 'index'))
+        for name, age in last_used.items():
+            index.dirs[os.path.realpath(os.path.join(self.base_dir, name))] = {
+                'last_used': self.now - age * DAY}
+        return index
+
+    def test_purge_index(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        self._make_dir('old', age=20)
+        # by when they were last used, not mtime
+        index = self._index(old=0, build3=0)
+        self.assertEqual(self._purge(2, index=index), ['build0', 'build3', 'old'])
+        self.assertEqual(sorted(index.dirs), [os.path.realpath(os.path.join(self.base_dir, d))
+                                              for d in ('build3', 'old')])
+
+    def test_purge_index_background(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        old = [self._make_dir('old%d' % i, age=20 + i) for i in range(2)]
+        index = self._index()
+        # what the index thinks deleting them frees
+        for d, size in self.sizes.items():
+            index.dirs[os.path.realpath(d)] = {'size': size * GB, 'measured': self.now}
+        # the space comes from old1, which is gone before we return; only
+        # old0 goes to the background
+        self.assertEqual(self._purge(1, index=index, background=True),
+                         ['build0', 'build1', 'build2', 'build3',
+                          'old0' + purge_builds.clobber_suffix])
+        self.assertEqual(self.deferred, [old[0] + purge_builds.clobber_suffix])
+
+    def test_purge_index_background_wrong_sizes(self):
+        for i in range(4):
+            self._make_dir('build%d' % i, age=i)
+        index = self._index()
+        build3 = os.path.join(self.base_dir, 'build3')
+        index.dirs[os.path.realpath(build3)] = {'size': 10 * GB, 'measured': self.now}
+        # build3 frees less than the index says, so build2 has to go too
+        self.assertEqual(self._purge(2, index=index, background=True),
+                         ['build0', 'build1'])
+        self.assertEqual(self.deferred, [])
+
+    def test_purge_dry_run(self):
+        for i in range(2):
+            self._make_dir('build%d' % i, age=i)
+        self.assertEqual(self._purge(5, dry_run=True, background=True),
+                         ['build0', 'build1'])
+        self.assertEqual(self.deferred, [])
+
+
+class TestUsageIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index')
+        self.now = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stamp(self, *stamps):
+        with open(self.path + '.journal', 'a') as fh:
+            for stamp in stamps:
+                fh.write((stamp if isinstance(stamp, str) else json.dumps(stamp)) + '\n')
+
+    def _dir(self, name):
+        d = os.path.join(self.tmpdir, name)
+        os.makedirs(d)
+        with open(os.path.join(d, 'file'), 'w') as fh:
+            fh.write('x' * 10000)
+        return os.path.realpath(d)
+
+    def test_journal(self):
+        a, b = self._dir('a'), self._dir('b')
+        self._stamp({'path': a, 'last_used': 100},
+                    {'path': b, 'last_used': 300, 'share': True},
+                    'not json',
+                    {'path': a},
+                    {'path': a, 'last_used': 200},
+                    {'path': a, 'last_used': 50})
+        index = purge_builds.UsageIndex(self.path)
+        self.assertEqual(index.dirs, {a: {'last_used': 200},
+                                      b: {'last_used': 300, 'share': True}})
+        # stamps written from now on go to a new journal
+        self.assertFalse(os.path.exists(self.path + '.journal'))
+        self._stamp({'path': a, 'last_used': 400})
+        index.save()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['a', 'b', 'index', 'index.journal'])
+        index = purge_builds.UsageIndex(self.path)
+        self.assertEqual(index.last_used(a), 400)
+        self.assertEqual(index.last_used(b), 300)
+
+    def test_last_used(self):
+        share = self._dir('share')
+        repo = self._dir(os.path.join('share', 'repo'))
+        other = self._dir('other')
+        self._stamp({'path': share, 'last_used': 300, 'share': True},
+                    {'path': repo, 'last_used': 100},
+                    {'path': os.path.join(other, 'sub'), 'last_used': 200})
+        index = purge_builds.UsageIndex(self.path)
+        self.assertEqual(index.last_used(os.path.join(self.tmpdir, 'missing')), 0)
+        # used along with the share it's in
+        self.assertEqual(index.last_used(repo), 300)
+        self.assertEqual(index.last_used(share), 300)
+        # only shares count for what's inside them
+        self.assertEqual(index.last_used(other), 0)
+
+    def test_shares(self):
+        share_dir = self._dir('shares')
+        repos = [self._dir(os.path.join('shares', name)) for name in ('a', 'b')]
+        index = purge_builds.UsageIndex(self.path)
+        # never walked
+        self.assertEqual(index.shares(share_dir), None)
+        index.set_shares(share_dir, repos)
+        self.assertEqual(index.shares(share_dir), repos)
+        shutil.rmtree(repos[0])
+        self.assertEqual(index.shares(share_dir), repos[1:])
+        index.save()
+        index = purge_builds.UsageIndex(self.path)
+        self.assertEqual(index.shares(share_dir), repos[1:])
+        # not walked recently enough
+        index.scans[share_dir] -= purge_builds.SHARE_RESCAN_INTERVAL + 1
+        self.assertEqual(index.shares(share_dir), None)
+
+    def test_size(self):
+        d = self._dir('d')
+        index = purge_builds.UsageIndex(self.path)
+        size = index.size(d)
+        self.assertTrue(size >= 10000)
+        # kept...
+        with open(os.path.join(d, 'file'), 'a') as fh:
+            fh.write('x' * 100000)
+        self.assertEqual(index.size(d), size)
+        # ...until the directory is used again
+        index.dirs[d]['last_used'] = time.time() + 1
+        bigger = index.size(d)
+        self.assertTrue(bigger > size)
+        # or changed
+        os.remove(os.path.join(d, 'file'))
+        os.utime(d, (time.time() + 2, time.time() + 2))
+        self.assertTrue(index.size(d) < bigger)
+        index.forget(d)
+        self.assertEqual(index.dirs, {})
+
+
+class TestRmdirRecursiveInBackground(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rmdir_recursive_in_background(self):
+        dirs = []
+        for i in range(3):
+            d = os.path.join(self.tmpdir, 'dir%d' % i)
+            os.makedirs(os.path.join(d, 'sub'))
+            os.chmod(os.path.join(d, 'sub'), 0500)
+            dirs.append(d)
+        purge_builds.rmdirRecursiveInBackground(dirs)
+        self.assertTrue(wait_for_removal(dirs))
+        self.assertEqual(os.listdir(self.tmpdir), [])
@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+
+import mock
+
+from mozharness.mozilla.taskcluster_helper import Taskcluster
+
+TASK = {'status': {'taskId': 'task', 'runs': [{'runId': 0}]}}
+
+
+def cleanup():
+    if os.path.exists('test_dir'):
+        shutil.rmtree('test_dir')
+
+
+class UploadError(Exception):
+    pass
+
+
+class TestTaskcluster(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        # Taskcluster() imports the taskcluster client; skip that and hand
+        # it a mocked queue and session instead.
+        self.tc = Taskcluster.__new__(Taskcluster)
+        self.tc.log_obj = None
+        self.tc.max_uploads = 2
+        self.tc.upload_sleeptime = 0
+        self.tc.task_id = 'task'
+        self.tc.taskcluster_queue = mock.Mock()
+        self.put_urls = []
+        self.tc.taskcluster_queue.createArtifact.side_effect = self._create_artifact
+        self.tc.session = mock.Mock()
+        self.uploads = {}
+        self.fail = {}
+        self.tc.session.put.side_effect = self._put
+
+    def tearDown(self):
+        cleanup()
+
+    def _create_artifact(self, task_id, run_id, name, info):
+        put_url = 'https://s3.example.com/%s/%d' % (name, len(self.put_urls))
+        self.put_urls.append(put_url)
+        return {'putUrl': put_url}
+
+    def _put(self, put_url, data, headers):
+        name = os.path.basename(data.name)
+        contents = data.read()
+        self.assertEqual(headers['Content-Length'], str(len(contents)))
+        if self.fail.get(name):
+            self.fail[name] -= 1
+            raise UploadError(name)
+        self.uploads[name] = (put_url, contents)
+        return mock.Mock()
+
+    def _write(self, name, contents='contents'):
+        path = os.path.join('test_dir', name)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def test_create_artifact(self):
+        self.tc.create_artifact(TASK, self._write('target.zip'))
+        self.assertEqual(self.uploads, {
+            'target.zip': ('https://s3.example.com/public/build/target.zip/0', 'contents'),
+        })
+        self.assertEqual(
+            self.tc.taskcluster_queue.createArtifact.call_args[0][3]['contentType'],
+            'application/zip')
+
+    def test_create_artifact_retry(self):
+        self.fail['target.zip'] = 2
+        self.tc.create_artifact(TASK, self._write('target.zip'))
+        # each attempt gets a fresh putUrl
+        self.assertEqual(self.tc.session.put.call_count, 3)
+        self.assertEqual([c[0][0] for c in self.tc.session.put.call_args_list],
+                         self.put_urls)
+        self.assertEqual(len(set(self.put_urls)), 3)
+        self.assertEqual(self.uploads['target.zip'][0], self.put_urls[-1])
+
+    def test_create_artifact_fails(self):
+        self.fail['target.zip'] = self.tc.upload_attempts
+        self.assertRaises(UploadError, self.tc.create_artifact, TASK,
+                          self._write('target.zip'))
+        self.assertEqual(len(self.put_urls), self.tc.upload_attempts)
+
+    def test_create_artifacts_fails(self):
+        self.fail['b.zip'] = self.tc.upload_attempts
+        put = self._put
+        started = threading.Event()
+
+        def slow_put(put_url, data, headers):
+            if os.path.basename(data.name) == 'a.zip':
+                started.set()
+                time.sleep(0.5)
+            else:
+                started.wait()
+            return put(put_url, data, headers)
+        self.tc.session.put.side_effect = slow_put
+        files = [self._write(name) for name in ('a.zip', 'b.zip', 'c.zip', 'd.zip')]
+        self.assertRaises(UploadError, self.tc.create_artifacts, TASK, files)
+        # the upload in flight finished first; nothing new was started
+        self.assertEqual(sorted(self.uploads), ['a.zip'])
+        self.assertFalse(self.tc.taskcluster_queue.reportCompleted.called)
+
+    def test_create_artifact_snapshots(self):
+        log = self._write('log_info.log', 'before\n')
+        put = self._put
+        snapshots = []
+
+        def put_while_logging(put_url, data, headers):
+            snapshots.append(data.name)
+            with open(log, 'a') as fh:
+                fh.write('during\n')
+            return put(put_url, data, headers)
+        self.tc.session.put.side_effect = put_while_logging
+        self.tc.create_artifact_snapshots(TASK, [log])
+        self.assertEqual(self.uploads['log_info.log'][1], 'before\n')
+        self.assertNotEqual(os.path.abspath(snapshots[0]), os.path.abspath(log))
+        self.assertFalse(os.path.exists(os.path.dirname(snapshots[0])))
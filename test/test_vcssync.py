@@ -1,9 +1,19 @@
+import BaseHTTPServer
 import glob
+import mock
 import os
 import shutil
+import SocketServer
+import StringIO
 import subprocess
 import sys
+import threading
 import unittest
+import urllib2
+try:
+    import requests
+except ImportError:
+    requests = None
 
 import mozharness.base.log as log
 import mozharness.base.script as script
@@ -19,6 +29,15 @@ def cleanup():
     if os.path.exists('test_logs'):
         shutil.rmtree('test_logs')
 
+def get_converter(*args):
+    old_argv = sys.argv
+    sys.argv = ['vcs_sync.py', '--base-work-dir', os.path.abspath('test_logs'),
+                '--work-dir', '.'] + list(args)
+    try:
+        return vcs_sync.HgGitScript(require_config_file=False)
+    finally:
+        sys.argv = old_argv
+
 def _write_data_file(fname, *args):
     nl = '\n' if args[0][-1] != '\n' else ''
     with open(fname, 'wt') as df:
@@ -85,6 +104,675 @@ class TestVCSSync(unittest.TestCase):
         ec = os.system('cmp %s %s' % (diff_file, expected_diff))
         self.assertEquals(ec, 0)
 
+    def test_pull_out_new_sha_lookups(self):
+        converter = get_converter()
+        old_file = os.path.abspath(os.path.join('test_logs', 'old_file'))
+        new_file = os.path.abspath(os.path.join('test_logs', 'new_file'))
+        # sorted by the second field
+        _write_data_file(old_file, 'e 1', 'c 3', 'a 5')
+        _write_data_file(new_file, 'e 1', 'd 2', 'c 3', 'b 4', 'a 5', 'f 6')
+        self.assertEqual(list(converter.pull_out_new_sha_lookups(old_file, new_file)),
+                         ['d 2\n', 'b 4\n', 'f 6\n'])
+        # not sorted
+        _write_data_file(old_file, 'a 5', 'e 1')
+        self.assertEqual(list(converter.pull_out_new_sha_lookups(old_file, new_file)),
+                         ['d 2\n', 'c 3\n', 'b 4\n', 'f 6\n'])
+        os.remove(old_file)
+        self.assertEqual(len(list(converter.pull_out_new_sha_lookups(old_file, new_file))), 6)
+
+    def test_combine_mapfiles(self):
+        converter = get_converter()
+        cwd = os.path.abspath('test_logs')
+        _write_data_file(os.path.join(cwd, 'a-mapfile'), 'e 1', 'c 3', 'a 5')
+        _write_data_file(os.path.join(cwd, 'b-mapfile'), 'b 4', 'd 2', 'e 1')
+        converter._combine_mapfiles(['a-mapfile', 'b-mapfile', 'c-mapfile'],
+                                    'combined-mapfile', cwd=cwd)
+        with open(os.path.join(cwd, 'combined-mapfile')) as fh:
+            self.assertEqual(fh.read(), 'e 1\nd 2\nc 3\nb 4\na 5\n')
+        self.assertTrue(os.path.islink(os.path.join(cwd, 'combined-mapfile-latest')))
+
+
+class TestGitNotes(unittest.TestCase):
+    repo = 'https://hg.mozilla.org/mozilla-central'
+
+    def setUp(self):
+        cleanup()
+        self.git_dir = os.path.abspath(os.path.join('test_logs', 'repo', '.git'))
+        self._git('init', '-q', os.path.dirname(self.git_dir), cwd=None)
+        self._git('config', 'user.name', 'Test')
+        self._git('config', 'user.email', 'test@example.com')
+        self.shas = []
+        for i in range(4):
+            self._git('commit', '-q', '--allow-empty', '-m', 'commit %d' % i)
+            self.shas.append(self._git('rev-parse', 'HEAD').strip())
+        # a developer's note, and a note that's already there
+        self._git('notes', 'add', '-m', 'a dev note', self.shas[0])
+        self._git('notes', 'add', '-m', self._note(1), self.shas[1])
+        self.converter = get_converter()
+        self.sha_lookups = ['%s %040d\n' % (sha, i)
+                            for (i, sha) in enumerate(self.shas)]
+
+    def tearDown(self):
+        cleanup()
+
+    def _git(self, *args, **kwargs):
+        return subprocess.check_output(['git'] + list(args),
+                                       cwd=kwargs.get('cwd', os.path.dirname(self.git_dir)))
+
+    def _note(self, i):
+        return 'Upstream source: %s/rev/%040d' % (self.repo, i)
+
+    def _notes(self):
+        return [self._git('notes', 'show', sha).rstrip('\n') for sha in self.shas]
+
+    def test_add_git_notes_in_bulk(self):
+        noted = self.converter._add_git_notes_in_bulk(
+            ['git'], self.git_dir, self.repo, self.sha_lookups)
+        self.assertEqual(noted, self.sha_lookups)
+        notes = self._notes()
+        self.assertEqual(notes, ['a dev note\n\n' + self._note(0)] +
+                         [self._note(i) for i in range(1, 4)])
+        # same notes as |git notes append|
+        self._git('update-ref', '-d', 'refs/notes/commits')
+        self._git('notes', 'add', '-m', 'a dev note', self.shas[0])
+        self._git('notes', 'add', '-m', self._note(1), self.shas[1])
+        noted = self.converter._add_git_notes_one_by_one(
+            ['git'], self.git_dir, self.repo, self.sha_lookups)
+        self.assertEqual(noted, self.sha_lookups)
+        self.assertEqual(self._notes(), notes)
+
+    def test_add_git_notes_in_bulk_again(self):
+        self.converter._add_git_notes_in_bulk(
+            ['git'], self.git_dir, self.repo, self.sha_lookups)
+        notes_ref = self._git('rev-parse', 'refs/notes/commits')
+        noted = self.converter._add_git_notes_in_bulk(
+            ['git'], self.git_dir, self.repo, self.sha_lookups)
+        self.assertEqual(noted, self.sha_lookups)
+        self.assertEqual(self._git('rev-parse', 'refs/notes/commits'), notes_ref)
+
+    def test_add_git_notes_in_bulk_fails(self):
+        notes_ref = self._git('rev-parse', 'refs/notes/commits')
+        noted = self.converter._add_git_notes_in_bulk(
+            ['git'], self.git_dir, self.repo,
+            self.sha_lookups + ['%040d %040d\n' % (1, 1)])
+        self.assertEqual(noted, None)
+        self.assertEqual(self._git('rev-parse', 'refs/notes/commits'), notes_ref)
+
+
+class TestPush(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.converter = get_converter()
+        self.work_dir = os.path.abspath(os.path.join('test_logs', 'conversion'))
+        self.target = os.path.abspath(os.path.join('test_logs', 'target.git'))
+        self._git('init', '-q', self.work_dir, cwd=None)
+        self._git('config', 'user.name', 'Test')
+        self._git('config', 'user.email', 'test@example.com')
+        self._git('commit', '-q', '--allow-empty', '-m', 'one')
+        self._git('branch', 'other')
+        self.refs = ['+refs/heads/master:refs/heads/master',
+                     '+refs/heads/other:refs/heads/b2g']
+        for i in range(30):
+            if i % 2:
+                self._git('tag', '-a', '-m', 'tag', 'tag%d' % i)
+            else:
+                self._git('tag', 'tag%d' % i)
+            self.refs.append('+refs/tags/tag%d:refs/tags/tag%d' % (i, i))
+        self._git('init', '-q', '--bare', self.target, cwd=None)
+        self.pushes = []
+        run_command = self.converter.run_command
+
+        def record(command, **kwargs):
+            self.pushes.append(command)
+            return run_command(command, **kwargs)
+        record.__name__ = 'run_command'
+        self.converter.run_command = record
+
+    def tearDown(self):
+        cleanup()
+
+    def _git(self, *args, **kwargs):
+        return subprocess.check_output(['git'] + list(args),
+                                       cwd=kwargs.get('cwd', self.work_dir))
+
+    def _push(self, **kwargs):
+        return self.converter._do_push_repo(
+            ['git', 'push', self.target], refs_list=self.refs,
+            kwargs={'cwd': os.path.join(self.work_dir, '.git')},
+            target=self.target, **kwargs)
+
+    def _remote_refs(self):
+        return sorted(self._git('for-each-ref', cwd=self.target).splitlines())
+
+    def test_push(self):
+        self.assertEqual(self._push(atomic=True), None)
+        self.assertEqual(len(self.pushes), 1)
+        self.assertTrue('--atomic' in self.pushes[0])
+        self.assertEqual(len(self._remote_refs()), len(self.refs))
+        self.assertEqual(self._git('rev-parse', 'refs/heads/b2g', cwd=self.target),
+                         self._git('rev-parse', 'refs/heads/other'))
+        self.assertEqual(self._git('rev-parse', 'refs/tags/tag1', cwd=self.target),
+                         self._git('rev-parse', 'refs/tags/tag1'))
+        # nothing to push
+        self.assertEqual(self._push(atomic=True), None)
+        self.assertEqual(len(self.pushes), 1)
+        # only what changed
+        self._git('commit', '-q', '--allow-empty', '-m', 'two')
+        self._git('tag', '-f', 'tag3')
+        self.assertEqual(self._push(), None)
+        self.assertEqual(len(self.pushes), 2)
+        self.assertEqual(self.pushes[1][3:], [self.refs[0], '+refs/tags/tag3:refs/tags/tag3'])
+
+    def test_push_batches(self):
+        self.assertEqual(self._push(batch_size=10), None)
+        self.assertEqual(len(self.pushes), 4)
+        self.assertEqual(sum(len(p) - 3 for p in self.pushes), len(self.refs))
+        self.assertEqual(len(self._remote_refs()), len(self.refs))
+
+    def test_push_atomic_unsupported(self):
+        self._git('config', 'receive.advertiseAtomic', 'false', cwd=self.target)
+        attempts = []
+        retry = self.converter.retry
+
+        def record_retry(action, **kwargs):
+            attempts.append(kwargs.get('attempts'))
+            return retry(action, **kwargs)
+        self.converter.retry = record_retry
+        self.assertEqual(self._push(batch_size=10, atomic=True), None)
+        self.assertEqual(len(self._remote_refs()), len(self.refs))
+        self.assertEqual(['--atomic' in p for p in self.pushes],
+                         [True, False, False, False, False])
+        # the atomic push isn't retried
+        self.assertEqual(attempts, [1, None, None, None, None])
+
+    def test_push_target_unreachable(self):
+        target = os.path.abspath(os.path.join('test_logs', 'missing.git'))
+        with mock.patch.object(self.converter, 'log', wraps=self.converter.log) as log_:
+            unchanged = self.converter._query_unchanged_refs(target, self.refs, self.work_dir)
+        self.assertEqual(unchanged, set())
+        self.assertEqual([c for c in log_.call_args_list
+                          if c[1].get('level') in (log.ERROR, log.FATAL)], [])
+
+    def test_push_fails(self):
+        self.refs.append('+refs/heads/missing:refs/heads/missing')
+        self.assertEqual(self._push(atomic=True), -1)
+        # all or nothing
+        self.assertEqual(self._remote_refs(), [])
+
+
+class TestRepoNames(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.converter = get_converter()
+        hg = os.path.join(os.path.dirname(sys.executable), 'hg')
+        self.hg = [hg if os.path.exists(hg) else 'hg']
+        self.converter._query_hg_exe = lambda: list(self.hg)
+        self.repo = os.path.abspath(os.path.join('test_logs', 'source'))
+        self._hg('init', self.repo, cwd=None)
+        for branch in ('default', 'GECKO20_BRANCH', 'b2g18', 'other'):
+            if branch != 'default':
+                # a head of its own, so `hg branches -a` lists it
+                self._hg('update', '-q', '-r', '0')
+            self._hg('branch', '-f', '-q', branch)
+            with open(os.path.join(self.repo, 'branch'), 'w') as fh:
+                fh.write(branch)
+            self._hg('commit', '-q', '-A', '-u', 'test', '-m', branch)
+        for tag in ('FIREFOX_20_0_RELEASE', 'B2G_1_0_RELEASE', 'FIREFOX_AURORA_20_BASE'):
+            self._hg('tag', '-u', 'test', tag)
+        self.commands = []
+        get_output_from_command = self.converter.get_output_from_command
+
+        def record(command, **kwargs):
+            self.commands.append(command)
+            return get_output_from_command(command, **kwargs)
+        self.converter.get_output_from_command = record
+
+    def tearDown(self):
+        cleanup()
+
+    def _hg(self, *args, **kwargs):
+        return subprocess.check_output(self.hg + list(args),
+                                       cwd=kwargs.get('cwd', self.repo))
+
+    def test_query_branches(self):
+        branch_config = {
+            'branches': {'default': 'master'},
+            'branch_regexes': ['^GECKO[0-9]+', '^b2g[0-9]+$', 'GECKO'],
+        }
+        expected = {'default': 'master', 'GECKO20_BRANCH': 'GECKO20_BRANCH', 'b2g18': 'b2g18'}
+        self.assertEqual(self.converter.query_branches(branch_config, self.repo), expected)
+        self.assertEqual(self.converter.query_branches(branch_config, self.repo), expected)
+        self.assertEqual(self.converter.query_branches({'branch_regexes': ['^oth']}, self.repo),
+                         {'other': 'other'})
+        self.assertEqual(self.commands, [self.hg + ['branches', '-a']])
+
+    def test_query_refs_list(self):
+        repo_config = {
+            'repo_name': 'source',
+            'branch_config': {'branches': {'default': 'master'}},
+            'tag_config': {'tag_regexes': ['^FIREFOX_[0-9_]+_RELEASE$', '^B2G_', 'RELEASE']},
+        }
+        refs_list = self.converter._query_refs_list(repo_config, {}, self.repo)
+        self.assertEqual(sorted(refs_list), [
+            '+refs/heads/master:refs/heads/master',
+            '+refs/tags/B2G_1_0_RELEASE:refs/tags/B2G_1_0_RELEASE',
+            '+refs/tags/FIREFOX_20_0_RELEASE:refs/tags/FIREFOX_20_0_RELEASE',
+        ])
+        self.converter._query_refs_list(repo_config, {'target_dest': 'other'}, self.repo)
+        self.assertEqual(self.commands, [self.hg + ['tags']])
+        # updating the repo starts over
+        self._hg('tag', '-u', 'test', 'B2G_1_1_RELEASE')
+        self.converter._forget_repo_names(self.repo)
+        refs_list = self.converter._query_refs_list(repo_config, {}, self.repo)
+        self.assertTrue('+refs/tags/B2G_1_1_RELEASE:refs/tags/B2G_1_1_RELEASE' in refs_list)
+        self.assertEqual(len(self.commands), 2)
+
+    def test_compile_regexes(self):
+        patterns = vcs_sync.compile_regexes(['^a', 'b$'])
+        self.assertEqual(len(patterns), 1)
+        self.assertTrue(patterns is vcs_sync.compile_regexes(['^a', 'b$']))
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'ax'))
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'xb'))
+        self.assertFalse(vcs_sync.search_regexes(patterns, 'xa'))
+        # backreferences, conditionals and inline flags keep to themselves
+        patterns = vcs_sync.compile_regexes(['^(x)\\1$', '(?i)^foo', '^(y)?(?(1)z|w)$', '^bar'])
+        self.assertEqual(len(patterns), 4)
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'yz'))
+        self.assertFalse(vcs_sync.search_regexes(patterns, 'yw'))
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'xx'))
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'FOO'))
+        self.assertFalse(vcs_sync.search_regexes(patterns, 'BAR'))
+        self.assertFalse(vcs_sync.search_regexes(vcs_sync.compile_regexes([]), 'x'))
+
+    def test_compile_regexes_same_group_name(self):
+        patterns = vcs_sync.compile_regexes(['^(?P<v>a)', '^(?P<v>b)'])
+        self.assertEqual(len(patterns), 2)
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'b'))
+        self.assertFalse(vcs_sync.search_regexes(patterns, 'c'))
+
+    def test_compile_regexes_too_many_groups(self):
+        regexes = ['^(tag)(%d)$' % i for i in range(60)]
+        patterns = vcs_sync.compile_regexes(regexes)
+        self.assertEqual(len(patterns), 60)
+        self.assertTrue(vcs_sync.search_regexes(patterns, 'tag59'))
+        self.assertFalse(vcs_sync.search_regexes(patterns, 'tag60'))
+
+
+class TestRepoWorkers(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        hg = os.path.join(os.path.dirname(sys.executable), 'hg')
+        self.hg = [hg if os.path.exists(hg) else 'hg']
+        self.repos = []
+        source_dir = os.path.abspath(os.path.join('test_logs', 'stage_source'))
+        for i in range(4):
+            repo_name = 'repo%d' % i
+            repo = os.path.join(source_dir, repo_name)
+            self._hg('init', repo)
+            with open(os.path.join(repo, 'file'), 'w') as fh:
+                fh.write(repo_name)
+            self._hg('commit', '-q', '-A', '-u', 'test', '-m', repo_name, cwd=repo)
+            # repo1 has no branch to convert
+            branch = 'missing' if i == 1 else 'default'
+            self.repos.append({
+                'repo_name': repo_name,
+                'conversion_dir': repo_name,
+                'mapfile_name': '%s-mapfile' % repo_name,
+                'branch_config': {'branches': {branch: 'master'}},
+            })
+
+    def tearDown(self):
+        cleanup()
+
+    def _hg(self, *args, **kwargs):
+        return subprocess.check_output(self.hg + list(args), cwd=kwargs.get('cwd'))
+
+    def _converter(self, *args):
+        converter = get_converter(*args)
+        converter._query_hg_exe = lambda: list(self.hg)
+        converter.query_all_non_failed_repos = lambda: list(self.repos)
+        converter.write_hggit_hgrc = lambda dest: None
+        run_command = converter.run_command
+
+        def gexport(command, **kwargs):
+            # stands in for hg-git: map each hg revision to a fake git one
+            if 'gexport' in command:
+                revs = subprocess.check_output(
+                    self.hg + ['log', '--template', '{node}\\n'], cwd=kwargs['cwd'])
+                with open(os.path.join(kwargs['cwd'], '.hg', 'git-mapfile'), 'w') as fh:
+                    for rev in revs.split():
+                        fh.write('%s %s\n' % (rev[::-1], rev))
+                return 0
+            return run_command(command, **kwargs)
+        gexport.__name__ = 'run_command'
+        converter.run_command = gexport
+        return converter
+
+    def _strip_times(self, repo_map):
+        for repo in repo_map['repos'].values():
+            for branch in repo['branches'].values():
+                del branch['pull_timestamp']
+                del branch['pull_datetime']
+        return repo_map['repos']
+
+    def test_update_work_mirror(self):
+        repo_maps = []
+        for workers in ('1', '3'):
+            shutil.rmtree(os.path.join('test_logs', 'conversion'), ignore_errors=True)
+            converter = self._converter('--repo-workers', workers)
+            converter.update_work_mirror()
+            # a failing repo doesn't stop the others
+            self.assertEqual(converter.failures, ['repo1'])
+            repo_maps.append(self._strip_times(converter._read_repo_update_json()))
+        self.assertEqual(sorted(repo_maps[0]), ['repo0', 'repo2', 'repo3'])
+        for repo_name in ('repo0', 'repo2', 'repo3'):
+            branch = repo_maps[0][repo_name]['branches']['default']
+            self.assertTrue(branch['git_revision'][::-1].startswith(branch['hg_revision']))
+            self.assertTrue(os.path.exists(os.path.join(
+                'test_logs', 'upload', '%s-mapfile' % repo_name)))
+        self.assertEqual(repo_maps[0], repo_maps[1])
+
+    def test_repo_lock(self):
+        converter = self._converter('--repo-workers', '4')
+        lock = converter._repo_lock
+        unlocked = []
+
+        class Failures(list):
+            def append(self, item):
+                if not lock._is_owned():
+                    unlocked.append(item)
+                list.append(self, item)
+        converter.failures = Failures()
+        write_to_file = converter.write_to_file
+
+        def check_lock(path, *args, **kwargs):
+            if not lock._is_owned():
+                unlocked.append(path)
+            return write_to_file(path, *args, **kwargs)
+        converter.write_to_file = check_lock
+
+        def fail(repo_config):
+            repo_name = repo_config['repo_name']
+            converter.add_failure(repo_name)
+            converter._update_repo_previous_status(repo_name, successful_flag=False,
+                                                   write_update=True)
+        repos = [{'repo_name': 'repo%d' % i} for i in range(20)]
+        converter._for_each_repo(fail, repos)
+        self.assertEqual(unlocked, [])
+        self.assertEqual(sorted(converter.failures), sorted(r['repo_name'] for r in repos))
+        # no update was lost
+        repo_map = converter._read_repo_update_json()
+        self.assertEqual(len(repo_map['repos']), len(repos))
+
+
+class TestRemoteHeads(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.converter = get_converter()
+        hg = os.path.join(os.path.dirname(sys.executable), 'hg')
+        self.hg = [hg if os.path.exists(hg) else 'hg']
+        self.converter._query_hg_exe = lambda: list(self.hg)
+        self.remote = os.path.abspath(os.path.join('test_logs', 'remote'))
+        self._hg('init', self.remote, cwd=None)
+        self._commit('one')
+        dirs = self.converter.query_abs_dirs()
+        os.makedirs(dirs['abs_source_dir'])
+        self._hg('clone', '-q', '--noupdate', self.remote,
+                 os.path.join(dirs['abs_source_dir'], 'remote'))
+        self.repo_config = {'repo_name': 'remote', 'repo': self.remote}
+        self.converter._update_repo_previous_status('remote', successful_flag=True,
+                                                    write_update=True)
+        self.urls = []
+        self.heads_error = None
+
+        def urlopen(url, **kwargs):
+            self.urls.append(url)
+            if self.heads_error:
+                raise self.heads_error
+            return StringIO.StringIO(self._hg('heads', '--template', '{node}\\n'))
+        self.converter._urlopen = urlopen
+        self.commands = []
+        run_command = self.converter.run_command
+
+        def record(command, **kwargs):
+            self.commands.append(command[1])
+            return run_command(command, **kwargs)
+        record.__name__ = 'run_command'
+        self.converter.run_command = record
+
+    def tearDown(self):
+        cleanup()
+
+    def _hg(self, *args, **kwargs):
+        return subprocess.check_output(self.hg + list(args),
+                                       cwd=kwargs.get('cwd', self.remote))
+
+    def _commit(self, message):
+        with open(os.path.join(self.remote, 'file'), 'w') as fh:
+            fh.write(message)
+        self._hg('commit', '-q', '-A', '-u', 'test', '-m', message)
+
+    def _update(self):
+        self.commands = []
+        self.converter.failures = []
+        self.converter.remote_heads = self.converter._query_all_remote_heads(
+            [dict(self.repo_config, repo='https://hg.example.com/remote')])
+        self.converter._update_stage_repo(self.repo_config)
+
+    def _recorded_heads(self):
+        repo_map = self.converter._read_repo_update_json()
+        return repo_map['repos']['remote'].get('remote_heads')
+
+    def test_query_remote_heads(self):
+        heads = self._hg('heads', '--template', '{node}\\n').split()
+        self.assertEqual(self.converter._query_remote_heads('https://hg.example.com/remote/'),
+                         heads)
+        self.assertEqual(self.urls, ['https://hg.example.com/remote?cmd=heads'])
+        self.converter._urlopen = lambda url, **kwargs: StringIO.StringIO('<html>')
+        self.assertEqual(self.converter._query_remote_heads('https://hg.example.com/remote'),
+                         None)
+        self.converter._urlopen = lambda url, **kwargs: StringIO.StringIO('')
+        self.assertEqual(self.converter._query_remote_heads('https://hg.example.com/remote'),
+                         None)
+
+    def test_update_stage_repo(self):
+        self._update()
+        # the heads weren't known, so they changed
+        self.assertEqual(self.commands, ['pull'])
+        self.assertEqual(self.converter.failures, [])
+        heads = self._recorded_heads()
+        self.assertEqual(len(heads), 1)
+        # unchanged
+        self._update()
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.converter.failures, ['remote'])
+        # changed
+        self._commit('two')
+        self._update()
+        self.assertEqual(self.commands, ['pull'])
+        self.assertEqual(self.converter.failures, [])
+        self.assertNotEqual(self._recorded_heads(), heads)
+
+    def test_update_stage_repo_no_heads(self):
+        self.heads_error = urllib2.URLError('down')
+        self._update()
+        self.assertEqual(len(self.urls), 1)
+        # falls back to |hg incoming|, which finds nothing new
+        self.assertEqual(self.commands, ['incoming'])
+        self.assertEqual(self.converter.failures, ['remote'])
+        self._commit('two')
+        self._update()
+        self.assertEqual(self.commands, ['incoming', 'pull'])
+        self.assertEqual(self._recorded_heads(), None)
+
+    def test_update_stage_repo_pull_fails(self):
+        self._commit('two')
+        # |hg incoming| is skipped, but the pull and then the reclone fail
+        self.converter.remote_heads = self.converter._query_all_remote_heads(
+            [dict(self.repo_config, repo='https://hg.example.com/remote')])
+        shutil.rmtree(self.remote)
+        self.converter._update_stage_repo(self.repo_config)
+        self.assertEqual(self.commands[0], 'pull')
+        self.assertEqual(self.converter.failures, ['remote'])
+        # so the heads aren't recorded, and the next run pulls again
+        self.assertEqual(self._recorded_heads(), None)
+        self.assertFalse(self.converter._query_repo_previous_status('remote'))
+
+
+class MapperServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A stand-in for mapper, serving the insert and rev lookup urls of
+    any project on localhost.
+
+    Chunks of more than `max_lines` lines are refused like the load
+    balancer does with requests that take too long.  Git shas in `lose`
+    are accepted but never stored.
+    """
+    daemon_threads = True
+
+    def __init__(self, max_lines=None, lose=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MapperHandler)
+        self.max_lines = max_lines
+        self.lose = set(lose)
+        self.by_sha = {}
+        self.posts = []
+        self.gets = 0
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MapperHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # answer in one packet, or keep-alive connections wait on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        lines = self.rfile.read(int(self.headers['Content-Length'])).splitlines()
+        with server.lock:
+            server.clients.add(self.client_address)
+            server.posts.append(len(lines))
+        if not self.path.endswith('/insert/ignoredups'):
+            return self._reply(404)
+        if server.max_lines and len(lines) > server.max_lines:
+            return self._reply(504)
+        with server.lock:
+            for line in lines:
+                git_sha, hg_sha = line.split()
+                if git_sha not in server.lose:
+                    server.by_sha[('git', git_sha)] = line
+                    server.by_sha[('hg', hg_sha)] = line
+        self._reply(200)
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.split('/')
+        with server.lock:
+            server.clients.add(self.client_address)
+            server.gets += 1
+            mapping = server.by_sha.get(tuple(parts[-2:]))
+        if parts[-3] != 'rev' or mapping is None:
+            return self._reply(404, "not found")
+        self._reply(200, mapping)
+
+
+@unittest.skipUnless(requests, "requests isn't installed")
+class TestPublishToMapper(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.converter = get_converter()
+        self.mappings = ['%040x %040x\n' % (i, i + 1000000) for i in range(500)]
+        self.server = None
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        if self.server:
+            self.server.stop()
+        cleanup()
+
+    def _session(self, mapper_config):
+        session = self.converter._query_mapper_session(requests, mapper_config)
+        self.sessions.append(session)
+        return session
+
+    def _publish(self, **mapper_config):
+        insert_url = '%s/gecko-dev/insert/ignoredups' % self.server.url
+        session = self._session(mapper_config)
+        return self.converter._publish_mappings(
+            session, insert_url, self.mappings,
+            lambda data: {'Content-Type': 'text/plain'}, mapper_config)
+
+    def _verify(self, **mapper_config):
+        insert_url = '%s/gecko-dev/insert/ignoredups' % self.server.url
+        session = self._session(mapper_config)
+        return self.converter._verify_mappings(
+            session, insert_url, self.mappings, mapper_config)
+
+    def test_publish(self):
+        self.server = MapperServer()
+        self.assertTrue(self._publish(workers=4, chunk_size=50))
+        self.assertEqual(sum(self.server.posts), len(self.mappings))
+        self.assertEqual(len(self.server.by_sha), 2 * len(self.mappings))
+        # chunks grow while mapper keeps up
+        self.assertTrue(max(self.server.posts) > 50)
+        self.assertTrue(len(self.server.posts) < len(self.mappings) / 50)
+        # connections are reused
+        self.assertTrue(len(self.server.clients) <= 4)
+        self.assertTrue(self._verify(verify_workers=4))
+        self.assertEqual(self.server.gets, 2 * len(self.mappings))
+
+    def test_publish_split(self):
+        self.server = MapperServer(max_lines=150)
+        self.assertTrue(self._publish(workers=4, chunk_size=400, min_chunk_size=50))
+        self.assertTrue(max(self.server.posts) > 150)
+        self.assertEqual(len(self.server.by_sha), 2 * len(self.mappings))
+        self.assertTrue(self._verify())
+
+    def test_publish_fails(self):
+        self.server = MapperServer(max_lines=40)
+        self.assertFalse(self._publish(workers=4, min_chunk_size=50))
+
+    def test_verify_fails(self):
+        self.server = MapperServer(lose=[self.mappings[432].split()[0]])
+        self.assertTrue(self._publish())
+        self.assertFalse(self._verify())
+
+    def test_verify_sample(self):
+        self.server = MapperServer()
+        self.assertTrue(self._publish())
+        self.assertTrue(self._verify(verify_sample=10))
+        self.assertEqual(self.server.gets, 20)
+
+    def test_check_new_mappings(self):
+        errors = []
+        self.converter.error = errors.append
+        published = os.path.abspath(os.path.join('test_logs', 'published-to-mapper'))
+        complete = os.path.abspath(os.path.join('test_logs', 'git-mapfile'))
+        _write_data_file(published, *self.mappings[:100])
+        _write_data_file(complete, *self.mappings[:300])
+        self.converter._check_new_mappings(published, complete, self.mappings[100:300])
+        self.assertEqual(errors, [])
+        self.converter._check_new_mappings(published, complete, self.mappings[50:300])
+        self.assertEqual(len(errors), 2)
 
 
 if __name__ == '__main__':